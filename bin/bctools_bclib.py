@@ -0,0 +1,233 @@
+"""
+Compact binary barcode libraries.
+
+A binary barcode library maps 64-bit hashes of read ids to barcodes packed
+with two bits per nucleotide. Positions of uncalled bases (N) are stored in a
+separate bit mask. Barcodes of reads whose id hashes collide are stored in a
+side table together with the full read id.
+
+File layout (little endian):
+
+* header: magic, barcode length, number of entries, number of side table
+  entries (32 bytes)
+* sorted read id hashes (uint64, one per entry)
+* packed barcodes (ceil(length / 4) bytes per entry)
+* N masks (ceil(length / 8) bytes per entry)
+* side table: per entry the read id length (uint32), the read id and the
+  barcode
+
+Libraries are read via mmap, lookups use binary search over the hashes.
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+from tempfile import mkstemp
+import numpy as np
+
+MAGIC = b"BCTLIB01"
+HEADER = struct.Struct("<8sIIQQ")
+
+# 2-bit codes of nucleotides, N is encoded as A and flagged in the N mask
+_ENCODE = np.full(256, 255, dtype=np.uint8)
+for _code, _nt in enumerate(bytearray(b"ACGT")):
+    _ENCODE[_nt] = _code
+_ENCODE[ord("N")] = 0
+_DECODE = np.frombuffer(b"ACGT", dtype=np.uint8)
+
+
+def is_binary_library(filename):
+    """Check if filename is a binary barcode library."""
+    with open(filename, "rb") as fh:
+        return fh.read(len(MAGIC)) == MAGIC
+
+
+def hash_read_ids(read_ids):
+    """Return the 64-bit hashes of a list of read ids as uint64 array."""
+    digests = b"".join([hashlib.md5(rid).digest()[:8] for rid in read_ids])
+    return np.frombuffer(digests, dtype="<u8")
+
+
+def pack_barcodes(barcodes, length):
+    """Pack a list of barcodes of the given length.
+
+    Returns a tuple (codes, nmasks) of uint8 arrays with one row per barcode.
+    """
+    seqs = np.frombuffer(b"".join(barcodes), dtype=np.uint8)
+    if len(seqs) != len(barcodes) * length:
+        raise ValueError("Binary barcode libraries require barcodes of equal length {}.".format(length))
+    seqs = seqs.reshape(len(barcodes), length)
+    codes = _ENCODE[seqs]
+    if (codes == 255).any():
+        raise ValueError("Binary barcode libraries only support barcodes of nucleotides A, C, G, T and N.")
+    # pad to full bytes and pack four nucleotides per byte, first nt in high bits
+    padded = np.zeros((len(barcodes), -(-length // 4) * 4), dtype=np.uint8)
+    padded[:, :length] = codes
+    padded = padded.reshape(len(barcodes), -1, 4)
+    packed = (padded[:, :, 0] << 6) | (padded[:, :, 1] << 4) | (padded[:, :, 2] << 2) | padded[:, :, 3]
+    nmasks = np.packbits(seqs == ord("N"), axis=1)
+    return packed.astype(np.uint8), nmasks
+
+
+def unpack_barcodes(codes, nmasks, length):
+    """Unpack rows of packed barcodes into a list of barcode byte strings."""
+    codes = np.asarray(codes, dtype=np.uint8)
+    n_barcodes = codes.shape[0]
+    unpacked = np.empty((n_barcodes, codes.shape[1] * 4), dtype=np.uint8)
+    for i, shift in enumerate((6, 4, 2, 0)):
+        unpacked[:, i::4] = (codes >> shift) & 3
+    seqs = _DECODE[unpacked[:, :length]]
+    is_n = np.unpackbits(np.asarray(nmasks, dtype=np.uint8), axis=1)[:, :length].astype(bool)
+    seqs[is_n] = ord("N")
+    data = seqs.tobytes()
+    return [data[i * length:(i + 1) * length] for i in range(n_barcodes)]
+
+
+class BarcodeLibraryWriter(object):
+    """Write a binary barcode library.
+
+    Entries are collected in memory and sorted when the library is closed.
+    Read ids are kept in a temporary file to resolve hash collisions.
+    """
+
+    def __init__(self, filename, tmpdir=None):
+        self.filename = filename
+        self.length = None
+        self._hashes = []
+        self._codes = []
+        self._nmasks = []
+        fd, self._ids_fn = mkstemp(prefix="bclib_ids_", dir=tmpdir)
+        self._ids = os.fdopen(fd, "wb")
+
+    def add(self, read_ids, barcodes):
+        """Add lists of read ids and barcodes to the library."""
+        if not read_ids:
+            return
+        if self.length is None:
+            self.length = len(barcodes[0])
+        codes, nmasks = pack_barcodes(barcodes, self.length)
+        self._hashes.append(hash_read_ids(read_ids))
+        self._codes.append(codes)
+        self._nmasks.append(nmasks)
+        self._ids.write(b"\n".join(read_ids) + b"\n")
+
+    def close(self):
+        """Sort entries, resolve collisions and write the library."""
+        self._ids.close()
+        try:
+            length = self.length or 0
+            if self._hashes:
+                hashes = np.concatenate(self._hashes)
+                codes = np.concatenate(self._codes)
+                nmasks = np.concatenate(self._nmasks)
+            else:
+                hashes = np.zeros(0, dtype="<u8")
+                codes = np.zeros((0, 0), dtype=np.uint8)
+                nmasks = np.zeros((0, 0), dtype=np.uint8)
+            order = np.argsort(hashes, kind="mergesort")
+            hashes = hashes[order]
+            codes = codes[order]
+            nmasks = nmasks[order]
+
+            # move entries with colliding hashes to the side table
+            colliding = np.zeros(len(hashes), dtype=bool)
+            if len(hashes) > 1:
+                same = hashes[1:] == hashes[:-1]
+                colliding[1:] |= same
+                colliding[:-1] |= same
+            side_table = self._side_table(order[colliding], codes[colliding], nmasks[colliding], length)
+            keep = ~colliding
+
+            with open(self.filename, "wb") as out:
+                out.write(HEADER.pack(MAGIC, length, 0, int(keep.sum()), len(side_table)))
+                out.write(hashes[keep].astype("<u8").tobytes())
+                out.write(np.ascontiguousarray(codes[keep]).tobytes())
+                out.write(np.ascontiguousarray(nmasks[keep]).tobytes())
+                for rid, barcode in side_table:
+                    out.write(struct.pack("<I", len(rid)) + rid + barcode)
+        finally:
+            os.remove(self._ids_fn)
+
+    def _side_table(self, indices, codes, nmasks, length):
+        """Return (read id, barcode) of the entries at the given input indices."""
+        if len(indices) == 0:
+            return []
+        barcodes = dict(zip(indices.tolist(), unpack_barcodes(codes, nmasks, length)))
+        side_table = []
+        seen = set()
+        with open(self._ids_fn, "rb") as ids:
+            for i, line in enumerate(ids):
+                if i in barcodes:
+                    rid = line.rstrip(b"\n")
+                    # keep the first entry of duplicated read ids
+                    if rid not in seen:
+                        seen.add(rid)
+                        side_table.append((rid, barcodes[i]))
+        return side_table
+
+
+class BarcodeLibrary(object):
+    """Memory-mapped binary barcode library."""
+
+    def __init__(self, filename):
+        self._fh = open(filename, "rb")
+        size = os.fstat(self._fh.fileno()).st_size
+        if size < HEADER.size:
+            raise ValueError("File '{}' is not a binary barcode library.".format(filename))
+        self._mm = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.length, _, n_entries, n_side = HEADER.unpack(self._mm[:HEADER.size])
+        if magic != MAGIC:
+            raise ValueError("File '{}' is not a binary barcode library.".format(filename))
+        code_width = -(-self.length // 4)
+        mask_width = -(-self.length // 8)
+        offset = HEADER.size
+        self.hashes = np.frombuffer(self._mm, dtype="<u8", count=n_entries, offset=offset)
+        offset += 8 * n_entries
+        self.codes = np.frombuffer(self._mm, dtype=np.uint8, count=n_entries * code_width,
+                                   offset=offset).reshape(n_entries, code_width)
+        offset += n_entries * code_width
+        self.nmasks = np.frombuffer(self._mm, dtype=np.uint8, count=n_entries * mask_width,
+                                    offset=offset).reshape(n_entries, mask_width)
+        offset += n_entries * mask_width
+
+        # the side table is small and read completely
+        self.side_table = {}
+        for _ in range(n_side):
+            id_len, = struct.unpack("<I", self._mm[offset:offset + 4])
+            offset += 4
+            rid = self._mm[offset:offset + id_len]
+            offset += id_len
+            self.side_table[rid] = self._mm[offset:offset + self.length]
+            offset += self.length
+        self._side_hashes = set(hash_read_ids(list(self.side_table)).tolist())
+
+    def __len__(self):
+        return len(self.hashes) + len(self.side_table)
+
+    def lookup(self, read_ids):
+        """Return the barcodes of a list of read ids, None for missing ids."""
+        hashes = hash_read_ids(read_ids)
+        pos = np.searchsorted(self.hashes, hashes)
+        pos_clipped = np.minimum(pos, max(len(self.hashes) - 1, 0))
+        if len(self.hashes):
+            found = self.hashes[pos_clipped] == hashes
+        else:
+            found = np.zeros(len(hashes), dtype=bool)
+        barcodes = [None] * len(read_ids)
+        found_idx = np.flatnonzero(found)
+        if len(found_idx):
+            rows = pos_clipped[found_idx]
+            for i, barcode in zip(found_idx.tolist(),
+                                  unpack_barcodes(self.codes[rows], self.nmasks[rows], self.length)):
+                barcodes[i] = barcode
+        if self.side_table:
+            for i, (rid, h) in enumerate(zip(read_ids, hashes.tolist())):
+                if h in self._side_hashes:
+                    barcodes[i] = self.side_table.get(rid)
+        return barcodes
+
+    def close(self):
+        self.hashes = self.codes = self.nmasks = None
+        self._mm.close()
+        self._fh.close()
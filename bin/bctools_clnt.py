@@ -0,0 +1,51 @@
+"""
+Conversion of alignment coordinates to crosslinked nucleotides.
+
+Bed lines are read in large blocks from plain or compressed files. The
+coordinates of a block are shifted at once with numpy, depending on strand:
+the crosslinked nucleotide is one nt upstream of the 5'-end of a read or,
+optionally, one nt downstream of its 3'-end. Features without strand are
+treated as plus-strand features. Coordinates are clipped as by
+pybedtools.featurefuncs.five_prime and three_prime, so the output is
+identical to that of BedTool.each(five_prime, upstream=1, downstream=0) and
+BedTool.each(three_prime, upstream=0, downstream=1).
+"""
+
+import numpy as np
+from bctools_fastq import DEFAULT_CHUNK_SIZE
+from bctools_io import open_input, read_blocks
+
+# header lines skipped by pybedtools
+_HEADER_PREFIXES = (b"#", b"track", b"browser")
+
+
+def _line_boundary(data):
+    """Return the offset behind the last complete line in data."""
+    return data.rfind(b"\n") + 1
+
+
+def crosslink_block(data, threeprime=False):
+    """Return the bed lines of a block of bed lines shifted to the crosslinked nucleotides."""
+    fields = [line.split(b"\t") for line in data.split(b"\n")
+              if line.strip() and not line.startswith(_HEADER_PREFIXES)]
+    if not fields:
+        return b""
+    starts = np.array([int(f[1]) for f in fields], dtype=np.int64)
+    stops = np.array([int(f[2]) for f in fields], dtype=np.int64)
+    minus = np.array([len(f) > 5 and f[5] == b"-" for f in fields], dtype=bool)
+    if threeprime:
+        new_starts = np.where(minus, starts - 1, stops)
+        new_stops = np.where(minus, starts, stops + 1)
+    else:
+        new_starts = np.where(minus, stops, starts - 1)
+        new_stops = np.where(minus, stops + 1, starts)
+    new_starts = np.minimum(np.maximum(new_starts, 0), new_stops)
+    return b"".join([b"\t".join([f[0], b"%d" % start, b"%d" % stop] + f[3:]) + b"\n"
+                     for f, start, stop in zip(fields, new_starts.tolist(), new_stops.tolist())])
+
+
+def crosslink_positions(filename, out, threeprime=False, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Write the crosslinked nucleotides of the bed lines of a plain or compressed file to the binary file handle out."""
+    with open_input(filename) as fh:
+        for block in read_blocks(fh, chunk_size, _line_boundary):
+            out.write(crosslink_block(block, threeprime))
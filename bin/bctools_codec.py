@@ -0,0 +1,90 @@
+"""
+Bit-packed barcode keys.
+
+Barcodes are packed into integers with two bits per nucleotide (A, C, G, T) or
+one bit per base in binary RY-space (R, Y). Nucleotides are translated to
+RY-space while packing, so nucleotide barcodes can be packed directly into
+RY-space keys.
+
+The first base is stored in the highest bits below a leading sentinel bit.
+Keys of barcodes of equal length therefore sort like the barcodes and
+barcodes of different length have different keys. Barcodes containing other
+characters, such as uncalled bases (N), can not be packed.
+"""
+
+import numpy as np
+
+NT_SPACE = "nt"
+RY_SPACE = "ry"
+BARCODE_SPACES = (NT_SPACE, RY_SPACE)
+
+_INVALID = 255
+
+
+def _code_table(codes):
+    table = np.full(256, _INVALID, dtype=np.uint8)
+    for chars, code in codes:
+        for char in bytearray(chars):
+            table[char] = code
+    return table
+
+
+class BarcodeCodec(object):
+    """Pack barcodes into integer keys and unpack keys into barcodes.
+
+    space is either NT_SPACE, packing A, C, G and T with two bits per base,
+    or RY_SPACE, packing R (A, G) and Y (C, T, U) with one bit per base.
+    """
+
+    def __init__(self, space=NT_SPACE):
+        if space == NT_SPACE:
+            self.bits = 2
+            self.alphabet = b"ACGT"
+            self._table = _code_table([(b"A", 0), (b"C", 1), (b"G", 2), (b"T", 3)])
+        elif space == RY_SPACE:
+            self.bits = 1
+            self.alphabet = b"RY"
+            self._table = _code_table([(b"AGR", 0), (b"CTUY", 1)])
+        else:
+            raise ValueError("Barcode space must be one of '{}', is '{}'.".format("', '".join(BARCODE_SPACES), space))
+        self.space = space
+        # longest barcode whose key, including the sentinel bit, fits into 64 bits
+        self.max_length = 63 // self.bits
+        self._codes = self._table.tolist()
+
+    def pack(self, barcode):
+        """Return the key of a barcode or None if it can not be packed."""
+        key = 1
+        for char in bytearray(barcode):
+            code = self._codes[char]
+            if code == _INVALID:
+                return None
+            key = (key << self.bits) | code
+        return key
+
+    def pack_batch(self, barcodes):
+        """Return the keys of a list of barcodes, None for barcodes that can not be packed."""
+        lengths = set(map(len, barcodes))
+        if len(lengths) != 1:
+            return [self.pack(barcode) for barcode in barcodes]
+        length = lengths.pop()
+        if length > self.max_length:
+            return [self.pack(barcode) for barcode in barcodes]
+        codes = self._table[np.frombuffer(b"".join(barcodes), dtype=np.uint8).reshape(len(barcodes), length)]
+        keys = np.ones(len(barcodes), dtype=np.uint64)
+        for column in range(length):
+            keys = (keys << np.uint64(self.bits)) | codes[:, column].astype(np.uint64)
+        packed = keys.tolist()
+        for i in np.flatnonzero((codes == _INVALID).any(axis=1)).tolist():
+            packed[i] = None
+        return packed
+
+    def unpack(self, key):
+        """Return the barcode of a key."""
+        mask = (1 << self.bits) - 1
+        bases = bytearray()
+        while key > 1:
+            bases.append(self.alphabet[key & mask])
+            key >>= self.bits
+        bases.reverse()
+        return bytes(bases)
@@ -0,0 +1,152 @@
+"""
+Assignment of reads to samples by experimental barcodes.
+
+Experimental barcodes are read from FASTA files such as RR_bcs.fa, the first
+word of each header is the sample name. Before processing reads, all sequences
+within the allowed number of mismatches of any barcode are enumerated and
+stored in a dictionary, so each read is assigned with a single lookup.
+Sequences that are equally close to barcodes of different samples are
+ambiguous.
+
+Barcodes are compared either as nucleotides or in binary RY-space. N counts as
+a mismatch to every base.
+"""
+
+from collections import Counter
+from itertools import combinations, product
+from bctools_extract import TOO_SHORT, NO_REMAINDER, NO_ANCHOR
+from bctools_fastq import parse_fastq_block, format_fastq
+from bctools_io import map_ordered
+from bctools_ry import translate_nt_to_RY
+
+# bins of reads that are not assigned to a single sample
+AMBIGUOUS = "ambiguous"
+UNASSIGNED = "unassigned"
+
+NT_ALPHABET = b"ACGTN"
+RY_ALPHABET = b"RYN"
+
+
+def read_barcode_fasta(filename):
+    """Return a list of (sample, barcode) tuples of a barcode FASTA file."""
+    barcodes = []
+    with open(filename, "rb") as fh:
+        name = None
+        seq = []
+        for line in fh:
+            line = line.strip()
+            if line.startswith(b">"):
+                if name is not None:
+                    barcodes.append((name, b"".join(seq).upper()))
+                fields = line[1:].split(None, 1)
+                if not fields:
+                    raise ValueError("Barcode without name in file '{}'.".format(filename))
+                name = fields[0].decode()
+                seq = []
+            elif line:
+                if name is None:
+                    raise ValueError("File '{}' is not in FASTA format.".format(filename))
+                seq.append(line)
+        if name is not None:
+            barcodes.append((name, b"".join(seq).upper()))
+    return barcodes
+
+
+def neighbourhood(barcode, mismatches, alphabet):
+    """Yield (sequence, distance) of all sequences within mismatches of barcode."""
+    yield bytes(barcode), 0
+    barcode = bytearray(barcode)
+    for distance in range(1, mismatches + 1):
+        for positions in combinations(range(len(barcode)), distance):
+            alternatives = [[base for base in bytearray(alphabet) if base != barcode[pos]]
+                            for pos in positions]
+            for substitution in product(*alternatives):
+                seq = bytearray(barcode)
+                for pos, base in zip(positions, substitution):
+                    seq[pos] = base
+                yield bytes(seq), distance
+
+
+class SampleTable(object):
+    """Lookup table of all sequences within mismatches of the sample barcodes.
+
+    barcodes is a list of (sample, barcode) tuples, a sample may have several
+    barcodes. With ry_space barcodes of reads and samples are translated to
+    binary RY-space before comparison.
+    """
+
+    def __init__(self, barcodes, mismatches=0, ry_space=False):
+        if not barcodes:
+            raise ValueError("No sample barcodes supplied.")
+        if mismatches < 0:
+            raise ValueError("Number of mismatches must not be negative.")
+        self.ry_space = ry_space
+        self.samples = []
+        alphabet = RY_ALPHABET if ry_space else NT_ALPHABET
+        lengths = set(len(barcode) for _, barcode in barcodes)
+        if len(lengths) != 1:
+            raise ValueError("Sample barcodes must be of equal length.")
+        self.length = lengths.pop()
+
+        closest = {}
+        for sample, barcode in barcodes:
+            if sample in (AMBIGUOUS, UNASSIGNED):
+                raise ValueError("Sample name '{}' is reserved.".format(sample))
+            if sample not in self.samples:
+                self.samples.append(sample)
+            barcode = self._translate(barcode)
+            if barcode.strip(alphabet):
+                raise ValueError("Sample barcode '{}' contains characters other than '{}'.".format(
+                    barcode.decode(), alphabet.decode()))
+            for seq, distance in neighbourhood(barcode, mismatches, alphabet):
+                best = closest.get(seq)
+                if best is None or distance < best[0]:
+                    closest[seq] = (distance, sample)
+                elif distance == best[0] and sample != best[1]:
+                    closest[seq] = (distance, AMBIGUOUS)
+        self.table = dict((seq, sample) for seq, (_, sample) in closest.items())
+
+    def _translate(self, seq):
+        return translate_nt_to_RY(seq) if self.ry_space else seq
+
+    def assign(self, barcode):
+        """Return the sample of a barcode, AMBIGUOUS or UNASSIGNED."""
+        return self.table.get(self._translate(barcode), UNASSIGNED)
+
+
+def demultiplex_chunk(records, pattern, table, add_to_head=False):
+    """Extract sample barcodes from a list of records and assign the reads.
+
+    Reads assigned to a sample have the barcode removed as in extract_bcs.py.
+    Ambiguous and unassigned reads, including reads the barcode could not be
+    extracted from, are kept unchanged.
+
+    Returns a tuple (reads, counts) of dictionaries mapping samples and bins
+    to the formatted reads and the number of reads.
+    """
+    reads = {}
+    counts = Counter()
+    for (header, seq, qual), result in zip(records, pattern.extract_batch(records)):
+        if result == TOO_SHORT or result == NO_REMAINDER or result == NO_ANCHOR:
+            sample = UNASSIGNED
+        else:
+            barcode, _, new_seq, new_qual = result
+            sample = table.assign(barcode)
+            if sample != AMBIGUOUS and sample != UNASSIGNED:
+                header = header + b" " + barcode if add_to_head else header
+                seq, qual = new_seq, new_qual
+        reads.setdefault(sample, []).append(format_fastq(header, seq, qual))
+        counts[sample] += 1
+    return dict((sample, b"".join(entries)) for sample, entries in reads.items()), counts
+
+
+def _demultiplex_block(block, pattern, table, add_to_head):
+    return demultiplex_chunk(parse_fastq_block(block), pattern, table, add_to_head)
+
+
+def demultiplex_blocks(blocks, pattern, table, threads=1, add_to_head=False):
+    """Demultiplex blocks of raw FASTQ data.
+
+    Yields the result of demultiplex_chunk for each block in input order.
+    """
+    return map_ordered(_demultiplex_block, blocks, (pattern, table, add_to_head), threads)
@@ -0,0 +1,271 @@
+"""
+Barcode patterns and batched barcode extraction for FASTQ records.
+
+Reads of a batch are grouped by length. For each length the barcode and the
+remaining sequence positions are gathered with NumPy index arrays from a
+matrix holding all reads of that length.
+
+Patterns may contain anchor sequences (literal A, C, G, T) such as linkers
+next to the barcode. Anchors are located per read by comparing the anchor
+positions of all reads of a length group at every allowed offset at once.
+"""
+
+import re
+from collections import defaultdict, namedtuple
+import numpy as np
+from bctools_fastq import parse_fastq_block, format_fastq, format_fasta, remove_tail
+from bctools_io import map_ordered
+from bctools_ry import FASTA_WRAP, translate_nt_to_RY
+
+# reasons for skipping a read
+TOO_SHORT = "too_short"
+NO_REMAINDER = "no_remainder"
+NO_ANCHOR = "no_anchor"
+
+
+def _index(positions):
+    """Concatenate a list of (start, stop) ranges into an index array."""
+    ranges = [np.arange(start, stop) for start, stop in positions]
+    return np.concatenate(ranges + [np.zeros(0, dtype=np.intp)]).astype(np.intp)
+
+
+class BarcodePattern(object):
+    """Barcode pattern of X (barcode), N (kept) and anchor positions.
+
+    Positions are counted from the 5'-end. Anchor positions (A, C, G, T) have
+    to match the read with at most max_mismatches mismatches and are removed
+    together with the barcode. If max_offset is set, the pattern may start up
+    to this many nts downstream of the 5'-end; the spacer in front of the
+    pattern is removed as well. The offset with the fewest anchor mismatches
+    is used, ties are resolved in favour of the smaller offset.
+    """
+
+    def __init__(self, pattern, max_offset=0, max_mismatches=0):
+        # check if supplied pattern is valid
+        if re.match("^[XNACGT]+$", pattern) is None:
+            raise ValueError("Error: supplied pattern '{}' is not valid.".format(pattern))
+        # check if at least one barcode position is included in the pattern
+        if re.search("X", pattern) is None:
+            raise ValueError("Error: supplied pattern '{}' does not contain a barcode position 'X'.".format(pattern))
+        if max_offset < 0 or max_mismatches < 0:
+            raise ValueError("Error: offset and number of mismatches must not be negative.")
+        self.pattern = pattern
+
+        # get X, N and anchor positions of pattern string
+        runs = [(m.start(), m.end(), m.group(0)) for m in re.finditer("X+|N+|[ACGT]+", pattern)]
+        self.barcode_positions = [(start, stop) for start, stop, run in runs if run[0] == "X"]
+        self.anchor_positions = [(start, stop) for start, stop, run in runs if run[0] in "ACGT"]
+        self.anchors = [run for _, _, run in runs if run[0] in "ACGT"]
+        if max_offset > 0 and not self.anchors:
+            raise ValueError("Error: supplied pattern '{}' requires an anchor sequence to search for offsets.".format(pattern))
+        self.max_offset = max_offset
+        self.max_mismatches = max_mismatches
+
+        # get last position of a barcode or anchor nt in the pattern
+        # reads must be long enough for all
+        self.min_readlen = max(stop for start, stop, run in runs if run[0] != "N")
+
+        # get coordinates of nucleotides to keep
+        # the tail after the last barcode or anchor nt is handled separately
+        self.seq_positions = [(start, stop) for start, stop, run in runs
+                              if run[0] == "N" and stop <= self.min_readlen]
+        self.last_seq_start = self.min_readlen
+
+        # index arrays used to gather barcode and sequence columns
+        self.barcode_index = _index(self.barcode_positions)
+        self.seq_head_index = _index(self.seq_positions)
+        self.anchor_index = _index(self.anchor_positions)
+        self.anchor_bases = np.frombuffer("".join(self.anchors).encode(), dtype=np.uint8)
+        self._seq_index_cache = {}
+
+    def seq_index(self, readlen, offset=0):
+        """Index array of the positions kept in a read of length readlen."""
+        try:
+            return self._seq_index_cache[readlen, offset]
+        except KeyError:
+            index = np.concatenate([self.seq_head_index + offset,
+                                    np.arange(self.last_seq_start + offset, readlen)]).astype(np.intp)
+            self._seq_index_cache[readlen, offset] = index
+            return index
+
+    def find_offsets(self, seqs):
+        """Locate the pattern in a matrix of reads of equal length.
+
+        Returns an array of pattern offsets per read, -1 for reads without
+        matching anchor.
+        """
+        n_reads, readlen = seqs.shape
+        n_offsets = min(self.max_offset, readlen - self.min_readlen) + 1
+        if not len(self.anchor_index):
+            return np.zeros(n_reads, dtype=np.intp)
+        mismatches = np.empty((n_offsets, n_reads), dtype=np.intp)
+        for offset in range(n_offsets):
+            mismatches[offset] = (seqs[:, self.anchor_index + offset] != self.anchor_bases).sum(axis=1)
+        offsets = mismatches.argmin(axis=0)
+        offsets[mismatches[offsets, np.arange(n_reads)] > self.max_mismatches] = -1
+        return offsets
+
+    def extract_batch(self, records):
+        """Extract barcodes from a list of (header, seq, qual) records.
+
+        Returns a list with one entry per record. Entries are either a tuple
+        (barcode, barcode_qual, new_seq, new_qual) or one of TOO_SHORT,
+        NO_REMAINDER and NO_ANCHOR for reads that have to be skipped.
+        """
+        results = [None] * len(records)
+        by_length = defaultdict(list)
+        for i, record in enumerate(records):
+            by_length[len(record[1])].append(i)
+
+        bclen = len(self.barcode_index)
+        for readlen, indices in by_length.items():
+            # skip reads that are too short to extract the full requested barcode
+            if readlen < self.min_readlen:
+                for i in indices:
+                    results[i] = TOO_SHORT
+                continue
+
+            n_reads = len(indices)
+            seqs = np.frombuffer(b"".join([records[i][1] for i in indices]),
+                                 dtype=np.uint8).reshape(n_reads, readlen)
+            quals = np.frombuffer(b"".join([records[i][2] for i in indices]),
+                                  dtype=np.uint8).reshape(n_reads, readlen)
+            offsets = self.find_offsets(seqs)
+            indices = np.asarray(indices)
+            for i in indices[offsets < 0].tolist():
+                results[i] = NO_ANCHOR
+
+            for offset in np.unique(offsets[offsets >= 0]).tolist():
+                rows = np.flatnonzero(offsets == offset)
+                seq_index = self.seq_index(readlen, offset)
+                # check if at least one nucleotide is left. having none would break fastq
+                if len(seq_index) == 0:
+                    for i in indices[rows].tolist():
+                        results[i] = NO_REMAINDER
+                    continue
+                barcode_index = self.barcode_index + offset
+                group_seqs = seqs[rows]
+                group_quals = quals[rows]
+                bcs = group_seqs[:, barcode_index].tobytes()
+                bc_quals = group_quals[:, barcode_index].tobytes()
+                new_seqs = group_seqs[:, seq_index].tobytes()
+                new_quals = group_quals[:, seq_index].tobytes()
+
+                seqlen = len(seq_index)
+                for j, i in enumerate(indices[rows].tolist()):
+                    bcstart = j * bclen
+                    seqstart = j * seqlen
+                    results[i] = (bcs[bcstart:bcstart + bclen],
+                                  bc_quals[bcstart:bcstart + bclen],
+                                  new_seqs[seqstart:seqstart + seqlen],
+                                  new_quals[seqstart:seqstart + seqlen])
+        return results
+
+
+# formatted output of process_chunk
+ChunkResult = namedtuple("ChunkResult", ["reads", "mate_reads", "barcodes", "ry_barcodes",
+                                         "library_entries", "skipped"])
+
+
+def process_chunk(pattern, records, mate_records=None, barcode_mate=1, tail_length=None,
+                  add_to_head=False, fasta_barcodes=False, nt_library=True, ry_library=False,
+                  binary_library=False):
+    """Run barcode extraction and the following stages on a chunk of reads.
+
+    records holds the reads of the first mate. For paired-end data
+    mate_records holds the reads of the second mate and the barcode is
+    extracted from mate barcode_mate (1 or 2). If tail_length is set, this
+    many nucleotides are removed from the 3'-end of the mate without barcode.
+    Pairs are skipped together if the barcode mate has to be skipped.
+
+    nt_library and ry_library select whether the barcode library is formatted
+    as nucleotides and translated to binary RY-space. RY-space FASTA records
+    are wrapped as by convert_bc_to_binary_RY.py. binary_library collects
+    the (read id, barcode) entries of a binary barcode library.
+
+    Returns a ChunkResult. reads and mate_reads contain the formatted FASTQ
+    entries of both mates (mate_reads is None for single-end data), barcodes
+    and ry_barcodes the formatted barcode libraries and library_entries a tuple
+    of lists of read ids and barcodes. skipped lists (header, seq, reason) of
+    all skipped reads.
+    """
+    paired = mate_records is not None
+    if not paired:
+        bc_records, other_records = records, records
+    elif barcode_mate == 1:
+        bc_records, other_records = records, mate_records
+    else:
+        bc_records, other_records = mate_records, records
+    bc_reads = []
+    other_reads = []
+    barcodes = []
+    ry_barcodes = []
+    entry_ids = []
+    entry_barcodes = []
+    skipped = []
+    format_library = format_fasta if fasta_barcodes else format_fastq
+    results = pattern.extract_batch(bc_records)
+    for (header, seq, qual), (oheader, oseq, oqual), result in zip(bc_records, other_records, results):
+        if result is TOO_SHORT or result is NO_REMAINDER or result is NO_ANCHOR:
+            skipped.append((header, seq, result))
+            continue
+        barcode, barcode_quals, new_seq, new_qual = result
+
+        # write barcode nucleotides into the headers of all mates
+        if add_to_head:
+            bc_reads.append(format_fastq(header + b" " + barcode, new_seq, new_qual))
+        else:
+            bc_reads.append(format_fastq(header, new_seq, new_qual))
+        if paired:
+            if tail_length is not None:
+                oseq, oqual = remove_tail(oseq, oqual, tail_length)
+            if add_to_head:
+                other_reads.append(format_fastq(oheader + b" " + barcode, oseq, oqual))
+            else:
+                other_reads.append(format_fastq(oheader, oseq, oqual))
+
+        library_args = (header, barcode) if fasta_barcodes else (header, barcode, barcode_quals)
+        if nt_library:
+            barcodes.append(format_library(*library_args))
+        if ry_library and fasta_barcodes:
+            # wrapped as by convert_bc_to_binary_RY.py
+            ry_barcodes.append(format_fasta(header, translate_nt_to_RY(barcode), FASTA_WRAP))
+        elif ry_library:
+            ry_barcodes.append(format_fastq(header, translate_nt_to_RY(barcode), barcode_quals))
+        if binary_library:
+            entry_ids.append(header.split(None, 1)[0])
+            entry_barcodes.append(barcode)
+
+    bc_reads = b"".join(bc_reads)
+    other_reads = b"".join(other_reads) if paired else None
+    if barcode_mate == 2 and paired:
+        bc_reads, other_reads = other_reads, bc_reads
+    return ChunkResult(bc_reads, other_reads, b"".join(barcodes), b"".join(ry_barcodes),
+                       (entry_ids, entry_barcodes), skipped)
+
+
+def _process_block(block, pattern, kwargs):
+    return process_chunk(pattern, parse_fastq_block(block), **kwargs)
+
+
+def _process_paired_chunk(chunk, pattern, kwargs):
+    return process_chunk(pattern, chunk[0], chunk[1], **kwargs)
+
+
+def process_blocks(blocks, pattern, threads=1, **kwargs):
+    """Process blocks of raw single-end FASTQ data.
+
+    Yields the ChunkResult of process_chunk for each block in input order.
+    kwargs are passed on to process_chunk. With threads > 1 blocks are parsed
+    and processed by a pool of worker processes.
+    """
+    return map_ordered(_process_block, blocks, (pattern, kwargs), threads)
+
+
+def process_paired_chunks(chunks, pattern, threads=1, **kwargs):
+    """Process chunks of paired records.
+
+    chunks yields tuples (records1, records2) as read_paired_fastq_chunks.
+    Yields the ChunkResult of process_chunk for each chunk in input order.
+    """
+    return map_ordered(_process_paired_chunk, chunks, (pattern, kwargs), threads)
@@ -0,0 +1,312 @@
+"""
+Chunked FASTQ input and output shared by the bctools FASTQ tools.
+
+Records are handled as tuples of byte strings (header, seq, qual). The header
+does not include the leading '@'. FASTQ records are expected to span exactly
+four lines. FASTA records are handled as (header, seq) and may span several
+lines.
+
+Uncompressed files are memory-mapped and cut into blocks of complete records,
+so records are only copied once before parsing. FastqWriter assembles output
+records in large batches.
+"""
+
+from itertools import repeat
+from bctools_io import BatchedWriter, map_input, open_input, read_blocks
+
+# number of bytes read from the input per chunk
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def _record_boundary(data):
+    """Return the offset behind the last complete four-line record in data."""
+    n_lines = data.count(b"\n")
+    # walk back over the lines that do not complete a record
+    end = len(data)
+    for _ in range(n_lines % 4 + 1):
+        end = data.rfind(b"\n", 0, end)
+    return end + 1
+
+
+def _fasta_record_boundary(data):
+    """Return the offset of the last FASTA header in data."""
+    return data.rfind(b"\n>") + 1
+
+
+def read_fastq_blocks(handle, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Iterate over blocks of raw FASTQ data from a binary file handle.
+
+    Each block is a byte string of roughly chunk_size bytes that contains only
+    complete records, so blocks can be parsed independently of each other.
+    """
+    return read_blocks(handle, chunk_size, _record_boundary)
+
+
+def _read_mapped_blocks(mm, chunk_size, record_boundary, start=0, stop=None):
+    """Iterate over blocks of complete records of a memory-mapped file.
+
+    Only the records between byte offsets start and stop are read.
+    """
+    size = len(mm) if stop is None else stop
+    while start < size:
+        end = start + chunk_size
+        if end >= size:
+            # the last record may lack a trailing newline
+            data = mm[start:size]
+            if data.strip():
+                yield data
+            break
+        boundary = record_boundary(mm[start:end])
+        if boundary == 0:
+            # no complete record within the chunk, enlarge it
+            chunk_size *= 2
+            continue
+        yield mm[start:start + boundary]
+        start += boundary
+    mm.close()
+
+
+def read_fastq_file_blocks(filename, chunk_size=DEFAULT_CHUNK_SIZE, start=0, stop=None):
+    """Iterate over blocks of raw FASTQ data of a plain or compressed file.
+
+    Like read_fastq_blocks, but uncompressed files are memory-mapped. start and
+    stop restrict reading to the records between these byte offsets, which
+    have to be record boundaries of an uncompressed file.
+    """
+    if stop is not None and stop <= start:
+        return iter([])
+    mm = map_input(filename)
+    if mm is None:
+        if start != 0 or stop is not None:
+            raise ValueError("Reading a range of records requires an uncompressed file, '{}' is compressed or empty.".format(filename))
+        return read_blocks(open_input(filename), chunk_size, _record_boundary)
+    return _read_mapped_blocks(mm, chunk_size, _record_boundary, start, stop)
+
+
+def read_fasta_file_blocks(filename, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Iterate over blocks of complete raw FASTA records of a file."""
+    mm = map_input(filename)
+    if mm is None:
+        return read_blocks(open_input(filename), chunk_size, _fasta_record_boundary)
+    return _read_mapped_blocks(mm, chunk_size, _fasta_record_boundary)
+
+
+def parse_fasta_block(data):
+    """Parse a block of complete FASTA records into (header, seq) tuples.
+
+    Lines in front of the first header are ignored, sequence lines of a record
+    are joined.
+    """
+    records = []
+    header = None
+    seq = []
+    for line in data.split(b"\n"):
+        if line.startswith(b">"):
+            if header is not None:
+                records.append((header, b"".join(seq).replace(b" ", b"")))
+            header = line[1:].rstrip()
+            seq = []
+        elif header is not None:
+            seq.append(line.rstrip())
+    if header is not None:
+        records.append((header, b"".join(seq).replace(b" ", b"")))
+    return records
+
+
+def _check_records(lines):
+    """Raise a ValueError for the first malformed record of a list of lines."""
+    for i in range(0, len(lines), 4):
+        header = lines[i]
+        if not header.startswith(b"@"):
+            raise ValueError("Records in Fastq files should start with '@' character")
+        if not lines[i + 2].startswith(b"+"):
+            raise ValueError("Sequence and quality captions differ in record '{}'".format(
+                header[1:].decode("utf-8", "replace")))
+        if len(lines[i + 1]) != len(lines[i + 3]):
+            raise ValueError("Lengths of sequence and quality values differs for '{}'".format(
+                header[1:].decode("utf-8", "replace")))
+
+
+def parse_fastq_block(data):
+    """Parse a block of complete FASTQ records into (header, seq, qual) tuples."""
+    lines = data.split(b"\n")
+    if data.endswith(b"\n"):
+        lines.pop()
+    # ignore empty lines at the end of the file
+    while len(lines) % 4 != 0 and not lines[-1].strip():
+        lines.pop()
+    if len(lines) % 4 != 0:
+        raise ValueError("End of file without quality information.")
+    # remove trailing whitespace such as carriage returns
+    lines = list(map(bytes.rstrip, lines))
+    headers = lines[0::4]
+    seqs = lines[1::4]
+    quals = lines[3::4]
+    # check all records at once, locate errors only if necessary
+    valid = all(map(bytes.startswith, headers, repeat(b"@"))) and all(map(bytes.startswith, lines[2::4], repeat(b"+")))
+    if not valid or list(map(len, seqs)) != list(map(len, quals)):
+        _check_records(lines)
+    return list(zip([header[1:] for header in headers], seqs, quals))
+
+
+def read_fastq_chunks(handle, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Iterate over FASTQ records of a binary file handle in chunks.
+
+    Yields lists of (header, seq, qual) tuples. Each list covers roughly
+    chunk_size bytes of input.
+    """
+    for block in read_fastq_blocks(handle, chunk_size):
+        yield parse_fastq_block(block)
+
+
+def read_id(header):
+    """Return the read id of a FASTQ header without description and mate suffix."""
+    fields = header.split(None, 1)
+    rid = fields[0] if fields else header
+    if rid.endswith(b"/1") or rid.endswith(b"/2"):
+        rid = rid[:-2]
+    return rid
+
+
+def _read_ids(records):
+    """Return the read ids of a list of records, as read_id."""
+    ids = [(header.split(None, 1) or [header])[0] for header, _, _ in records]
+    return [rid[:-2] if rid[-2:] in (b"/1", b"/2") else rid for rid in ids]
+
+
+def read_paired_fastq_chunks(filename1, filename2, chunk_size=DEFAULT_CHUNK_SIZE, ranges=None):
+    """Iterate over the records of two mate FASTQ files in lockstep.
+
+    Yields tuples (records1, records2) of equally long record lists. Raises a
+    ValueError if the read ids of mates differ or if one of the files contains
+    more reads than the other. ranges optionally holds a (start, stop) tuple of
+    byte offsets per file as passed to read_fastq_file_blocks.
+    """
+    range1, range2 = ranges if ranges is not None else ((0, None), (0, None))
+    chunks1 = (parse_fastq_block(block) for block in read_fastq_file_blocks(filename1, chunk_size, *range1))
+    chunks2 = (parse_fastq_block(block) for block in read_fastq_file_blocks(filename2, chunk_size, *range2))
+    records1 = []
+    records2 = []
+    while True:
+        if not records1:
+            records1 = next(chunks1, [])
+        if not records2:
+            records2 = next(chunks2, [])
+        if not records1 or not records2:
+            break
+        n_pairs = min(len(records1), len(records2))
+        batch1, records1 = records1[:n_pairs], records1[n_pairs:]
+        batch2, records2 = records2[:n_pairs], records2[n_pairs:]
+        # compare the read ids of all pairs at once, locate errors only if necessary
+        if _read_ids(batch1) != _read_ids(batch2):
+            for (header1, _, _), (header2, _, _) in zip(batch1, batch2):
+                if read_id(header1) != read_id(header2):
+                    raise ValueError("Read ids of mates differ: '{}' and '{}'.".format(
+                        header1.decode("utf-8", "replace"), header2.decode("utf-8", "replace")))
+        yield batch1, batch2
+    if records1 or records2 or next(chunks1, None) or next(chunks2, None):
+        raise ValueError("Mate files contain different numbers of reads.")
+
+
+def remove_tail(seq, qual, length):
+    """Remove length nucleotides from the 3'-end of a read.
+
+    If removing the tail would lead to an empty sequence, the sequence is set
+    to a single N to keep paired fastq files synchronized.
+    """
+    if len(seq) <= length:
+        return b"N", b"B"
+    return seq[0:-length], qual[0:-length]
+
+
+def _complement_table():
+    table = bytearray(range(256))
+    for src, tgt in zip(bytearray(b"ACGTN"), bytearray(b"TGCAN")):
+        table[src] = tgt
+    return bytes(table)
+
+
+# translation table for use with bytes.translate
+COMPLEMENT_TABLE = _complement_table()
+# default length of the mate sequence used to detect readthroughs
+DEFAULT_SEED_LENGTH = 12
+
+
+def _reverse_complement(seq):
+    return seq[::-1].translate(COMPLEMENT_TABLE)
+
+
+def _find_short_insert(seq, mate, length, seed_length):
+    """Return the length of an insert shorter than seed_length followed by a readthrough, or None.
+
+    The read has to start with the reverse complement of the insert and the
+    barcode of the mate, at least seed_length nts in total.
+    """
+    barcode = _reverse_complement(mate[:length])
+    pos = seq.find(barcode, max(seed_length - length, 1)) if length else -1
+    while 0 <= pos < seed_length:
+        if seq[:pos] == _reverse_complement(mate[length:length + pos]):
+            return pos
+        pos = seq.find(barcode, pos + 1)
+    return None
+
+
+def find_readthroughs(seqs, mate_seqs, length, seed_length=DEFAULT_SEED_LENGTH):
+    """Locate readthroughs into the barcode of the mate.
+
+    The barcode occupies the first length nts of the mate reads. If the
+    fragment is shorter than the read, the read continues from the insert into
+    the reverse complement of the barcode. The seed_length nts of the mate next
+    to the barcode are reverse complemented and searched in the read; a
+    readthrough is present if sequence follows the seed. Reads without seed
+    are checked for inserts shorter than the seed (see _find_short_insert).
+    Seeds have to match exactly.
+
+    Returns a list of tuples (index, number of nts to keep) of the reads with
+    readthrough.
+    """
+    # reverse complement the seeds of all mates at once
+    seeds = _reverse_complement(b"".join([mate[length:length + seed_length].ljust(seed_length, b"\0")
+                                          for mate in mate_seqs]))
+    # seeds are stored in reverse order
+    ends = range(len(seeds), 0, -seed_length)
+    readthroughs = []
+    for i, seq, end in zip(range(len(seqs)), seqs, ends):
+        pos = seq.rfind(seeds[end - seed_length:end])
+        if pos >= 0 and pos + seed_length < len(seq):
+            readthroughs.append((i, pos + seed_length))
+        elif pos < 0:
+            insert_length = _find_short_insert(seq, mate_seqs[i], length, seed_length)
+            if insert_length is not None:
+                readthroughs.append((i, insert_length))
+    return readthroughs
+
+
+def format_fastq(header, seq, qual):
+    """Format a single FASTQ record as bytes."""
+    return b"@" + header + b"\n" + seq + b"\n+\n" + qual + b"\n"
+
+
+def format_fasta(header, seq, wrap=None):
+    """Format a single FASTA record as bytes.
+
+    If wrap is set, the sequence is split into lines of wrap nts.
+    """
+    if wrap is None:
+        return b">" + header + b"\n" + seq + b"\n"
+    return b">" + header + b"\n" + b"".join([seq[i:i + wrap] + b"\n" for i in range(0, len(seq), wrap)])
+
+
+class FastqWriter(BatchedWriter):
+    """Batched writer of FASTQ and FASTA records."""
+
+    def write_fastq(self, header, seq, qual):
+        self.write(b"@%s\n%s\n+\n%s\n" % (header, seq, qual))
+
+    def write_fastq_records(self, records):
+        """Write a list of (header, seq, qual) records."""
+        self.write(b"".join([b"@%s\n%s\n+\n%s\n" % record for record in records]))
+
+    def write_fasta(self, header, seq, wrap=None):
+        """Write a FASTA record, split the sequence into lines of wrap nts if set."""
+        self.write(format_fasta(header, seq, wrap))
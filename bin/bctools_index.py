@@ -0,0 +1,117 @@
+"""
+Byte offset indices of FASTQ files for processing files in shards.
+
+An index lists the byte offsets of every interval-th record of an
+uncompressed FASTQ file. It is stored next to the FASTQ file with suffix
+INDEX_SUFFIX as two tab-separated columns, record number and byte offset. The
+last line holds the total number of records and the file size.
+
+A shard i/N covers a contiguous range of index intervals, so the outputs of
+shards 1/N to N/N concatenated in order equal the output of a single job.
+"""
+
+import logging
+import os
+import numpy as np
+from bctools_fastq import DEFAULT_CHUNK_SIZE, read_fastq_file_blocks
+from bctools_io import map_input
+
+INDEX_SUFFIX = ".fqi"
+# number of records between indexed offsets
+DEFAULT_INTERVAL = 100000
+
+
+def build_index(filename, interval=DEFAULT_INTERVAL, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Return the index of a FASTQ file as list of (record, offset) tuples."""
+    if interval < 1:
+        raise ValueError("Index interval must be a positive integer, is '{}'.".format(interval))
+    mm = map_input(filename)
+    if mm is None:
+        if os.path.isfile(filename) and os.path.getsize(filename) == 0:
+            return [(0, 0)]
+        raise ValueError("Indexing requires an uncompressed FASTQ file, '{}' is compressed.".format(filename))
+    mm.close()
+
+    index = []
+    n_records = 0
+    offset = 0
+    for block in read_fastq_file_blocks(filename, chunk_size):
+        newlines = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord("\n"))
+        # start offsets of the records of this block
+        starts = np.concatenate([[0], newlines[3::4] + 1])
+        n_block = len(newlines) // 4
+        # the last record of a file may lack a trailing newline
+        if len(newlines) % 4 == 3 and block[newlines[-1] + 1:].strip():
+            n_block += 1
+        records = np.arange(n_records, n_records + n_block)
+        indexed = np.flatnonzero(records % interval == 0)
+        index.extend(zip(records[indexed].tolist(), (starts[indexed] + offset).tolist()))
+        n_records += n_block
+        offset += len(block)
+    index.append((n_records, os.path.getsize(filename)))
+    return index
+
+
+def write_index(index, filename):
+    with open(filename, "w") as out:
+        for record, offset in index:
+            out.write("{}\t{}\n".format(record, offset))
+
+
+def read_index(filename):
+    with open(filename) as fh:
+        return [tuple(int(field) for field in line.split("\t")) for line in fh if line.strip()]
+
+
+def load_index(filename):
+    """Return the index of a FASTQ file.
+
+    The index file next to the FASTQ file is used if present, otherwise the
+    index is built in memory.
+    """
+    index_fn = filename + INDEX_SUFFIX
+    if not os.path.exists(index_fn):
+        return build_index(filename)
+    index = read_index(index_fn)
+    if index[-1][1] != os.path.getsize(filename):
+        raise ValueError("Index '{}' does not match the size of '{}', please rebuild the index.".format(
+            index_fn, filename))
+    return index
+
+
+def parse_shard(shard):
+    """Parse a shard specification i/N into a tuple (i, N), i counting from 1."""
+    try:
+        i, n = (int(field) for field in shard.split("/"))
+    except ValueError:
+        raise ValueError("Shard must be given as i/N, is '{}'.".format(shard))
+    if n < 1 or not 1 <= i <= n:
+        raise ValueError("Shard i/N requires 1 <= i <= N, is '{}'.".format(shard))
+    return i, n
+
+
+def shard_range(index, i, n):
+    """Return (first record, start offset, stop offset) of shard i of n."""
+    n_intervals = len(index) - 1
+    first = (i - 1) * n_intervals // n
+    last = i * n_intervals // n
+    return index[first][0], index[first][1], index[last][1]
+
+
+def shard_offsets(filenames, shard):
+    """Return (start, stop) byte offsets of shard i/N for each of filenames.
+
+    Several files, such as the mates of paired-end data, are split at the same
+    records and require indices of identical record numbers.
+    """
+    i, n = parse_shard(shard)
+    for filename in filenames:
+        if n > 1 and not os.path.exists(filename + INDEX_SUFFIX):
+            logging.warning("WARNING: no index '{}' found, every shard reads the whole file '{}' to build it. "
+                            "Create the index once with index_fastq.py before processing shards.".format(
+                                filename + INDEX_SUFFIX, filename))
+    indices = [load_index(filename) for filename in filenames]
+    records = [[record for record, _ in index] for index in indices]
+    if any(rec != records[0] for rec in records[1:]):
+        raise ValueError("Indices of '{}' differ in the indexed records.".format("', '".join(filenames)))
+    return [shard_range(index, i, n)[1:] for index in indices]
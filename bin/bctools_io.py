@@ -0,0 +1,293 @@
+"""
+Transparent handling of compressed input and output files.
+
+Input compression is detected from the leading magic bytes, so gzip, bgzf and
+zstd compressed files are read without further configuration. Output can be
+written gzip, bgzf or zstd compressed. Blocks of output are compressed in
+parallel by a pool of threads.
+
+Uncompressed input files can be memory-mapped. Input is read in blocks of
+complete records (read_blocks), which map_ordered hands to a pool of worker
+processes, yielding the results in input order. Output is collected in large
+batches before it is handed to the (compressing) file handle.
+
+zstd support requires the zstandard package.
+"""
+
+import gzip
+import io
+import mmap
+import os
+import struct
+import zlib
+from collections import deque
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from sys import stdout
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSION_FORMATS = ["gzip", "bgzf", "zstd"]
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+# number of bytes collected by BatchedWriter before writing
+BATCH_SIZE = 4 * 1024 * 1024
+# number of uncompressed bytes handed to a compression thread at once
+COMPRESS_BLOCK_SIZE = 1024 * 1024
+# maximum number of uncompressed bytes per bgzf block, as used by bgzip
+BGZF_BLOCK_SIZE = 0xff00
+# empty bgzf block marking the end of file
+BGZF_EOF = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+
+
+def _require_zstandard():
+    if zstandard is None:
+        raise ImportError("zstd compression requires the python package 'zstandard'.")
+
+
+def detect_compression(filename):
+    """Return "gzip", "zstd" or None depending on the magic bytes of filename.
+
+    bgzf files are gzip files and reported as "gzip".
+    """
+    with open(filename, "rb") as fh:
+        magic = fh.read(4)
+    if magic.startswith(GZIP_MAGIC):
+        return "gzip"
+    if magic == ZSTD_MAGIC:
+        return "zstd"
+    return None
+
+
+def open_input(filename):
+    """Open plain or compressed filename for binary reading."""
+    compression = detect_compression(filename)
+    if compression == "gzip":
+        return gzip.open(filename, "rb")
+    if compression == "zstd":
+        _require_zstandard()
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(filename, "rb")))
+    return open(filename, "rb")
+
+
+def map_input(filename):
+    """Memory-map an uncompressed regular file for reading.
+
+    Returns None for compressed, empty or non-regular files, which have to be
+    read via open_input.
+    """
+    if not os.path.isfile(filename) or os.path.getsize(filename) == 0:
+        return None
+    if detect_compression(filename) is not None:
+        return None
+    with open(filename, "rb") as fh:
+        return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def read_blocks(handle, chunk_size, record_boundary):
+    """Iterate over blocks of complete records read from a binary file handle.
+
+    Each block holds roughly chunk_size bytes. record_boundary(data) returns
+    the offset behind the last complete record in data, the remainder is
+    prepended to the next block.
+    """
+    leftover = b""
+    while True:
+        data = handle.read(chunk_size)
+        if not data:
+            break
+        if leftover:
+            data = leftover + data
+        boundary = record_boundary(data)
+        leftover = data[boundary:]
+        if boundary:
+            yield data[:boundary]
+    # the last record may lack a trailing newline
+    if leftover.strip():
+        yield leftover
+
+
+# function and arguments used by worker processes
+_worker_args = None
+
+
+def _init_worker(func, args, initializer=None):
+    global _worker_args
+    if initializer is not None:
+        args = initializer(*args)
+    _worker_args = (func, args)
+
+
+def _run_job(job):
+    func, args = _worker_args
+    return func(job, *args)
+
+
+def map_ordered(func, jobs, args, threads, initializer=None):
+    """Yield func(job, *args) for all jobs in input order.
+
+    With threads > 1 jobs are processed by a pool of worker processes. At most
+    two jobs per worker are held in memory at any time. With initializer,
+    args are replaced by initializer(*args) once per process, e.g. to open
+    files in each worker instead of passing open files to the workers.
+    """
+    if threads <= 1:
+        if initializer is not None:
+            args = initializer(*args)
+        for job in jobs:
+            yield func(job, *args)
+        return
+
+    pool = Pool(threads, _init_worker, (func, args, initializer))
+    try:
+        pending = deque()
+        for job in jobs:
+            pending.append(pool.apply_async(_run_job, (job,)))
+            if len(pending) >= 2 * threads:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _compress_gzip(data, level):
+    """Compress data into a complete gzip member."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _compress_bgzf(data, level):
+    """Compress data into a series of bgzf blocks."""
+    blocks = []
+    for start in range(0, len(data), BGZF_BLOCK_SIZE):
+        chunk = data[start:start + BGZF_BLOCK_SIZE]
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        deflated = compressor.compress(chunk) + compressor.flush()
+        # header with BC extra field holding the total block size - 1
+        blocks.append(struct.pack("<4BI2BH2BHH", 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6,
+                                  ord("B"), ord("C"), 2, len(deflated) + 25))
+        blocks.append(deflated)
+        blocks.append(struct.pack("<2I", zlib.crc32(chunk) & 0xffffffff, len(chunk)))
+    return b"".join(blocks)
+
+
+class ParallelCompressWriter(io.RawIOBase):
+    """Binary writer compressing blocks of output in a pool of threads.
+
+    Compressed blocks are written in the order of the uncompressed data.
+    Supported formats are "gzip" (concatenated gzip members) and "bgzf".
+    """
+
+    def __init__(self, fh, compress="gzip", threads=1, level=6):
+        io.RawIOBase.__init__(self)
+        self._fh = fh
+        self._compress = _compress_bgzf if compress == "bgzf" else _compress_gzip
+        self._bgzf = compress == "bgzf"
+        self._level = level
+        self._threads = max(threads, 1)
+        self._pool = ThreadPool(self._threads)
+        self._pending = deque()
+        self._buffer = []
+        self._buffered = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer.append(bytes(data))
+        self._buffered += len(data)
+        if self._buffered >= COMPRESS_BLOCK_SIZE:
+            self._submit()
+        return len(data)
+
+    def _submit(self):
+        data = b"".join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        if data:
+            self._pending.append(self._pool.apply_async(self._compress, (data, self._level)))
+        # limit the number of compressed blocks held in memory
+        while len(self._pending) > 2 * self._threads:
+            self._fh.write(self._pending.popleft().get())
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self._submit()
+            while self._pending:
+                self._fh.write(self._pending.popleft().get())
+            if self._bgzf:
+                self._fh.write(BGZF_EOF)
+            self._fh.close()
+        finally:
+            self._pool.terminate()
+            io.RawIOBase.close(self)
+
+
+def open_output(filename=None, compress=None, threads=1):
+    """Open filename for binary writing, use stdout if filename is None.
+
+    compress selects one of COMPRESSION_FORMATS, None writes uncompressed
+    output. threads sets the number of compression threads.
+    """
+    if filename is None:
+        # python 3 provides the binary stream as buffer
+        fh = getattr(stdout, "buffer", stdout)
+    else:
+        fh = open(filename, "wb")
+    if compress is None:
+        return fh
+    if compress == "zstd":
+        _require_zstandard()
+        # zstandard spawns its own compression threads, 0 disables them
+        zstd_threads = threads if threads > 1 else 0
+        return zstandard.ZstdCompressor(threads=zstd_threads).stream_writer(fh)
+    if compress in ("gzip", "bgzf"):
+        return ParallelCompressWriter(fh, compress, threads)
+    raise ValueError("Unknown compression format '{}'.".format(compress))
+
+
+class BatchedWriter(object):
+    """Collect output in memory and write it in large batches.
+
+    Wraps a binary file handle as returned by open_output. Data is written
+    once at least batch_size bytes are collected and when the writer is
+    flushed or closed.
+    """
+
+    def __init__(self, fh, batch_size=BATCH_SIZE):
+        self._fh = fh
+        self._batch_size = batch_size
+        self._buffer = []
+        self._buffered = 0
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self._batch_size:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            self._fh.write(b"".join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+
+    def close(self):
+        self.flush()
+        self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
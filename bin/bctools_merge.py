@@ -0,0 +1,630 @@
+"""
+Merging of PCR duplicates by outer alignment coordinates and barcode.
+
+Barcodes are looked up by read id in a barcode library held in memory, either
+a fastq library loaded into a dictionary or a memory-mapped binary library.
+Barcodes are stored as packed integer keys (see bctools_codec), nucleotide
+barcodes that can not be packed but contain no N are kept as byte strings.
+Barcodes containing N are dropped.
+
+Duplicates are counted in a dictionary keyed by barcode, chromosome, start,
+stop and strand. The representative read id of an event is the smallest read
+id of its alignments. Events are written sorted by barcode, chromosome,
+start, stop and strand, comparing fields as byte strings, which is the output
+order of the awk/sort/join/datamash pipeline.
+
+If the table of events exceeds a memory limit, sorted runs of events are
+spilled to compressed temporary files and merged (see
+ExternalDuplicateCounter). The memory of the table is estimated from the
+sizes of the events counted.
+Alignments sorted by coordinates are merged one position at a time (see
+merge_presorted). Merging can be distributed to worker processes by
+partitioning alignments by chrom and strand (see merge_duplicates_parallel).
+Optionally, barcodes of a position that differ by sequencing errors are
+merged (see cluster_events). Spurious events can be removed from the merged
+events as by rm_spurious_events.py (see bctools_spurious).
+
+Paired-end alignments in SAM or BAM format can be merged directly, taking
+barcodes from a SAM tag or a read name suffix (see read_bam_batches). This
+requires the pysam package.
+"""
+
+import gzip
+import heapq
+import logging
+import os
+import sys
+import zlib
+from itertools import groupby, islice
+from operator import itemgetter
+from shutil import rmtree
+from tempfile import mkdtemp
+from bctools_bclib import BarcodeLibrary, is_binary_library
+from bctools_codec import NT_SPACE
+from bctools_fastq import read_fastq_file_blocks, parse_fastq_block
+from bctools_io import map_ordered
+from bctools_spurious import sort_events, filter_sorted
+from bctools_umi import directional_clusters
+
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
+# number of alignments processed at once
+BATCH_SIZE = 100000
+# initial estimate of the memory used per counted event in bytes
+EVENT_SIZE = 400
+# number of events sampled per chunk of alignments to estimate their size
+EVENT_SAMPLE_SIZE = 32
+# minimum number of alignments counted between checks of the memory limit
+MIN_CHUNK_SIZE = 100
+# number of partitions of alignments per worker process
+PARTITIONS_PER_THREAD = 4
+
+
+def pack_barcodes(codec, barcodes):
+    """Return the keys of a list of barcodes, None for barcodes to drop.
+
+    Nucleotide barcodes of other characters than A, C, G and T are kept as
+    byte strings unless they contain N.
+    """
+    keys = codec.pack_batch(barcodes)
+    if codec.space != NT_SPACE:
+        return keys
+    return [key if key is not None or b"N" in bc else bc for key, bc in zip(keys, barcodes)]
+
+
+class BarcodeKeys(object):
+    """Packed barcodes of a fastq or binary barcode library by read id."""
+
+    def __init__(self, filename, codec):
+        self.codec = codec
+        self._library = None
+        self._keys = None
+        if is_binary_library(filename):
+            self._library = BarcodeLibrary(filename)
+        else:
+            self._keys = {}
+            for block in read_fastq_file_blocks(filename):
+                records = parse_fastq_block(block)
+                read_ids = [(header.split(None, 1) or [header])[0] for header, _, _ in records]
+                self._keys.update(zip(read_ids, pack_barcodes(codec, [seq for _, seq, _ in records])))
+
+    def lookup(self, read_ids, metrics=None):
+        """Return the barcode keys of a list of read ids, None for missing ids and dropped barcodes.
+
+        Missing and dropped barcodes are counted in metrics, a MergeMetrics.
+        """
+        if self._library is not None:
+            return _pack_present(self.codec, self._library.lookup(read_ids), metrics)
+        keys = [self._keys.get(rid) for rid in read_ids]
+        if metrics is not None:
+            n_missing = sum(1 for rid in read_ids if rid not in self._keys)
+            metrics.add_lookup(len(keys), n_missing, keys.count(None) - n_missing)
+        return keys
+
+    def close(self):
+        if self._library is not None:
+            self._library.close()
+        self._keys = None
+
+
+def read_alignment_batches(filename, batch_size=BATCH_SIZE):
+    """Yield lists of (read id, chrom, start, stop, strand) of a bed6 file.
+
+    The read id is the first word of the name field.
+    """
+    with open(filename, "rb") as alns:
+        while True:
+            batch = []
+            for line in islice(alns, batch_size):
+                fields = line.rstrip(b"\n").split(b"\t")
+                name = fields[3].split(None, 1) if len(fields) > 3 else None
+                if not name:
+                    raise ValueError("Alignment without read id in file '{}': '{}'.".format(
+                        filename, line.rstrip().decode()))
+                batch.append((name[0], fields[0], fields[1], fields[2], fields[5] if len(fields) > 5 else b""))
+            if not batch:
+                break
+            yield batch
+
+
+def library_batches(alignments_fn, library, metrics=None, batch_size=BATCH_SIZE):
+    """Yield tuples (alignments, keys) of batches of a bed6 file and their keys in a BarcodeKeys library."""
+    for alignments in read_alignment_batches(alignments_fn, batch_size):
+        yield alignments, library.lookup([aln[0] for aln in alignments], metrics)
+
+
+def _require_pysam():
+    if pysam is None:
+        raise ImportError("Reading SAM and BAM files requires the python package 'pysam'.")
+
+
+def _barcode_from_tag(read, tag):
+    return read.get_tag(tag).encode() if read.has_tag(tag) else None
+
+
+def read_bam_batches(filename, codec, barcode_tag=None, barcode_separator=None, metrics=None, batch_size=BATCH_SIZE):
+    """Yield tuples (alignments, keys) of the read pairs of a SAM or BAM file.
+
+    Alignments are given as read_alignment_batches with the outer coordinates
+    of the fragment and the strand of the first mate, as determined by
+    extract_aln_ends.py. Only primary alignments of pairs mapped to the same
+    reference in opposite directions are used. Mates are paired by read name,
+    so the file may be sorted by coordinates or by read name.
+
+    The barcode is taken from SAM tag barcode_tag of either mate, or from the
+    read name following the last barcode_separator. The read id is then the
+    read name up to the separator. Missing and dropped barcodes are counted
+    in metrics, a MergeMetrics.
+    """
+    _require_pysam()
+    if (barcode_tag is None) == (barcode_separator is None):
+        raise ValueError("Exactly one of barcode tag and barcode separator is required.")
+    separator = barcode_separator.encode() if barcode_separator is not None else None
+    pending = {}
+    n_skipped = 0
+    with pysam.AlignmentFile(filename, "r") as alns:
+        chroms = [name.encode() for name in alns.references]
+        alignments = []
+        barcodes = []
+        for read in alns:
+            if read.is_unmapped or not read.is_paired or read.mate_is_unmapped or read.is_secondary or read.is_supplementary:
+                continue
+            name = read.query_name
+            barcode = _barcode_from_tag(read, barcode_tag) if barcode_tag is not None else None
+            mate = pending.pop(name, None)
+            if mate is None:
+                pending[name] = (read.is_read1, read.reference_id, read.reference_start, read.reference_end,
+                                 read.is_reverse, barcode)
+                continue
+            mate_is_read1, mate_ref, mate_start, mate_end, mate_reverse, mate_barcode = mate
+            if mate_ref != read.reference_id or mate_reverse == read.is_reverse or mate_is_read1 == read.is_read1:
+                n_skipped += 1
+                continue
+            if read.is_read1:
+                first = (read.is_reverse, read.reference_start, read.reference_end)
+                second = (mate_start, mate_end)
+            else:
+                first = (mate_reverse, mate_start, mate_end)
+                second = (read.reference_start, read.reference_end)
+            if first[0]:
+                start, stop, strand = second[0], first[2], b"-"
+            else:
+                start, stop, strand = first[1], second[1], b"+"
+            rid = name.encode()
+            if separator is not None:
+                rid, _, barcode = rid.rpartition(separator)
+                if not rid:
+                    rid, barcode = barcode, None
+            elif barcode is None:
+                barcode = mate_barcode
+            alignments.append((rid, chroms[read.reference_id], b"%d" % start, b"%d" % stop, strand))
+            barcodes.append(barcode)
+            if len(alignments) >= batch_size:
+                yield alignments, _pack_present(codec, barcodes, metrics)
+                alignments = []
+                barcodes = []
+        if alignments:
+            yield alignments, _pack_present(codec, barcodes, metrics)
+    if pending or n_skipped:
+        logging.warning("skipped {} read pairs that are not mapped in forward-reverse direction and {} reads without mapped mate".format(
+            n_skipped, len(pending)))
+
+
+def _pack_present(codec, barcodes, metrics=None):
+    packed = iter(pack_barcodes(codec, [bc for bc in barcodes if bc is not None]))
+    keys = [next(packed) if bc is not None else None for bc in barcodes]
+    if metrics is not None:
+        n_missing = barcodes.count(None)
+        metrics.add_lookup(len(keys), n_missing, keys.count(None) - n_missing)
+    return keys
+
+
+class DuplicateCounter(object):
+    """Count alignments per barcode, chrom, start, stop and strand."""
+
+    def __init__(self):
+        self.events = {}
+
+    def add(self, alignments, keys):
+        """Add a list of alignments as yielded by read_alignment_batches and their barcode keys."""
+        events = self.events
+        for (rid, chrom, start, stop, strand), key in zip(alignments, keys):
+            if key is None:
+                continue
+            event = (key, chrom, start, stop, strand)
+            counts = events.get(event)
+            if counts is None:
+                events[event] = [1, rid]
+            else:
+                counts[0] += 1
+                if rid < counts[1]:
+                    counts[1] = rid
+
+
+def cluster_events(events, codec, mismatches):
+    """Merge events of barcodes within mismatches at the same position.
+
+    Barcodes of each chrom, start, stop and strand are clustered by the
+    directional method (see bctools_umi). The events of a cluster are merged
+    into a single event of the representative barcode, adding up counts and
+    keeping the smallest read id. Returns a new dictionary of events.
+    """
+    positions = {}
+    clustered = {}
+    for event, counts in events.items():
+        if isinstance(event[0], bytes):
+            # barcodes that are not packed are only merged if identical
+            clustered[event] = counts
+        else:
+            positions.setdefault(event[1:], {})[event[0]] = counts
+    for position, barcodes in positions.items():
+        if len(barcodes) == 1:
+            for key, counts in barcodes.items():
+                clustered[(key,) + position] = counts
+            continue
+        counts = dict((key, count) for key, (count, _) in barcodes.items())
+        for cluster in directional_clusters(counts, codec.bits, mismatches):
+            clustered[(cluster[0],) + position] = [sum(counts[key] for key in cluster),
+                                                   min(barcodes[key][1] for key in cluster)]
+    return clustered
+
+
+def barcode_sort_key(codec):
+    """Return a function mapping barcode keys to the byte strings events are sorted by.
+
+    Nucleotide barcodes sort as barcodes, RY-space barcodes as keys in
+    fixed-width hexadecimal notation.
+    """
+    if codec.space == NT_SPACE:
+        def sort_key(key):
+            return key if isinstance(key, bytes) else codec.unpack(key)
+    else:
+        key_width = -(-(codec.max_length * codec.bits + 1) // 4)
+
+        def sort_key(key):
+            return b"%0*x" % (key_width, key)
+    return sort_key
+
+
+def sorted_events(events, codec):
+    """Return a list of (barcode, chrom, start, stop, strand, count, read id) in output order.
+
+    The barcode is given as byte string used for sorting, see barcode_sort_key.
+    """
+    sort_key = barcode_sort_key(codec)
+    merged = [(sort_key(key), chrom, start, stop, strand, count, rid)
+              for (key, chrom, start, stop, strand), (count, rid) in events.items()]
+    merged.sort(key=lambda event: event[:5])
+    return merged
+
+
+def format_events(events):
+    """Format events as yielded by sorted_events as bed6 lines."""
+    return b"".join([b"%s\t%s\t%s\t%s\t%d\t%s\n" % (chrom, start, stop, rid, count, strand)
+                     for _, chrom, start, stop, strand, count, rid in events])
+
+
+def _event_size(event, counts):
+    """Return the memory used by an event key and its counts in bytes, excluding the dictionary."""
+    fields_size = sum(sys.getsizeof(field) for field in event)
+    return sys.getsizeof(event) + fields_size + sys.getsizeof(counts) + sys.getsizeof(counts[1])
+
+
+class ExternalDuplicateCounter(DuplicateCounter):
+    """Count alignments using at most about max_memory bytes for events.
+
+    When the events exceed max_memory they are sorted and spilled as a run to
+    a gzip compressed file in tmpdir. Runs are merged with a k-way merge that
+    adds up the counts of events found in several runs.
+
+    The memory of the events is the size of the dictionary plus the number of
+    events times the mean size of an event, which is measured on a sample of
+    the events of each chunk of alignments. Alignments are added in chunks
+    fitting into the remaining memory, so runs are spilled close to the limit.
+    """
+
+    def __init__(self, codec, max_memory, tmpdir=None):
+        super(ExternalDuplicateCounter, self).__init__()
+        self.codec = codec
+        self.max_memory = max_memory
+        self.event_size = EVENT_SIZE
+        self._sampled_size = 0
+        self._sampled = 0
+        self.tmpdir = mkdtemp(prefix="merge_runs_", dir=tmpdir)
+        self.runs = []
+
+    def memory(self):
+        """Return the estimated memory used by the events in bytes."""
+        return sys.getsizeof(self.events) + len(self.events) * self.event_size
+
+    def _sample_event_size(self, alignments, keys):
+        step = max(1, len(alignments) // EVENT_SAMPLE_SIZE)
+        for (_, chrom, start, stop, strand), key in zip(alignments[::step], keys[::step]):
+            if key is None:
+                continue
+            event = (key, chrom, start, stop, strand)
+            self._sampled_size += _event_size(event, self.events[event])
+            self._sampled += 1
+        if self._sampled:
+            self.event_size = self._sampled_size // self._sampled
+
+    def add(self, alignments, keys):
+        begin = 0
+        while begin < len(alignments):
+            # add about as many alignments as new events fit into the remaining memory
+            chunk_size = max(MIN_CHUNK_SIZE, (self.max_memory - self.memory()) // self.event_size)
+            chunk, chunk_keys = alignments[begin:begin + chunk_size], keys[begin:begin + chunk_size]
+            super(ExternalDuplicateCounter, self).add(chunk, chunk_keys)
+            self._sample_event_size(chunk, chunk_keys)
+            if self.memory() > self.max_memory:
+                self._spill()
+            begin += chunk_size
+
+    def _spill(self):
+        run_fn = os.path.join(self.tmpdir, "run{}.gz".format(len(self.runs)))
+        n_events = len(self.events)
+        memory = self.memory()
+        write_run(sorted_events(self.events, self.codec), run_fn)
+        self.runs.append(run_fn)
+        self.events = {}
+        logging.debug("spilled {} events using about {} bytes to run {}".format(n_events, memory, run_fn))
+
+    def sorted_events(self):
+        """Yield the events of all runs as sorted_events, merging events of equal keys."""
+        if not self.runs:
+            for event in sorted_events(self.events, self.codec):
+                yield event
+            return
+        if self.events:
+            self._spill()
+        logging.info("merging {} runs".format(len(self.runs)))
+        for event in merge_runs(self.runs):
+            yield event
+
+    def close(self):
+        rmtree(self.tmpdir)
+
+
+def write_run(events, run_fn):
+    """Write events as returned by sorted_events to a gzip compressed run file."""
+    events = iter(events)
+    with gzip.open(run_fn, "wb", compresslevel=1) as run:
+        while True:
+            batch = list(islice(events, BATCH_SIZE))
+            if not batch:
+                break
+            run.write(b"".join([b"%s\t%s\t%s\t%s\t%s\t%d\t%s\n" % event for event in batch]))
+
+
+def _read_run(run_fn):
+    with gzip.open(run_fn, "rb") as run:
+        for line in run:
+            yield line.rstrip(b"\n").split(b"\t")
+
+
+def merge_runs(run_fns):
+    """Yield the events of sorted run files as sorted_events, merging events of equal keys."""
+    runs = [_read_run(run_fn) for run_fn in run_fns]
+    for key, events in groupby(heapq.merge(*runs), key=itemgetter(slice(0, 5))):
+        count = 0
+        rid = None
+        for event in events:
+            count += int(event[5])
+            rid = event[6] if rid is None or event[6] < rid else rid
+        yield tuple(key) + (count, rid)
+
+
+def parse_memory(size):
+    """Parse a memory size such as 500M or 2G into bytes.
+
+    Suffixes K, M and G denote powers of 1024, numbers without suffix bytes.
+    """
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    try:
+        if size[-1:].upper() in units:
+            return int(float(size[:-1]) * units[size[-1:].upper()])
+        return int(size)
+    except ValueError:
+        raise ValueError("Memory size must be a number of bytes optionally followed by K, M or G, is '{}'.".format(size))
+
+
+def filter_spurious(events, threshold):
+    """Return bed6 lines of events as returned by sorted_events without spurious events.
+
+    Lines are in the output order of rm_spurious_events.py, so the result is
+    identical to filtering the formatted events with rm_spurious_events.py.
+    """
+    spurious = [(chrom, int(start), int(stop), rid, count, strand,
+                 b"%s\t%s\t%s\t%s\t%d\t%s\n" % (chrom, start, stop, rid, count, strand))
+                for _, chrom, start, stop, strand, count, rid in events]
+    sort_events(spurious)
+    return [event[6] for event in filter_sorted(spurious, threshold)]
+
+
+def _new_counter(codec, max_memory, tmpdir, mismatches):
+    if mismatches and max_memory is not None:
+        raise ValueError("Clustering barcodes with mismatches can not be combined with a memory limit.")
+    if max_memory is None:
+        return DuplicateCounter()
+    return ExternalDuplicateCounter(codec, max_memory, tmpdir)
+
+
+def _merged_events(batches, codec, counter, mismatches):
+    """Count batches of alignments and keys and return an iterator over the sorted events."""
+    for alignments, keys in batches:
+        counter.add(alignments, keys)
+    if mismatches:
+        counter.events = cluster_events(counter.events, codec, mismatches)
+    if isinstance(counter, ExternalDuplicateCounter):
+        return counter.sorted_events()
+    return iter(sorted_events(counter.events, codec))
+
+
+def _write_events(events, out, batch_size=BATCH_SIZE, spurious_threshold=None, metrics=None):
+    """Write events as bed6 lines, counting them in metrics before removing spurious events."""
+    if spurious_threshold is not None:
+        events = list(events)
+        if metrics is not None:
+            metrics.add_events(events)
+        out.write(b"".join(filter_spurious(events, spurious_threshold)))
+        return
+    while True:
+        batch = list(islice(events, batch_size))
+        if not batch:
+            break
+        if metrics is not None:
+            metrics.add_events(batch)
+        out.write(format_events(batch))
+
+
+def merge_duplicates(batches, codec, out, max_memory=None, tmpdir=None, mismatches=0, metrics=None, spurious_threshold=None,
+                     batch_size=BATCH_SIZE):
+    """Merge PCR duplicates of batches of alignments and barcode keys.
+
+    batches yields tuples (alignments, keys) as library_batches or
+    read_bam_batches. Writes merged events in bed6 format to the binary file
+    handle out. With max_memory, events are counted by an
+    ExternalDuplicateCounter spilling runs to tmpdir. With mismatches,
+    barcodes within mismatches are merged by cluster_events. Merged events
+    are counted in metrics, a MergeMetrics. With spurious_threshold, spurious
+    events are removed by filter_spurious after counting.
+    """
+    counter = _new_counter(codec, max_memory, tmpdir, mismatches)
+    try:
+        events = _merged_events(batches, codec, counter, mismatches)
+        _write_events(events, out, batch_size, spurious_threshold, metrics)
+    finally:
+        if max_memory is not None:
+            counter.close()
+
+
+def partition_alignments(alignments_fn, partition_fns):
+    """Distribute the alignments of a bed6 file to partition files by chrom and strand."""
+    partitions = [open(fn, "wb") for fn in partition_fns]
+    try:
+        with open(alignments_fn, "rb") as alns:
+            while True:
+                lines = list(islice(alns, BATCH_SIZE))
+                if not lines:
+                    break
+                buffers = [[] for _ in partitions]
+                for line in lines:
+                    fields = line.rstrip(b"\n").split(b"\t")
+                    location = fields[0] + b"\t" + (fields[5] if len(fields) > 5 else b"")
+                    buffers[zlib.crc32(location) % len(partitions)].append(line if line.endswith(b"\n") else line + b"\n")
+                for partition, buf in zip(partitions, buffers):
+                    partition.write(b"".join(buf))
+    finally:
+        for partition in partitions:
+            partition.close()
+
+
+def _open_partition_library(library_fn, codec, *args):
+    return (BarcodeKeys(library_fn, codec),) + args
+
+
+def _merge_partition(partition_fn, library, max_memory, tmpdir, mismatches, metrics_type):
+    metrics = metrics_type() if metrics_type is not None else None
+    counter = _new_counter(library.codec, max_memory, tmpdir, mismatches)
+    try:
+        run_fn = partition_fn + ".run.gz"
+        batches = library_batches(partition_fn, library, metrics)
+        write_run(_merged_events(batches, library.codec, counter, mismatches), run_fn)
+    finally:
+        if max_memory is not None:
+            counter.close()
+    return run_fn, metrics
+
+
+def merge_duplicates_parallel(alignments_fn, library_fn, codec, out, threads, max_memory=None, tmpdir=None, mismatches=0,
+                              metrics=None, spurious_threshold=None):
+    """Merge PCR duplicates of a bed6 file using a pool of worker processes.
+
+    Alignments are distributed to partition files in a temporary directory in
+    tmpdir by chrom and strand. Partitions are merged independently by
+    workers, each of which opens the barcode library library_fn as
+    BarcodeKeys using codec, so no open files or large dictionaries are
+    passed to the workers. The
+    sorted events of the partitions are then merged into the output order, so
+    the output is identical to that of merge_duplicates. With max_memory,
+    each worker uses an equal share of it. Lookups and merged events are
+    counted in metrics, a MergeMetrics. With spurious_threshold, spurious
+    events are removed by filter_spurious after counting.
+    """
+    workdir = mkdtemp(prefix="merge_partitions_", dir=tmpdir)
+    try:
+        partition_fns = [os.path.join(workdir, "partition{}.bed".format(i)) for i in range(PARTITIONS_PER_THREAD * threads)]
+        partition_alignments(alignments_fn, partition_fns)
+        worker_memory = max_memory // threads if max_memory is not None else None
+        metrics_type = type(metrics) if metrics is not None else None
+        run_fns = []
+        worker_args = (library_fn, codec, worker_memory, workdir, mismatches, metrics_type)
+        for run_fn, partition_metrics in map_ordered(_merge_partition, partition_fns, worker_args, threads,
+                                                     _open_partition_library):
+            run_fns.append(run_fn)
+            if metrics is not None:
+                metrics.update(partition_metrics)
+        _write_events(merge_runs(run_fns), out, spurious_threshold=spurious_threshold, metrics=metrics)
+    finally:
+        rmtree(workdir)
+
+
+def _position_events(events, codec, mismatches):
+    """Return the events of one position as sorted_events, ordered by stop, strand and read id."""
+    if mismatches:
+        events = cluster_events(events, codec, mismatches)
+    merged = sorted_events(events, codec)
+    merged.sort(key=lambda event: (int(event[3]), event[4], event[6]))
+    return merged
+
+
+def _format_positions(positions, metrics=None, spurious_threshold=None):
+    """Format lists of events of positions as bed6 lines, counting them in metrics."""
+    if metrics is not None:
+        metrics.add_positions(positions)
+    if spurious_threshold is None:
+        return b"".join([format_events(events) for events in positions])
+    return b"".join([line for events in positions for line in filter_spurious(events, spurious_threshold)])
+
+
+def merge_presorted(batches, codec, out, mismatches=0, metrics=None, spurious_threshold=None):
+    """Merge PCR duplicates of batches of alignments sorted by chrom and start.
+
+    Alignments of the same chrom and start form a position. Events of a
+    position are written as soon as the next position starts, so only the
+    alignments of one position are kept in memory. Positions are written in
+    input order, events of a position ordered by stop, strand and read id.
+    With mismatches, barcodes within mismatches are merged by cluster_events.
+    Merged events are counted in metrics, a MergeMetrics. With
+    spurious_threshold, spurious events of each position are removed by
+    filter_spurious after counting, as by rm_spurious_events.py --presorted.
+    """
+    counter = DuplicateCounter()
+    chrom = start = None
+    finished_chroms = set()
+    for alignments, keys in batches:
+        positions = []
+        begin = 0
+        for i, aln in enumerate(alignments):
+            if aln[1] == chrom and aln[2] == start:
+                continue
+            counter.add(alignments[begin:i], keys[begin:i])
+            positions.append(_position_events(counter.events, codec, mismatches))
+            counter.events = {}
+            begin = i
+            if aln[1] != chrom:
+                finished_chroms.add(chrom)
+                if aln[1] in finished_chroms:
+                    raise ValueError("Alignments are not sorted by chromosome, found '{}' after '{}'.".format(
+                        aln[1].decode(), chrom.decode()))
+            elif int(aln[2]) < int(start):
+                raise ValueError("Alignments are not sorted by start, found {} after {} on '{}'.".format(
+                    aln[2].decode(), start.decode(), chrom.decode()))
+            chrom, start = aln[1], aln[2]
+        counter.add(alignments[begin:], keys[begin:])
+        out.write(_format_positions(positions, metrics, spurious_threshold))
+    positions = [_position_events(counter.events, codec, mismatches)]
+    out.write(_format_positions(positions, metrics, spurious_threshold))
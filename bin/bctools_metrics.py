@@ -0,0 +1,136 @@
+"""
+Library complexity and duplication metrics of merged PCR duplicates.
+
+Metrics are collected while merging: barcode lookups report the number of
+alignments and of alignments without barcode or with barcodes containing N,
+merged events are counted as they are written. The library size, the number
+of distinct molecules, is estimated from the number of alignments and events
+as by Picard EstimateLibraryComplexity, assuming a Lander-Waterman model.
+
+The number of distinct barcodes per position requires all events of a
+position. Events of complete positions, as merged from sorted alignments,
+are added to the histogram directly (see MergeMetrics.add_positions). Events
+in any other order are counted in a table of positions, which grows with the
+number of positions (see MergeMetrics.add_events).
+
+Metrics are written in JSON format to files with suffix .json and as
+tab-separated name and value pairs otherwise. Histograms are written as one
+line per value in TSV format.
+"""
+
+import json
+from collections import Counter, OrderedDict
+from itertools import groupby
+from math import exp
+from operator import itemgetter
+
+# fields of events as returned by bctools_merge.sorted_events
+_COUNT = itemgetter(5)
+_POSITION = itemgetter(1, 2, 3, 4)
+_STOP_STRAND = itemgetter(3, 4)
+
+
+def estimate_library_size(n_reads, n_unique):
+    """Estimate the number of distinct molecules from reads and unique reads.
+
+    Solves n_unique / x = 1 - exp(-n_reads / x) for x by bisection. Returns
+    None if there are no duplicates.
+    """
+    def f(x):
+        return n_unique / float(x) - 1 + exp(-n_reads / float(x))
+
+    if n_unique <= 0 or n_unique >= n_reads:
+        return None
+    lower, upper = 1.0, 100.0
+    if f(lower * n_unique) < 0:
+        return None
+    while f(upper * n_unique) >= 0:
+        upper *= 10
+    for _ in range(40):
+        middle = (lower + upper) / 2
+        value = f(middle * n_unique)
+        if value == 0:
+            break
+        elif value > 0:
+            lower = middle
+        else:
+            upper = middle
+    return int(n_unique * (lower + upper) / 2)
+
+
+class MergeMetrics(object):
+    """Duplication metrics of a merge of PCR duplicates."""
+
+    def __init__(self):
+        self.alignments = 0
+        self.missing_barcode = 0
+        self.n_barcode = 0
+        self.duplicates = Counter()
+        # distinct barcodes of positions of unordered events
+        self.barcodes = Counter()
+        # histogram of distinct barcodes per complete position
+        self.barcodes_per_position = Counter()
+
+    def add_lookup(self, n_alignments, n_missing, n_dropped):
+        """Count alignments, alignments without barcode and alignments with barcodes containing N."""
+        self.alignments += n_alignments
+        self.missing_barcode += n_missing
+        self.n_barcode += n_dropped
+
+    def update(self, other):
+        """Add the lookup counts of another MergeMetrics."""
+        self.add_lookup(other.alignments, other.missing_barcode, other.n_barcode)
+
+    def add_events(self, events):
+        """Count merged events as returned by bctools_merge.sorted_events."""
+        self.duplicates.update(map(_COUNT, events))
+        self.barcodes.update(map(_POSITION, events))
+
+    def add_positions(self, positions):
+        """Count lists of the merged events of complete positions of the same chrom and start.
+
+        Events of a position have to be ordered by stop and strand. Only the
+        histogram of barcodes per position is kept, not the positions.
+        """
+        sizes = []
+        for events in positions:
+            if len(events) == 1:
+                sizes.append(1)
+            else:
+                sizes.extend([len(list(group)) for _, group in groupby(map(_STOP_STRAND, events))])
+            self.duplicates.update(map(_COUNT, events))
+        self.barcodes_per_position.update(sizes)
+
+    def summary(self):
+        """Return an ordered dictionary of all metrics."""
+        n_events = sum(self.duplicates.values())
+        n_merged = sum(count * n for count, n in self.duplicates.items())
+        barcodes_per_position = Counter(self.barcodes.values())
+        barcodes_per_position.update(self.barcodes_per_position)
+        return OrderedDict([
+            ("alignments", self.alignments),
+            ("alignments_missing_barcode", self.missing_barcode),
+            ("alignments_barcode_with_N", self.n_barcode),
+            ("alignments_merged", n_merged),
+            ("events", n_events),
+            ("positions", sum(barcodes_per_position.values())),
+            ("duplication_rate", 1 - n_events / float(n_merged) if n_merged else 0.0),
+            ("estimated_library_size", estimate_library_size(n_merged, n_events)),
+            ("duplicates_per_event", OrderedDict(sorted(self.duplicates.items()))),
+            ("barcodes_per_position", OrderedDict(sorted(barcodes_per_position.items()))),
+        ])
+
+    def write(self, filename):
+        """Write metrics in JSON format if filename ends with .json, as TSV otherwise."""
+        summary = self.summary()
+        with open(filename, "w") as out:
+            if filename.endswith(".json"):
+                json.dump(summary, out, indent=2)
+                out.write("\n")
+                return
+            for name, value in summary.items():
+                if isinstance(value, dict):
+                    for key, n in value.items():
+                        out.write("{}\t{}\t{}\n".format(name, key, n))
+                else:
+                    out.write("{}\t{}\n".format(name, "NA" if value is None else value))
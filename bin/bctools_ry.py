@@ -0,0 +1,97 @@
+"""
+Translation of nucleotide sequences to binary RY-space.
+
+A and G are converted to R. T, U and C are converted to Y. All other
+characters are kept.
+
+Blocks of FASTQ and FASTA records are translated in bulk: all sequence lines of
+a block are translated with a single call of bytes.translate while headers and
+quality lines are copied unchanged. Blocks that need normalization, such as
+trailing whitespace or multi-line FASTA sequences, are parsed record by
+record, so the output of both paths is identical.
+"""
+
+from itertools import repeat
+from bctools_fastq import parse_fastq_block, parse_fasta_block, format_fasta
+
+
+def _make_table(source, target):
+    table = bytearray(range(256))
+    for src, tgt in zip(bytearray(source), bytearray(target)):
+        table[src] = tgt
+    return bytes(table)
+
+
+# translation table for use with bytes.translate
+RY_TABLE = _make_table(b"AGCUT", b"RRYYY")
+# length of the sequence lines of translated FASTA records, as written by Biopython
+FASTA_WRAP = 60
+
+
+def translate_nt_to_RY(seq):
+    """Translates nucleotides of a byte string to RY (A,G -> R; C,U,T -> Y).
+
+    >>> translate_nt_to_RY(b"ACGUTACGUT")
+    b'RYRYYRYRYY'
+    """
+    return seq.translate(RY_TABLE)
+
+
+def _has_trailing_whitespace(data):
+    return not data.endswith(b"\n") or b"\r" in data or b" \n" in data or b"\t\n" in data
+
+
+def _is_plain_fastq(data, lines):
+    """Check if FASTQ lines are unchanged by parsing and formatting them."""
+    n_records = len(lines) // 4
+    if len(lines) != 4 * n_records or _has_trailing_whitespace(data):
+        return False
+    if lines[2::4].count(b"+") != n_records:
+        return False
+    if not all(map(bytes.startswith, lines[0::4], repeat(b"@"))):
+        return False
+    return list(map(len, lines[1::4])) == list(map(len, lines[3::4]))
+
+
+def translate_fastq_block(data):
+    """Translate the sequences of a block of FASTQ records to RY-space.
+
+    Returns the formatted records as written by FastqWriter.
+    """
+    lines = data.split(b"\n")
+    lines.pop()
+    if not _is_plain_fastq(data, lines):
+        return b"".join([b"@%s\n%s\n+\n%s\n" % (header, seq.translate(RY_TABLE), qual)
+                         for header, seq, qual in parse_fastq_block(data)])
+    lines[1::4] = b"\n".join(lines[1::4]).translate(RY_TABLE).split(b"\n")
+    lines.append(b"")
+    return b"\n".join(lines)
+
+
+def _is_plain_fasta(data, lines, wrap):
+    """Check if FASTA lines are records with a single line of at most wrap nts."""
+    if len(lines) % 2 != 0 or not lines or _has_trailing_whitespace(data):
+        return False
+    seqs = lines[1::2]
+    if not all(map(bytes.startswith, lines[0::2], repeat(b">"))):
+        return False
+    if any(map(bytes.startswith, seqs, repeat(b">"))):
+        return False
+    return 0 < min(map(len, seqs)) and max(map(len, seqs)) <= wrap
+
+
+def translate_fasta_block(data, wrap=FASTA_WRAP):
+    """Translate the sequences of a block of FASTA records to RY-space.
+
+    Sequences are split into lines of wrap nts as done by Biopython.
+    """
+    lines = data.split(b"\n")
+    lines.pop()
+    joined = b"\n".join(lines[1::2]) if _is_plain_fasta(data, lines, wrap) else None
+    # spaces in sequences are removed by the parser
+    if joined is None or b" " in joined or b"\t" in joined:
+        return b"".join([format_fasta(header, seq.translate(RY_TABLE), wrap)
+                         for header, seq in parse_fasta_block(data)])
+    lines[1::2] = joined.translate(RY_TABLE).split(b"\n")
+    lines.append(b"")
+    return b"\n".join(lines)
@@ -0,0 +1,304 @@
+"""
+Removal of spurious crosslinking events arising from errors in barcodes.
+
+Events sharing chrom, start, stop and strand form a group. Within each group
+the maximum number of PCR duplicates is determined and events supported by
+less than threshold times this maximum are removed, as by
+rm_spurious_events.pl. With a window W, events are instead compared to the
+maximum count of all events of the same chrom and strand whose start and stop
+are both within W of their own (see window_maxima).
+
+Events are written sorted by chrom (in version order, so chr2 precedes chr10),
+start, stop, strand, name and descending count, the output order of the
+sort/perl/sort pipeline. Strands are ordered as in the en_US.UTF-8 locale
+used to produce the reference outputs, "-" before "+". Names are compared as
+byte strings.
+
+All events are sorted once and filtered group by group (see
+remove_spurious). Events sorted by chrom and start are filtered one position
+at a time (see remove_spurious_presorted). Several thresholds can be
+evaluated in a single pass (see sweep_thresholds).
+"""
+
+import re
+from bisect import bisect_left, bisect_right
+from collections import deque
+from itertools import groupby, islice
+from operator import itemgetter
+
+# number of events read and written at once
+BATCH_SIZE = 100000
+
+_DIGITS = re.compile(br"(\d+)")
+_STRAND_ORDER = {b"-": 0, b"+": 1}
+# events of a group share these fields of parse_event
+_GROUP_KEY = itemgetter(0, 1, 2, 5)
+
+
+def version_key(chrom):
+    """Return a key sorting chromosome names in version order, as sort -V."""
+    parts = _DIGITS.split(chrom)
+    parts[1::2] = [int(part) for part in parts[1::2]]
+    return parts
+
+
+def parse_event(line):
+    """Return (chrom, start, stop, name, count, strand, line) of a bed6 line."""
+    fields = line.rstrip(b"\r\n").split(b"\t")
+    if len(fields) < 6:
+        raise ValueError("Expected bed6 events, found line '{}'.".format(line.rstrip(b"\r\n").decode()))
+    if not line.endswith(b"\n"):
+        line += b"\n"
+    return fields[0], int(fields[1]), int(fields[2]), fields[3], int(fields[4]), fields[5], line
+
+
+def read_events(filename, batch_size=BATCH_SIZE):
+    """Yield lists of events of a bed6 file as returned by parse_event."""
+    with open(filename, "rb") as fh:
+        while True:
+            lines = list(islice(fh, batch_size))
+            if not lines:
+                break
+            yield [parse_event(line) for line in lines if line.strip()]
+
+
+def sort_events(events):
+    """Sort a list of events as returned by parse_event into output order."""
+    chroms = sorted(set(event[0] for event in events), key=version_key)
+    chrom_rank = dict((chrom, rank) for rank, chrom in enumerate(chroms))
+    strand_order = _STRAND_ORDER
+    events.sort(key=lambda event: (chrom_rank[event[0]], event[1], event[2], strand_order.get(event[5], 2), event[5],
+                                   event[3], -event[4], event[6]))
+
+
+def filter_group(events, threshold, max_count=None):
+    """Return the events of one group supported by at least threshold times the maximum count.
+
+    By default the maximum count is that of the events of the group.
+    """
+    if max_count is None:
+        max_count = max(event[4] for event in events)
+    return [event for event in events if event[4] >= max_count * threshold]
+
+
+def filter_sorted(events, threshold, maxima=None):
+    """Yield the events of a sequence of events in output order that pass the threshold.
+
+    maxima optionally maps groups to the maximum counts used, see window_maxima.
+    """
+    for group_key, group in groupby(events, key=_GROUP_KEY):
+        max_count = maxima[group_key] if maxima is not None else None
+        for event in filter_group(list(group), threshold, max_count):
+            yield event
+
+
+def _sweep_window_maxima(positions, counts, window):
+    """Return the maximum count within window of each of a list of (start, stop) sorted by start.
+
+    A sweep line over start adds positions entering and removes positions
+    leaving the window of starts. Positions in the window are kept in a max
+    segment tree over the distinct stops. Each stop holds the positions in
+    the window as monotonic queue of decreasing counts, positions enter and
+    leave it in start order, so the maximum of a stop is at its front.
+    """
+    stops = sorted(set(stop for _, stop in positions))
+    column = dict((stop, i) for i, stop in enumerate(stops))
+    size = 1
+    while size < len(stops):
+        size <<= 1
+    tree = [-1] * (2 * size)
+    queues = [deque() for _ in stops]
+
+    def update(i, value):
+        i += size
+        tree[i] = value
+        i >>= 1
+        while i:
+            tree[i] = max(tree[2 * i], tree[2 * i + 1])
+            i >>= 1
+
+    maxima = []
+    added = removed = 0
+    for start, stop in positions:
+        while added < len(positions) and positions[added][0] <= start + window:
+            queue = queues[column[positions[added][1]]]
+            while queue and counts[queue[-1]] <= counts[added]:
+                queue.pop()
+            queue.append(added)
+            if queue[0] == added:
+                update(column[positions[added][1]], counts[added])
+            added += 1
+        while positions[removed][0] < start - window:
+            queue = queues[column[positions[removed][1]]]
+            if queue[0] == removed:
+                queue.popleft()
+                update(column[positions[removed][1]], counts[queue[0]] if queue else -1)
+            removed += 1
+        lower = bisect_left(stops, stop - window) + size
+        upper = bisect_right(stops, stop + window) + size
+        max_count = -1
+        while lower < upper:
+            if lower & 1:
+                max_count = max(max_count, tree[lower])
+                lower += 1
+            if upper & 1:
+                upper -= 1
+                max_count = max(max_count, tree[upper])
+            lower >>= 1
+            upper >>= 1
+        maxima.append(max_count)
+    return maxima
+
+
+def window_maxima(events, window):
+    """Return a dictionary of the groups of events and the maximum count within window.
+
+    Groups are given as (chrom, start, stop, strand). The maximum count of a
+    group is taken over all events of the same chrom and strand with start and
+    stop differing by at most window from those of the group. This takes
+    O(n log n) time for n groups, see _sweep_window_maxima.
+    """
+    group_maxima = {}
+    for event in events:
+        group_key = _GROUP_KEY(event)
+        if group_maxima.get(group_key, -1) < event[4]:
+            group_maxima[group_key] = event[4]
+    locations = {}
+    for chrom, start, stop, strand in group_maxima:
+        locations.setdefault((chrom, strand), []).append((start, stop))
+    maxima = {}
+    for (chrom, strand), positions in locations.items():
+        positions.sort()
+        counts = [group_maxima[(chrom, start, stop, strand)] for start, stop in positions]
+        for (start, stop), max_count in zip(positions, _sweep_window_maxima(positions, counts, window)):
+            maxima[(chrom, start, stop, strand)] = max_count
+    return maxima
+
+
+def _write_events(events, out, batch_size=BATCH_SIZE):
+    while True:
+        lines = [event[6] for event in islice(events, batch_size)]
+        if not lines:
+            break
+        out.write(b"".join(lines))
+
+
+def remove_spurious(filename, out, threshold, window=0):
+    """Remove spurious events of a bed6 file and write the others to the binary file handle out.
+
+    All events are held in memory and sorted once into output order. With
+    window, events are compared to the maximum count within window.
+    """
+    events = []
+    for batch in read_events(filename):
+        events.extend(batch)
+    sort_events(events)
+    maxima = window_maxima(events, window) if window else None
+    _write_events(filter_sorted(events, threshold, maxima), out)
+
+
+def _presorted_positions(filename):
+    """Yield the lists of events of each chrom and start of a bed6 file sorted by chrom and start."""
+    position = []
+    finished_chroms = set()
+    for batch in read_events(filename):
+        for event in batch:
+            if position and (event[0] != position[0][0] or event[1] != position[0][1]):
+                chrom, start = position[0][:2]
+                yield position
+                position = []
+                if event[0] != chrom:
+                    finished_chroms.add(chrom)
+                    if event[0] in finished_chroms:
+                        raise ValueError("Events are not sorted by chromosome, found '{}' after '{}'.".format(
+                            event[0].decode(), chrom.decode()))
+                elif event[1] < start:
+                    raise ValueError("Events are not sorted by start, found {} after {} on '{}'.".format(
+                        event[1], start, chrom.decode()))
+            position.append(event)
+    if position:
+        yield position
+
+
+def remove_spurious_presorted(filename, out, threshold):
+    """Remove spurious events of a bed6 file sorted by chrom and start.
+
+    Events are filtered one position (chrom and start) at a time, so only the
+    events of one position are kept in memory. Positions are written in input
+    order, events of a position in output order.
+    """
+    for position in _presorted_positions(filename):
+        sort_events(position)
+        out.write(b"".join(event[6] for event in filter_sorted(position, threshold)))
+
+
+def parse_thresholds(thresholds):
+    """Parse a comma-separated list of thresholds in [0,1]."""
+    try:
+        values = [float(value) for value in thresholds.split(",")]
+    except ValueError:
+        raise ValueError("Thresholds must be given as comma-separated numbers, is '{}'.".format(thresholds))
+    if any(value < 0 or value > 1 for value in values):
+        raise ValueError("Thresholds must be in [0,1], is '{}'.".format(thresholds))
+    return values
+
+
+def _sorted_groups(filename, presorted=False, window=0):
+    """Yield the lists of events of each group of a bed6 file in output order and their maximum count."""
+    maxima = None
+    if presorted:
+        positions = _presorted_positions(filename)
+    else:
+        events = []
+        for batch in read_events(filename):
+            events.extend(batch)
+        positions = [events]
+        if window:
+            maxima = window_maxima(events, window)
+    for events in positions:
+        sort_events(events)
+        for group_key, group in groupby(events, key=_GROUP_KEY):
+            group = list(group)
+            yield group, maxima[group_key] if maxima is not None else max(event[4] for event in group)
+
+
+def sweep_thresholds(filename, out, thresholds, presorted=False, window=0):
+    """Evaluate several thresholds for spurious event removal in one pass.
+
+    Writes all events of a bed6 file in output order to the binary file handle
+    out, appending the ratio of the count of each event to the maximum count
+    of its group as an additional column. With presorted, events sorted by
+    chrom and start are processed one position at a time. With window, ratios
+    are taken to the maximum count within window. Returns a list of
+    (threshold, events, removed events, duplicates, removed duplicates) for
+    each threshold, duplicates being the sum of the counts of the events kept
+    and removed at this threshold.
+    """
+    kept = [0] * len(thresholds)
+    kept_duplicates = [0] * len(thresholds)
+    n_events = n_duplicates = 0
+    lines = []
+    for group, max_count in _sorted_groups(filename, presorted, window):
+        for event in group:
+            count = event[4]
+            for i, threshold in enumerate(thresholds):
+                if count >= max_count * threshold:
+                    kept[i] += 1
+                    kept_duplicates[i] += count
+            n_events += 1
+            n_duplicates += count
+            ratio = count / float(max_count) if max_count else 1.0
+            lines.append(b"%s\t%.6g\n" % (event[6].rstrip(b"\r\n"), ratio))
+        if len(lines) >= BATCH_SIZE:
+            out.write(b"".join(lines))
+            lines = []
+    out.write(b"".join(lines))
+    return [(threshold, n, n_events - n, duplicates, n_duplicates - duplicates)
+            for threshold, n, duplicates in zip(thresholds, kept, kept_duplicates)]
+
+
+def write_sweep_summary(summary, out):
+    """Write the summary returned by sweep_thresholds as tab-separated table to the file handle out."""
+    out.write("threshold\tevents\tremoved_events\tduplicates\tremoved_duplicates\n")
+    for row in summary:
+        out.write("{:g}\t{}\t{}\t{}\t{}\n".format(*row))
@@ -0,0 +1,141 @@
+"""
+Error-aware clustering of barcodes (UMIs) of packed barcode keys.
+
+Barcodes of one position are clustered by the directional method of
+UMI-tools: barcode a absorbs barcode b if they differ in at most the allowed
+number of mismatches and count(a) >= 2 * count(b) - 1. Starting from the most
+frequent barcode, each cluster collects all barcodes reachable along such
+edges that are not part of a previous cluster.
+
+Mismatches are counted on packed keys (see bctools_codec) by XOR and
+popcount. Candidate neighbours are found by the pigeonhole principle: if two
+barcodes differ in at most k positions, they are identical in at least one of
+k + 1 segments, so barcodes are indexed by the value of each segment and only
+barcodes sharing a segment are compared.
+"""
+
+from collections import deque
+import numpy as np
+
+# number of set bits of each byte value
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+# maximum number of key pairs compared at once
+_BLOCK_SIZE = 1 << 20
+# smaller sets of keys are compared pairwise in python, without index or numpy
+_MIN_INDEXED = 32
+
+
+def key_length(key, bits):
+    """Return the length of the barcode of a packed key."""
+    return (key.bit_length() - 1) // bits
+
+
+def _segments(length, bits, mismatches):
+    """Return (shift, mask) of the k + 1 segments of packed keys of barcodes of the given length."""
+    n_segments = min(mismatches + 1, length)
+    segments = []
+    for i in range(n_segments):
+        begin = i * length // n_segments
+        end = (i + 1) * length // n_segments
+        segments.append(((length - end) * bits, (1 << ((end - begin) * bits)) - 1))
+    return segments
+
+
+def _mismatch_mask(length, bits):
+    """Return the mask selecting one bit per base of XORed keys."""
+    mask = 0
+    for _ in range(length):
+        mask = (mask << bits) | 1
+    return mask
+
+
+def _close_pairs(bucket, bits, mask, mismatches):
+    """Yield pairs of keys of a list of keys within mismatches."""
+    for i, a in enumerate(bucket):
+        for b in bucket[i + 1:]:
+            x = a ^ b
+            if bits == 2:
+                x = (x | (x >> 1)) & mask
+            if bin(x).count("1") <= mismatches:
+                yield a, b
+
+
+def _close_pairs_packed(bucket, bits, mask, mismatches):
+    """Yield pairs of keys of a list of keys fitting into 64 bits within mismatches.
+
+    Keys are compared block-wise as numpy arrays.
+    """
+    keys = np.array(bucket, dtype=np.uint64)
+    mask = np.uint64(mask)
+    rows_per_block = max(1, _BLOCK_SIZE // len(keys))
+    for begin in range(0, len(keys) - 1, rows_per_block):
+        rows = keys[begin:begin + rows_per_block]
+        x = rows[:, None] ^ keys[None, :]
+        if bits == 2:
+            x = (x | (x >> np.uint64(1))) & mask
+        distances = _POPCOUNT[x.view(np.uint8)].reshape(x.shape + (8,)).sum(axis=2)
+        # report each pair once, comparing rows to the keys following them
+        close = (distances <= mismatches) & (np.arange(len(keys))[None, :] > np.arange(begin, begin + len(rows))[:, None])
+        for i, j in zip(*np.nonzero(close)):
+            yield bucket[begin + i], bucket[j]
+
+
+def neighbours(keys, length, bits, mismatches):
+    """Return a dictionary of keys of barcodes of equal length and the keys within mismatches."""
+    if mismatches >= length:
+        # barcodes of equal length differ in at most length positions
+        return dict((key, set(keys) - set([key])) for key in keys)
+    mask = _mismatch_mask(length, bits)
+    found = dict((key, set()) for key in keys)
+    if len(keys) < _MIN_INDEXED:
+        for a, b in _close_pairs(keys, bits, mask, mismatches):
+            found[a].add(b)
+            found[b].add(a)
+        return found
+    packed = length * bits < 64
+    index = {}
+    for segment, (shift, segment_mask) in enumerate(_segments(length, bits, mismatches)):
+        for key in keys:
+            index.setdefault((segment, (key >> shift) & segment_mask), []).append(key)
+    for bucket in index.values():
+        if len(bucket) < 2:
+            continue
+        close_pairs = _close_pairs_packed if packed and len(bucket) >= _MIN_INDEXED else _close_pairs
+        for a, b in close_pairs(bucket, bits, mask, mismatches):
+            found[a].add(b)
+            found[b].add(a)
+    return found
+
+
+def directional_clusters(counts, bits, mismatches):
+    """Cluster packed barcode keys by the directional method.
+
+    counts is a dictionary of keys and counts. Returns a list of clusters,
+    each a list of keys starting with the representative key. Keys of
+    different length are never clustered together.
+    """
+    by_length = {}
+    for key in counts:
+        by_length.setdefault(key_length(key, bits), []).append(key)
+    adjacent = {}
+    for length, keys in by_length.items():
+        adjacent.update(neighbours(keys, length, bits, mismatches))
+
+    clusters = []
+    assigned = set()
+    for key in sorted(counts, key=lambda key: (-counts[key], key)):
+        if key in assigned:
+            continue
+        assigned.add(key)
+        cluster = [key]
+        queue = deque([key])
+        while queue:
+            node = queue.popleft()
+            threshold = counts[node]
+            for other in sorted(adjacent[node]):
+                if other not in assigned and threshold >= 2 * counts[other] - 1:
+                    assigned.add(other)
+                    cluster.append(other)
+                    queue.append(other)
+        clusters.append(cluster)
+    return clusters
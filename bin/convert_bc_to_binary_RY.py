@@ -1,23 +1,27 @@
 #!/usr/bin/env python
 
-from builtins import str
 import argparse
 import logging
-from sys import stdout
-from Bio import SeqIO
-from Bio.Seq import Seq
-from Bio.Alphabet import IUPAC
+from bctools_fastq import read_fastq_file_blocks, read_fasta_file_blocks
+from bctools_index import shard_offsets
+from bctools_io import BatchedWriter, open_output, COMPRESSION_FORMATS
+from bctools_ry import translate_fastq_block, translate_fasta_block
 
 tool_description = """
 Convert standard nucleotides in FASTQ or FASTA format to IUPAC nucleotide codes
 used for binary RY-space barcodes.
 
 A and G are converted to R. T, U and C are converted to Y. By default output is
-written to stdout.
+written to stdout. Input files may be gzip, bgzf or zstd compressed.
 
 Example usage:
 - write converted sequences from file in.fa to file file out.fa:
 convert_bc_to_binary_RY.py in.fastq --outfile out.fastq
+- same as above, write zstd compressed output:
+convert_bc_to_binary_RY.py in.fastq --outfile out.fastq.zst --compress zstd
+- convert the second of 8 shards of an uncompressed FASTQ file (see
+  index_fastq.py):
+convert_bc_to_binary_RY.py in.fastq --shard 2/8 --outfile out_2.fastq
 """
 
 # parse command line arguments
@@ -31,11 +35,24 @@ parser.add_argument(
 parser.add_argument(
     "-o", "--outfile",
     help="Write results to this file.")
+parser.add_argument(
+    "--compress",
+    choices=COMPRESSION_FORMATS,
+    help="Compress output using this format.")
+parser.add_argument(
+    "--compress-threads",
+    dest="compress_threads",
+    type=int,
+    default=1,
+    help="Number of threads used for compressing output.")
 parser.add_argument(
     "-f", "--fasta-format",
     dest="fasta_format",
     help="Read and write fasta instead of fastq format.",
     action="store_true")
+parser.add_argument(
+    "--shard",
+    help="Only process shard i/N of the uncompressed fastq input file, counting from 1. Uses the index built by index_fastq.py if present.")
 parser.add_argument(
     "-v", "--verbose",
     help="Be verbose.",
@@ -46,31 +63,6 @@ parser.add_argument(
     action="store_true")
 
 
-def translate_nt_to_RY(seq):
-    """Translates nucleotides to RY (A,G -> R; C,U,T -> Y).
-
-    >>> translate_nt_to_RY("ACGUTACGUT")
-    RYRYYRYRYY
-    """
-    trans_table = str.maketrans("AGCUT", "RRYYY")
-    trans_seq = seq.translate(trans_table)
-    logging.debug(seq + " -> " + trans_seq)
-    return trans_seq
-
-
-def translate_nt_to_RY_iterator(robj):
-    """Translate SeqRecords sequences to RY alphabet."""
-    for record in robj:
-        if not args.fasta_format:
-            saved_letter_annotations = record.letter_annotations
-        record.letter_annotations = {}
-        record.seq = Seq(translate_nt_to_RY(str(record.seq)),
-                         IUPAC.unambiguous_dna)
-        if not args.fasta_format:
-            record.letter_annotations = saved_letter_annotations
-        yield record
-
-
 # handle arguments
 args = parser.parse_args()
 if args.debug:
@@ -84,18 +76,21 @@ if args.outfile:
     logging.info("  outfile: enabled writing to file")
     logging.info("  outfile: '{}'".format(args.outfile))
 logging.info("  outfile: '{}'".format(args.outfile))
+if args.compress:
+    logging.info("  compress: writing {} compressed output using {} threads".format(args.compress, args.compress_threads))
+if args.shard:
+    logging.info("  shard: {}".format(args.shard))
 logging.info("")
 
-# get input iterator
-input_handle = open(args.infile, "rU")
-if args.fasta_format:
-    input_seq_iterator = SeqIO.parse(input_handle, "fasta")
-else:
-    input_seq_iterator = SeqIO.parse(input_handle, "fastq")
-convert_seq_iterator = translate_nt_to_RY_iterator(input_seq_iterator)
-output_handle = (open(args.outfile, "w") if args.outfile is not None else stdout)
-if args.fasta_format:
-    SeqIO.write(convert_seq_iterator, output_handle, "fasta")
-else:
-    SeqIO.write(convert_seq_iterator, output_handle, "fastq")
-output_handle.close()
+if args.shard is not None and args.fasta_format:
+    raise ValueError("Option --shard is only supported for fastq input.")
+
+# convert sequence lines of whole blocks, headers and qualities are copied unchanged
+with BatchedWriter(open_output(args.outfile, args.compress, args.compress_threads)) as output_handle:
+    if args.fasta_format:
+        for block in read_fasta_file_blocks(args.infile):
+            output_handle.write(translate_fasta_block(block))
+    else:
+        start, stop = shard_offsets([args.infile], args.shard)[0] if args.shard is not None else (0, None)
+        for block in read_fastq_file_blocks(args.infile, start=start, stop=stop):
+            output_handle.write(translate_fastq_block(block))
@@ -3,14 +3,22 @@
 import argparse
 import logging
 from sys import stdout
-from pybedtools import BedTool
-from pybedtools.featurefuncs import five_prime
-from pybedtools.featurefuncs import three_prime
+from bctools_clnt import crosslink_positions
+from bctools_io import open_output, COMPRESSION_FORMATS
+
+try:
+    from pybedtools import BedTool
+    from pybedtools.featurefuncs import five_prime
+    from pybedtools.featurefuncs import three_prime
+except ImportError:
+    BedTool = None
 # avoid ugly python IOError when stdout output is piped into another program
 # and then truncated (such as piping to head)
 from signal import signal, SIGPIPE, SIG_DFL
 signal(SIGPIPE, SIG_DFL)
 
+ENGINES = ("native", "pybedtools")
+
 tool_description = """
 Given coordinates of aligned reads in bed format, calculate positions of the
 crosslinked nucleotides. By default, crosslinked nts are assumed to be one nt
@@ -18,6 +26,12 @@ upstream of the 5'-end of the read.
 
 By default output is written to stdout.
 
+Input may be gzip or zstd compressed. By default the input is read in large
+blocks and the coordinates are converted in-process without temporary files,
+output can be compressed with --compress. With --engine pybedtools the
+previous implementation using pybedtools is used, which requires pybedtools
+and writes uncompressed output. Both engines produce identical output.
+
 Input:
 * bed6 file containing coordinates of aligned reads
 * bed6 file containing coordinates of crosslinking events
@@ -26,6 +40,9 @@ Example usage:
 - convert read coordinates from file in.bed to coordinates of the crosslinking
   events, written to out.bed:
 coords2clnt.py in.bed --outfile out.bed
+- convert read coordinates from gzip compressed file in.bed.gz, writing gzip
+  compressed output to out.bed.gz:
+coords2clnt.py in.bed.gz --outfile out.bed.gz --compress gzip
 """
 
 # parse command line arguments
@@ -43,6 +60,21 @@ parser.add_argument(
     "-3", "--threeprime",
     help="Set position one nt downstream of 3'-end as crosslinked nucleotide.",
     action="store_true")
+parser.add_argument(
+    "--engine",
+    choices=ENGINES,
+    default="native",
+    help="Convert coordinates in-process (native) or using pybedtools (pybedtools).")
+parser.add_argument(
+    "--compress",
+    choices=COMPRESSION_FORMATS,
+    help="Compress output using this format.")
+parser.add_argument(
+    "--compress-threads",
+    dest="compress_threads",
+    type=int,
+    default=1,
+    help="Number of threads used for compressing output.")
 parser.add_argument(
     "-v", "--verbose",
     help="Be verbose.",
@@ -65,23 +97,39 @@ if args.outfile:
     logging.info("  outfile: enabled writing to file")
     logging.info("  outfile: '{}'".format(args.outfile))
 logging.info("  outfile: '{}'".format(args.outfile))
+logging.info("  engine: {}".format(args.engine))
+if args.compress:
+    logging.info("  compress: writing {} compressed output using {} threads".format(args.compress, args.compress_threads))
 logging.info("")
 
-# data processing
-alns = BedTool(args.infile)
-# select either from 5' or 3'-end
-if args.threeprime:
-    clnts = alns.each(three_prime, upstream=0, downstream=1)
-else:
-    clnts = alns.each(five_prime, upstream=1, downstream=0)
+if args.compress and args.engine != "native":
+    raise ValueError("Option --compress requires the native engine.")
 
-# write to file or to stdout
-if args.outfile:
-    clnts.saveas(args.outfile)
+if args.engine == "native":
+    out = open_output(args.outfile, args.compress, args.compress_threads)
+    crosslink_positions(args.infile, out, args.threeprime)
+    if args.outfile or args.compress:
+        out.close()
+    else:
+        out.flush()
 else:
-    tmptool = clnts.saveas()
-    logging.debug("results written to temporary file :" + tmptool.fn)
-    tmp = open(tmptool.fn)
-    for line in tmp:
-        stdout.write(line)
-    tmp.close()
+    if BedTool is None:
+        raise ImportError("Engine pybedtools requires the python package 'pybedtools'.")
+    # data processing
+    alns = BedTool(args.infile)
+    # select either from 5' or 3'-end
+    if args.threeprime:
+        clnts = alns.each(three_prime, upstream=0, downstream=1)
+    else:
+        clnts = alns.each(five_prime, upstream=1, downstream=0)
+
+    # write to file or to stdout
+    if args.outfile:
+        clnts.saveas(args.outfile)
+    else:
+        tmptool = clnts.saveas()
+        logging.debug("results written to temporary file :" + tmptool.fn)
+        tmp = open(tmptool.fn)
+        for line in tmp:
+            stdout.write(line)
+        tmp.close()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+import argparse
+import logging
+from collections import Counter
+from bctools_extract import BarcodePattern
+from bctools_demux import SampleTable, AMBIGUOUS, UNASSIGNED, read_barcode_fasta, demultiplex_blocks
+from bctools_fastq import read_fastq_file_blocks
+from bctools_io import BatchedWriter, open_output, COMPRESSION_FORMATS
+# avoid ugly python IOError when stdout output is piped into another program
+# and then truncated (such as piping to head)
+from signal import signal, SIGPIPE, SIG_DFL
+signal(SIGPIPE, SIG_DFL)
+
+tool_description = """
+Demultiplex reads according to experimental barcodes.
+
+The experimental barcode is extracted from the reads according to a pattern as
+used by extract_bcs.py: X positions form the experimental barcode and are
+removed, N positions are kept and A, C, G and T positions are anchor
+sequences. The barcode is compared to the sample barcodes of a FASTA file such
+as RR_bcs.fa, allowing up to --mismatches mismatches. With --ry-space barcodes
+are compared in binary RY-space.
+
+Reads of each sample are written to <prefix><sample>.fastq. Reads matching
+barcodes of several samples equally well are written unchanged to
+<prefix>ambiguous.fastq, reads without matching barcode to
+<prefix>unassigned.fastq. The number of reads per sample is written to the
+file given by --stats.
+
+Input files may be gzip, bgzf or zstd compressed.
+
+Example usage:
+- assign reads by the RY-space barcode at positions 4 and 5, allowing no
+  mismatches:
+demultiplex_reads.py reads.fastq NNNXX RR_bcs.fa --ry-space --prefix demux_ --stats demux_stats.tsv
+"""
+
+
+class DefaultsRawDescriptionHelpFormatter(argparse.ArgumentDefaultsHelpFormatter,
+                                          argparse.RawDescriptionHelpFormatter):
+    # To join the behaviour of RawDescriptionHelpFormatter with that of ArgumentDefaultsHelpFormatter
+    pass
+
+
+def main():
+    # parse command line arguments
+    parser = argparse.ArgumentParser(description=tool_description,
+                                     formatter_class=DefaultsRawDescriptionHelpFormatter)
+    # positional arguments
+    parser.add_argument(
+        "infile",
+        help="Path to fastq file.")
+    parser.add_argument(
+        "pattern",
+        help="Pattern of experimental barcode nucleotides starting at 5'-end. X positions form the experimental barcode, N positions will be kept. A, C, G and T positions form anchor sequences that have to match the read and will be removed.")
+    parser.add_argument(
+        "barcodes",
+        help="Path to fasta file of sample barcodes. The first word of the header is used as sample name.")
+    # optional arguments
+    parser.add_argument(
+        "--mismatches",
+        type=int,
+        default=0,
+        help="Allow this many mismatches between experimental and sample barcodes.")
+    parser.add_argument(
+        "--ry-space",
+        dest="ry_space",
+        action="store_true",
+        help="Compare barcodes in binary RY-space.")
+    parser.add_argument(
+        "--prefix",
+        default="",
+        help="Prefix of output files.")
+    parser.add_argument(
+        "--stats",
+        help="Write the number of reads per sample to this file.")
+    parser.add_argument(
+        "--max-offset",
+        dest="max_offset",
+        type=int,
+        default=0,
+        help="Search the pattern up to this many nts downstream of the 5'-end. Requires an anchor sequence in the pattern.")
+    parser.add_argument(
+        "--anchor-mismatches",
+        dest="anchor_mismatches",
+        type=int,
+        default=0,
+        help="Allow this many mismatches in the anchor sequences of the pattern.")
+    parser.add_argument(
+        "-a", "--add-bc-to-fastq",
+        dest="add_to_head",
+        help="Append experimental barcodes to the FASTQ headers of assigned reads.",
+        action="store_true")
+    parser.add_argument(
+        "--compress",
+        choices=COMPRESSION_FORMATS,
+        help="Compress output files using this format.")
+    parser.add_argument(
+        "--compress-threads",
+        dest="compress_threads",
+        type=int,
+        default=1,
+        help="Number of threads used for compressing output.")
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="Process reads using this many worker processes. Output order is preserved.")
+    # misc arguments
+    parser.add_argument(
+        "-v", "--verbose",
+        help="Be verbose.",
+        action="store_true")
+    parser.add_argument(
+        "-d", "--debug",
+        help="Print lots of debugging information",
+        action="store_true")
+
+    args = parser.parse_args()
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG, format="%(asctime)s - %(filename)s - %(levelname)s - %(message)s")
+    elif args.verbose:
+        logging.basicConfig(level=logging.INFO, format="%(filename)s - %(levelname)s - %(message)s")
+    else:
+        logging.basicConfig(format="%(filename)s - %(levelname)s - %(message)s")
+    logging.info("Parsed arguments:")
+    logging.info("  infile: '{}'".format(args.infile))
+    logging.info("  pattern: '{}'".format(args.pattern))
+    logging.info("  barcodes: '{}'".format(args.barcodes))
+    logging.info("  mismatches: {}".format(args.mismatches))
+    logging.info("  ry-space: {}".format(args.ry_space))
+    logging.info("  prefix: '{}'".format(args.prefix))
+    logging.info("  stats: '{}'".format(args.stats))
+    if args.compress:
+        logging.info("  compress: writing {} compressed output using {} threads".format(args.compress, args.compress_threads))
+    logging.info("  threads: {}".format(args.threads))
+    logging.info("")
+
+    # check parameters
+    if args.threads < 1:
+        raise ValueError("Threads must be a positive integer, is '{}'.".format(args.threads))
+    pattern = BarcodePattern(args.pattern, args.max_offset, args.anchor_mismatches)
+    table = SampleTable(read_barcode_fasta(args.barcodes), args.mismatches, args.ry_space)
+    if table.length != len(pattern.barcode_index):
+        raise ValueError("Sample barcodes of length {} do not match the {} barcode positions of pattern '{}'.".format(
+            table.length, len(pattern.barcode_index), args.pattern))
+    logging.info("lookup table holds {} barcode sequences".format(len(table.table)))
+
+    # one output file per sample and bin, small per-chunk outputs are batched
+    bins = table.samples + [AMBIGUOUS, UNASSIGNED]
+    outfiles = dict((sample, BatchedWriter(open_output("{}{}.fastq".format(args.prefix, sample),
+                                                       args.compress, args.compress_threads)))
+                    for sample in bins)
+
+    counts = Counter()
+    blocks = read_fastq_file_blocks(args.infile)
+    for reads, chunk_counts in demultiplex_blocks(blocks, pattern, table, args.threads, args.add_to_head):
+        for sample, data in reads.items():
+            outfiles[sample].write(data)
+        counts.update(chunk_counts)
+
+    for out in outfiles.values():
+        out.close()
+
+    # report reads per sample
+    for sample in bins:
+        logging.info("{}: {} reads".format(sample, counts[sample]))
+    if args.stats is not None:
+        with open(args.stats, "w") as stats:
+            stats.write("sample\treads\n")
+            for sample in bins:
+                stats.write("{}\t{}\n".format(sample, counts[sample]))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,9 +2,11 @@
 
 import argparse
 import logging
-import re
-from sys import stdout
-from Bio.SeqIO.QualityIO import FastqGeneralIterator
+from bctools_extract import BarcodePattern, TOO_SHORT, NO_ANCHOR, process_blocks, process_paired_chunks
+from bctools_fastq import DEFAULT_CHUNK_SIZE, read_fastq_file_blocks, read_paired_fastq_chunks
+from bctools_bclib import BarcodeLibraryWriter
+from bctools_index import shard_offsets
+from bctools_io import open_output, COMPRESSION_FORMATS
 # avoid ugly python IOError when stdout output is piped into another program
 # and then truncated (such as piping to head)
 from signal import signal, SIGPIPE, SIG_DFL
@@ -13,161 +15,258 @@ signal(SIGPIPE, SIG_DFL)
 tool_description = """
 Exract barcodes from a FASTQ file according to a user-specified pattern. Starting from the 5'-end, positions marked by X will be moved into a separate FASTQ file. Positions marked bv N will be kept.
 
-By default output is written to stdout.
+Patterns may contain anchor sequences such as linkers (A, C, G, T) that have to match the read with at most --anchor-mismatches mismatches. Anchor positions are removed from the reads. With --max-offset the pattern is searched up to this many nts downstream of the 5'-end, for example to skip variable-length spacers. The nts in front of the pattern are removed. Reads without matching anchor are skipped and counted.
+
+By default output is written to stdout. Input files may be gzip, bgzf or zstd
+compressed.
 
 Example usage:
 - remove barcode nucleotides at positions 1-3 and 6-7 from FASTQ; write modified
   FASTQ entries to output.fastq and barcode nucleotides to barcodes.fa:
 fastq_extract_barcodes.py barcoded_input.fastq XXXNNXX --out output.fastq --bcs barcodes.fastq
+- extract barcodes from the first mate of paired reads and remove the
+  readthrough of 7 nts into the barcode from the second mate in a single pass:
+fastq_extract_barcodes.py R1.fastq XXXNNXX --paired R2.fastq --remove-tail 7 --out R1_out.fastq --paired-outfile R2_out.fastq --bcs barcodes.fastq
+- extract 6 nt barcode followed by linker TGAC that may be preceded by a spacer of
+  up to 3 nts, allowing one mismatch in the linker:
+fastq_extract_barcodes.py barcoded_input.fastq XXXXXXTGAC --max-offset 3 --anchor-mismatches 1 --out output.fastq --bcs barcodes.fastq
+- same as the first example, but write barcodes to a compact binary barcode
+  library for use with merge_pcr_duplicates.py:
+fastq_extract_barcodes.py barcoded_input.fastq XXXNNXX --out output.fastq --bcs barcodes.bclib --binary-barcodes
+- same as the first example, using 8 worker processes:
+fastq_extract_barcodes.py barcoded_input.fastq XXXNNXX --out output.fastq --bcs barcodes.fastq --threads 8
+- process the third of 10 shards of an uncompressed FASTQ file, e.g. as one of
+  10 cluster jobs; the outputs of all shards concatenated in order equal the
+  output of a single job (see index_fastq.py):
+fastq_extract_barcodes.py barcoded_input.fastq XXXNNXX --shard 3/10 --out output_3.fastq --bcs barcodes_3.fastq
+- read compressed input and write bgzf compressed output using 4 compression
+  threads:
+fastq_extract_barcodes.py barcoded_input.fastq.gz XXXNNXX --out output.fastq.gz --bcs barcodes.fastq.gz --compress bgzf --compress-threads 4
 """
 
-# parse command line arguments
-parser = argparse.ArgumentParser(description=tool_description,
-                                 formatter_class=argparse.RawDescriptionHelpFormatter)
-# positional arguments
-parser.add_argument(
-    "infile",
-    help="Path to fastq file.")
-parser.add_argument(
-    "pattern",
-    help="Pattern of barcode nucleotides starting at 5'-end. X positions will be moved to the header, N positions will be kept.")
-# optional arguments
-parser.add_argument(
-    "-o", "--outfile",
-    help="Write results to this file.")
-parser.add_argument(
-    "-b", "--bcs",
-    dest="out_bc_fasta",
-    help="Write barcodes to this file in FASTQ format.")
-parser.add_argument(
-    "--fasta-barcodes",
-    dest="save_bcs_as_fa",
-    action="store_true",
-    help="Save extracted barcodes in FASTA format.")
-parser.add_argument(
-    "-a", "--add-bc-to-fastq",
-    dest="add_to_head",
-    help="Append extracted barcodes to the FASTQ headers.",
-    action="store_true")
-parser.add_argument(
-    "-v", "--verbose",
-    help="Be verbose.",
-    action="store_true")
-parser.add_argument(
-    "-d", "--debug",
-    help="Print lots of debugging information",
-    action="store_true")
-
-args = parser.parse_args()
-if args.debug:
-    logging.basicConfig(level=logging.DEBUG, format="%(asctime)s - %(filename)s - %(levelname)s - %(message)s")
-elif args.verbose:
-    logging.basicConfig(level=logging.INFO, format="%(filename)s - %(levelname)s - %(message)s")
-else:
-    logging.basicConfig(format="%(filename)s - %(levelname)s - %(message)s")
-logging.info("Parsed arguments:")
-logging.info("  infile: '{}'".format(args.infile))
-logging.info("  pattern: '{}'".format(args.pattern))
-if args.outfile:
-    logging.info("  outfile: enabled writing to file")
-    logging.info("  outfile: '{}'".format(args.outfile))
-if args.out_bc_fasta:
-    logging.info("  bcs: enabled writing barcodes to fastq file")
-    logging.info("  bcs: {}".format(args.out_bc_fasta))
-if args.save_bcs_as_fa:
-    logging.info("  fasta-barcodes: write barcodes in fasta format instead of fastq")
-logging.info("")
-
-# check if supplied pattern is valid
-valid_pattern = re.compile("^[XN]+$")
-pattern_match = valid_pattern.match(args.pattern)
-if pattern_match is None:
-    raise ValueError("Error: supplied pattern '{}' is not valid.".format(args.pattern))
-
-# check if at least one barcode position is included in the pattern
-has_bcpos_pattern = re.compile("X")
-pattern_match = has_bcpos_pattern.search(args.pattern)
-if pattern_match is None:
-    raise ValueError("Error: supplied pattern '{}' does not contain a barcode position 'X'.".format(args.pattern))
-
-logging.info("Barcode pattern analysis:")
-# get X positions of pattern string
-barcode_nt_pattern = re.compile("X+")
-barcode_positions = []
-for m in re.finditer(barcode_nt_pattern, args.pattern):
-    logging.info('  found barcode positions in pattern: %02d-%02d: %s' % (m.start(), m.end(), m.group(0)))
-    barcode_positions.append((m.start(), m.end()))
-logging.info("  barcode positions: {}".format(barcode_positions))
-# get last position of a barcode nt in the pattern
-# reads must be long enough for all
-min_readlen = barcode_positions[-1][-1]
-logging.info("  last position of a barcode nt in pattern: {}".format(min_readlen))
-logging.info("")
-
-# get coordinates of nucleotides to keep
-# the tail after the last barcode nt is handled separately
-seq_positions = []
-last_seq_start = 0
-for bcstart, bcstop in barcode_positions:
-    seq_positions.append((last_seq_start, bcstart))
-    last_seq_start = bcstop
-logging.info("  sequence positions: {}".format(seq_positions))
-logging.info("  start of sequence tail: {}".format(last_seq_start))
-
-samout = (open(args.outfile, "w") if args.outfile is not None else stdout)
-if args.out_bc_fasta is not None:
-    faout = open(args.out_bc_fasta, "w")
-for header, seq, qual in FastqGeneralIterator(open(args.infile)):
-
-    # skip reads that are too short to extract the full requested barcode
-    if len(seq) < min_readlen:
-        logging.warning("skipping read '{}', is too short to extract the full requested barcode".format(header))
-        logging.debug("seq: {}".format(seq))
-        logging.debug("len(seq): {}".format(len(seq)))
-        continue
-
-    # extract barcode nucleotides
-    barcode_list = []
-    barcode_qual_list = []
-    for bcstart, bcstop in barcode_positions:
-        barcode_list.append(seq[bcstart:bcstop])
-        barcode_qual_list.append(qual[bcstart:bcstop])
-    barcode = "".join(barcode_list)
-    barcode_quals = "".join(barcode_qual_list)
-    logging.debug("extracted barcode: {}".format(barcode))
-
-    # create new sequence and quality string without barcode nucleotides
-    new_seq_list = []
-    new_qual_list = []
-    for seqstart, seqstop in seq_positions:
-        new_seq_list.append(seq[seqstart:seqstop])
-        new_qual_list.append(qual[seqstart:seqstop])
-    new_seq_list.append(seq[last_seq_start:])
-    new_qual_list.append(qual[last_seq_start:])
-    new_seq = "".join(new_seq_list)
-    new_qual = "".join(new_qual_list)
-    # check if at least one nucleotide is left. having none would break fastq
-    if len(new_seq) == 0:
-        logging.warning("skipping read '{}', no sequence remains after barcode extraction".format(header))
-        logging.debug("seq: {}".format(seq))
-        logging.debug("len(seq): {}".format(len(seq)))
-        continue
-
-    # write barcode nucleotides into header
-    if args.add_to_head:
-        annotated_header = " ".join([header, barcode])
+
+def main():
+    # parse command line arguments
+    parser = argparse.ArgumentParser(description=tool_description,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    # positional arguments
+    parser.add_argument(
+        "infile",
+        help="Path to fastq file.")
+    parser.add_argument(
+        "pattern",
+        help="Pattern of barcode nucleotides starting at 5'-end. X positions will be moved to the header, N positions will be kept. A, C, G and T positions form anchor sequences that have to match the read and will be removed.")
+    # optional arguments
+    parser.add_argument(
+        "--max-offset",
+        dest="max_offset",
+        type=int,
+        default=0,
+        help="Search the pattern up to this many nts downstream of the 5'-end. Requires an anchor sequence in the pattern, nts in front of the pattern are removed.")
+    parser.add_argument(
+        "--anchor-mismatches",
+        dest="anchor_mismatches",
+        type=int,
+        default=0,
+        help="Allow this many mismatches in the anchor sequences of the pattern.")
+    parser.add_argument(
+        "-o", "--outfile",
+        help="Write results to this file.")
+    parser.add_argument(
+        "--paired",
+        dest="mate2",
+        help="Path to fastq file of the second mate. Enables paired-end mode: infile holds the first mate, both files are processed in lockstep.")
+    parser.add_argument(
+        "--paired-outfile",
+        dest="mate2_outfile",
+        help="Write results for the second mate to this file (paired-end mode).")
+    parser.add_argument(
+        "--barcode-mate",
+        dest="barcode_mate",
+        type=int,
+        choices=[1, 2],
+        default=1,
+        help="Extract barcodes from this mate (paired-end mode).")
+    parser.add_argument(
+        "--remove-tail",
+        dest="tail_length",
+        type=int,
+        help="Remove this many nts from the 3'-end of the mate without barcode (paired-end mode).")
+    parser.add_argument(
+        "-b", "--bcs",
+        dest="out_bc_fasta",
+        help="Write barcodes to this file in FASTQ format.")
+    parser.add_argument(
+        "--fasta-barcodes",
+        dest="save_bcs_as_fa",
+        action="store_true",
+        help="Save extracted barcodes in FASTA format.")
+    parser.add_argument(
+        "--binary-barcodes",
+        dest="save_bcs_as_binary",
+        action="store_true",
+        help="Save extracted barcodes as compact binary barcode library.")
+    parser.add_argument(
+        "-a", "--add-bc-to-fastq",
+        dest="add_to_head",
+        help="Append extracted barcodes to the FASTQ headers.",
+        action="store_true")
+    parser.add_argument(
+        "--compress",
+        choices=COMPRESSION_FORMATS,
+        help="Compress output files using this format.")
+    parser.add_argument(
+        "--compress-threads",
+        dest="compress_threads",
+        type=int,
+        default=1,
+        help="Number of threads used for compressing output.")
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="Extract barcodes using this many worker processes. Output order is preserved.")
+    parser.add_argument(
+        "--chunk-size",
+        dest="chunk_size",
+        type=int,
+        default=DEFAULT_CHUNK_SIZE,
+        help="Read the input in blocks of about this many bytes, each processed as one job by the worker processes.")
+    parser.add_argument(
+        "--shard",
+        help="Only process shard i/N of the uncompressed input file(s), counting from 1. Uses the index built by index_fastq.py if present.")
+    parser.add_argument(
+        "-v", "--verbose",
+        help="Be verbose.",
+        action="store_true")
+    parser.add_argument(
+        "-d", "--debug",
+        help="Print lots of debugging information",
+        action="store_true")
+
+    args = parser.parse_args()
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG, format="%(asctime)s - %(filename)s - %(levelname)s - %(message)s")
+    elif args.verbose:
+        logging.basicConfig(level=logging.INFO, format="%(filename)s - %(levelname)s - %(message)s")
+    else:
+        logging.basicConfig(format="%(filename)s - %(levelname)s - %(message)s")
+    logging.info("Parsed arguments:")
+    logging.info("  infile: '{}'".format(args.infile))
+    logging.info("  pattern: '{}'".format(args.pattern))
+    logging.info("  max-offset: {}".format(args.max_offset))
+    logging.info("  anchor-mismatches: {}".format(args.anchor_mismatches))
+    if args.outfile:
+        logging.info("  outfile: enabled writing to file")
+        logging.info("  outfile: '{}'".format(args.outfile))
+    if args.out_bc_fasta:
+        logging.info("  bcs: enabled writing barcodes to fastq file")
+        logging.info("  bcs: {}".format(args.out_bc_fasta))
+    if args.save_bcs_as_fa:
+        logging.info("  fasta-barcodes: write barcodes in fasta format instead of fastq")
+    if args.save_bcs_as_binary:
+        logging.info("  binary-barcodes: write barcodes as binary barcode library")
+    if args.mate2:
+        logging.info("  paired: enabled paired-end mode")
+        logging.info("  paired: '{}'".format(args.mate2))
+        logging.info("  paired-outfile: '{}'".format(args.mate2_outfile))
+        logging.info("  barcode-mate: {}".format(args.barcode_mate))
+        logging.info("  remove-tail: {}".format(args.tail_length))
+    if args.compress:
+        logging.info("  compress: writing {} compressed output using {} threads".format(args.compress, args.compress_threads))
+    logging.info("  threads: {}".format(args.threads))
+    logging.info("  chunk-size: {}".format(args.chunk_size))
+    if args.shard:
+        logging.info("  shard: {}".format(args.shard))
+    logging.info("")
+
+    # check threads parameter
+    if args.threads < 1:
+        raise ValueError("Threads must be a positive integer, is '{}'.".format(args.threads))
+    if args.chunk_size < 1:
+        raise ValueError("Chunk size must be a positive integer, is '{}'.".format(args.chunk_size))
+
+    # check paired-end parameters
+    if args.mate2 is None and (args.mate2_outfile is not None or args.tail_length is not None):
+        raise ValueError("Options --paired-outfile and --remove-tail require paired-end mode (--paired).")
+    if args.mate2 is not None and args.mate2_outfile is None:
+        raise ValueError("Paired-end mode requires an output file for the second mate (--paired-outfile).")
+    if args.tail_length is not None and args.tail_length < 0:
+        raise ValueError("Length must be a positive integer, is '{}'.".format(args.tail_length))
+
+    # check barcode library parameters
+    if args.save_bcs_as_binary and (args.out_bc_fasta is None or args.save_bcs_as_fa):
+        raise ValueError("Option --binary-barcodes requires --bcs and excludes --fasta-barcodes.")
+    if args.save_bcs_as_binary and args.shard is not None:
+        raise ValueError("Binary barcode libraries can not be written in shards.")
+
+    # check if supplied pattern is valid
+    pattern = BarcodePattern(args.pattern, args.max_offset, args.anchor_mismatches)
+
+    logging.info("Barcode pattern analysis:")
+    for bcstart, bcstop in pattern.barcode_positions:
+        logging.info('  found barcode positions in pattern: %02d-%02d: %s' % (bcstart, bcstop, args.pattern[bcstart:bcstop]))
+    logging.info("  barcode positions: {}".format(pattern.barcode_positions))
+    logging.info("  anchor positions: {}".format(pattern.anchor_positions))
+    logging.info("  last position of a barcode or anchor nt in pattern: {}".format(pattern.min_readlen))
+    logging.info("")
+    logging.info("  sequence positions: {}".format(pattern.seq_positions))
+    logging.info("  start of sequence tail: {}".format(pattern.last_seq_start))
+
+    samout = open_output(args.outfile, args.compress, args.compress_threads)
+    if args.save_bcs_as_binary:
+        faout = BarcodeLibraryWriter(args.out_bc_fasta)
+    elif args.out_bc_fasta is not None:
+        faout = open_output(args.out_bc_fasta, args.compress, args.compress_threads)
+    options = dict(add_to_head=args.add_to_head,
+                   fasta_barcodes=args.save_bcs_as_fa,
+                   nt_library=args.out_bc_fasta is not None and not args.save_bcs_as_binary,
+                   binary_library=args.save_bcs_as_binary)
+    if args.mate2 is not None:
+        mate2out = open_output(args.mate2_outfile, args.compress, args.compress_threads)
+        ranges = shard_offsets([args.infile, args.mate2], args.shard) if args.shard is not None else None
+        chunks = read_paired_fastq_chunks(args.infile, args.mate2, args.chunk_size, ranges)
+        results = process_paired_chunks(chunks, pattern, args.threads, barcode_mate=args.barcode_mate,
+                                        tail_length=args.tail_length, **options)
     else:
-        annotated_header = header
-    samout.write("@%s\n%s\n+\n%s\n" % (annotated_header, new_seq, new_qual))
+        start, stop = shard_offsets([args.infile], args.shard)[0] if args.shard is not None else (0, None)
+        blocks = read_fastq_file_blocks(args.infile, args.chunk_size, start, stop)
+        results = process_blocks(blocks, pattern, args.threads, **options)
+    n_no_anchor = 0
+    for result in results:
+        for header, seq, reason in result.skipped:
+            if reason == NO_ANCHOR:
+                # reads without anchor are reported in summary
+                n_no_anchor += 1
+                continue
+            if reason == TOO_SHORT:
+                # skip reads that are too short to extract the full requested barcode
+                logging.warning("skipping read '{}', is too short to extract the full requested barcode".format(header.decode()))
+            else:
+                # at least one nucleotide has to be left. having none would break fastq
+                logging.warning("skipping read '{}', no sequence remains after barcode extraction".format(header.decode()))
+            logging.debug("seq: {}".format(seq.decode()))
+            logging.debug("len(seq): {}".format(len(seq)))
+
+        samout.write(result.reads)
+        if args.mate2 is not None:
+            mate2out.write(result.mate_reads)
+        # write barcodes to fasta if requested
+        if args.save_bcs_as_binary:
+            faout.add(*result.library_entries)
+        elif args.out_bc_fasta is not None:
+            faout.write(result.barcodes)
 
-    # write barcode to fasta if requested
+    if n_no_anchor:
+        logging.warning("skipped {} reads, no anchor sequence found".format(n_no_anchor))
+
+    # close files
+    samout.close()
+    if args.mate2 is not None:
+        mate2out.close()
     if args.out_bc_fasta is not None:
-        if args.save_bcs_as_fa:
-            faout.write(">{}\n{}\n".format(header, barcode))
-        else:
-            faout.write("@{}\n{}\n+\n{}\n".format(header, barcode, barcode_quals))
-
-# close files
-samout.close()
-if args.out_bc_fasta is not None:
-    faout.close()
+        faout.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+import argparse
+import logging
+from bctools_index import INDEX_SUFFIX, DEFAULT_INTERVAL, build_index, write_index
+
+tool_description = """
+Index the record offsets of a FASTQ file.
+
+The byte offset of every --interval-th record is written to a file next to the
+FASTQ file with suffix {}. extract_bcs.py, remove_tail.py and
+convert_bc_to_binary_RY.py use the index to process a part of the file with
+--shard i/N. Concatenating the outputs of shards 1/N to N/N in order gives the
+output of processing the whole file.
+
+Only uncompressed FASTQ files can be indexed.
+
+Example usage:
+- index reads.fastq and process the second of four shards:
+index_fastq.py reads.fastq
+extract_bcs.py reads.fastq XXXNNXX --shard 2/4 --out out_2.fastq --bcs bcs_2.fastq
+""".format(INDEX_SUFFIX)
+
+
+class DefaultsRawDescriptionHelpFormatter(argparse.ArgumentDefaultsHelpFormatter,
+                                          argparse.RawDescriptionHelpFormatter):
+    # To join the behaviour of RawDescriptionHelpFormatter with that of ArgumentDefaultsHelpFormatter
+    pass
+
+
+def main():
+    # parse command line arguments
+    parser = argparse.ArgumentParser(description=tool_description,
+                                     formatter_class=DefaultsRawDescriptionHelpFormatter)
+    # positional arguments
+    parser.add_argument(
+        "infile",
+        help="Path to uncompressed fastq file.")
+    # optional arguments
+    parser.add_argument(
+        "--interval",
+        type=int,
+        default=DEFAULT_INTERVAL,
+        help="Record the offset of every this many reads.")
+    parser.add_argument(
+        "-o", "--outfile",
+        help="Write index to this file instead of infile{}.".format(INDEX_SUFFIX))
+    # misc arguments
+    parser.add_argument(
+        "-v", "--verbose",
+        help="Be verbose.",
+        action="store_true")
+    parser.add_argument(
+        "-d", "--debug",
+        help="Print lots of debugging information",
+        action="store_true")
+
+    args = parser.parse_args()
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG, format="%(asctime)s - %(filename)s - %(levelname)s - %(message)s")
+    elif args.verbose:
+        logging.basicConfig(level=logging.INFO, format="%(filename)s - %(levelname)s - %(message)s")
+    else:
+        logging.basicConfig(format="%(filename)s - %(levelname)s - %(message)s")
+    logging.info("Parsed arguments:")
+    logging.info("  infile: '{}'".format(args.infile))
+    logging.info("  interval: {}".format(args.interval))
+    logging.info("  outfile: '{}'".format(args.outfile))
+    logging.info("")
+
+    index = build_index(args.infile, args.interval)
+    write_index(index, args.outfile if args.outfile is not None else args.infile + INDEX_SUFFIX)
+    logging.info("indexed {} reads at {} offsets".format(index[-1][0], len(index) - 1))
+
+
+if __name__ == "__main__":
+    main()
@@ -7,11 +7,18 @@ from subprocess import check_call
 from shutil import rmtree
 from tempfile import mkdtemp
 from os.path import isfile
+from itertools import islice
+from bctools_bclib import BarcodeLibrary, is_binary_library
+from bctools_codec import BarcodeCodec, BARCODE_SPACES, NT_SPACE
+from bctools_metrics import MergeMetrics
+from bctools_merge import BarcodeKeys, library_batches, read_bam_batches, merge_duplicates, merge_duplicates_parallel, merge_presorted, parse_memory
 # avoid ugly python IOError when stdout output is piped into another program
 # and then truncated (such as piping to head)
 from signal import signal, SIGPIPE, SIG_DFL
 signal(SIGPIPE, SIG_DFL)
 
+ENGINES = ("native", "pipeline")
+
 tool_description = """
 Merge PCR duplicates according to random barcode library. All alignments with
 same outer coordinates and barcode will be merged into a single crosslinking
@@ -19,9 +26,64 @@ event.
 
 Barcodes containing uncalled base 'N' are removed.
 
+With --barcode-space ry, nucleotide barcodes are translated to binary RY-space
+while reading the library and alignments are merged by RY-space barcode. This
+gives the same result as merging with a library converted by
+convert_bc_to_binary_RY.py. Barcodes are grouped as bit-packed integer keys.
+
+By default duplicates are merged in-process: the barcode library is loaded
+into memory and alignments are counted in a hash table. With --engine
+pipeline the previous awk/sort/join/datamash pipeline is used, which requires
+GNU coreutils and datamash. Both engines produce identical output.
+
+With --max-memory, merged events exceeding the given amount of memory are
+sorted and written to compressed temporary files in --tmpdir, which are merged
+at the end. The memory of the merged events is estimated from the sizes of
+the events counted. The limit applies to the table of merged events only, the
+barcode library is held in memory in addition. Memory use then does not grow
+with the number of alignments.
+
+With --presorted, alignments sorted by chrom and start (e.g. by sort -k1,1
+-k2,2n) are merged as they are read and the events of each position are
+written as soon as the position is complete. Positions are written in input
+order, events of a position sorted by stop, strand and read id.
+
+With --umi-mismatches K, barcodes that arose from sequencing errors are
+merged as well: at each position, a barcode is merged into a barcode that
+differs in at most K positions and has at least about twice the count
+(directional method of UMI-tools). The merged event has the total count and
+the smallest read id.
+
+With --threads, alignments are distributed to partitions by chrom and strand,
+which are merged by worker processes. The output is identical to that of a
+single process.
+
+With --metrics, duplication metrics are computed while merging: the number of
+alignments, of alignments without barcode and with barcodes containing N, the
+histograms of duplicates per event and of distinct barcodes per position and
+the library size estimated as by Picard EstimateLibraryComplexity.
+Counting distinct barcodes per position requires a table of all positions,
+except with --presorted, where each position is counted once it is complete.
+--metrics therefore can not be combined with --max-memory.
+
+With --spurious-threshold F, spurious events are removed from the merged
+events as by rm_spurious_events.py --threshold F: among events sharing
+coordinates and strand, events supported by less than F times the maximum
+number of PCR duplicates are removed. The output is identical to that of
+rm_spurious_events.py run on the merged events (with --presorted if merging
+with --presorted), without writing and sorting the merged events again.
+Metrics are computed before the removal of spurious events.
+
 Input:
 * bed6 file containing alignments with fastq read-id in name field
-* fastq library of random barcodes
+* fastq library of random barcodes or binary barcode library as written by
+  extract_bcs.py --binary-barcodes
+
+or:
+* paired-end alignments in SAM or BAM format with barcodes in a SAM tag
+  (--barcode-tag) or appended to the read names (--barcode-separator). The
+  outer coordinates of the fragments are determined as by extract_aln_ends.py
+  and no barcode library is required. Requires pysam.
 
 Output:
 * bed6 file with a read id from a representative alignment in the name field and
@@ -32,82 +94,265 @@ Example usage:
 - read PCR duplicates from file duplicates.bed and write merged results to file
   merged.bed:
 merge_pcr_duplicates.py duplicates.bed bclibrary.fa --outfile merged.bed
+- merge PCR duplicates by binary RY-space barcodes of a nucleotide barcode
+  library:
+merge_pcr_duplicates.py duplicates.bed bclibrary.fastq --barcode-space ry --outfile merged.bed
+- merge PCR duplicates of paired-end alignments with barcodes in SAM tag RX:
+merge_pcr_duplicates.py alignments.bam --barcode-tag RX --outfile merged.bed
 """
 
-# parse command line arguments
-parser = argparse.ArgumentParser(description=tool_description,
-                                 formatter_class=argparse.RawDescriptionHelpFormatter)
-# positional arguments
-parser.add_argument(
-    "alignments",
-    help="Path to bed6 file containing alignments.")
-parser.add_argument(
-    "bclib",
-    help="Path to fastq barcode library.")
-# optional arguments
-parser.add_argument(
-    "-o", "--outfile",
-    required=True,
-    help="Write results to this file.")
-# misc arguments
-parser.add_argument(
-    "-v", "--verbose",
-    help="Be verbose.",
-    action="store_true")
-parser.add_argument(
-    "-d", "--debug",
-    help="Print lots of debugging information",
-    action="store_true")
-
-args = parser.parse_args()
-
-if args.debug:
-    logging.basicConfig(level=logging.DEBUG, format="%(asctime)s - %(filename)s - %(levelname)s - %(message)s")
-elif args.verbose:
-    logging.basicConfig(level=logging.INFO, format="%(filename)s - %(levelname)s - %(message)s")
-else:
-    logging.basicConfig(format="%(filename)s - %(levelname)s - %(message)s")
-logging.info("Parsed arguments:")
-logging.info("  alignments: '{}'".format(args.alignments))
-logging.info("  bclib: '{}'".format(args.bclib))
-if args.outfile:
-    logging.info("  outfile: enabled writing to file")
-    logging.info("  outfile: '{}'".format(args.outfile))
-logging.info("")
-
-# see if alignments are empty and the tool can quit
-n_alns = sum(1 for line in open(args.alignments))
-if n_alns == 0:
-    logging.warning("WARNING: Working on empty set of alignments, writing empty output.")
-    eventalnout = (open(args.outfile, "w") if args.outfile is not None else stdout)
-    eventalnout.close()
-    exit(0)
-
-# check input filenames
-if not isfile(args.bclib):
-    raise Exception("ERROR: barcode library '{}' not found.")
-if not isfile(args.alignments):
-    raise Exception("ERROR: alignments '{}' not found.")
-
-try:
-    tmpdir = mkdtemp()
-    logging.debug("tmpdir: " + tmpdir)
-
-    # prepare alinments
-    syscall2 = "cat " + args.alignments + " | awk -F \"\\t\" 'BEGIN{OFS=\"\\t\"}{split($4, a, \" \"); $4 = a[1]; print}'| sort --compress-program=gzip -k4,4 > " + tmpdir + "/alns.csv"
-    check_call(syscall2, shell=True)
-
-    # join barcode library and alignments
-    # after join: id, bc, chr, start, stop, mapscore, strand
-    # after datamash: bc, chr, start, stop, strand, ndupes, idrepresentative
-    syscall3 = "cat " + \
-        args.bclib + \
-        " | awk 'BEGIN{OFS=\"\\t\"}NR%4==1{gsub(/^@/,\"\"); id=$1}NR%4==2{bc=$1}NR%4==3{print id,bc}' " + \
-        " | sort --compress-program=gzip -k1,1 | join -1 1 -2 4 - " + tmpdir + "/alns.csv " + \
-        " | awk 'BEGIN{OFS=\"\\t\"}$2!~/N/{print $1,$2,$3,$4,$5,$6,$7}' " + \
-        " | datamash --sort -g 2,3,4,5,7 count 2 first 1 " + \
-        " | awk 'BEGIN{OFS=\"\\t\"}{print $2,$3,$4,$7,$6,$5}' > " + args.outfile
-    check_call(syscall3, shell=True)
-finally:
-    logging.debug("removed tmpdir: " + tmpdir)
-    rmtree(tmpdir)
+
+def join_binary_library(alignments_fn, bclib_fn, out_fn, batch_size=100000):
+    """Join alignments sorted by read id with a binary barcode library.
+
+    Writes the same fields as joining a text barcode library with join:
+    id, bc, chr, start, stop, mapscore, strand. Alignments without library
+    entry are dropped.
+    """
+    library = BarcodeLibrary(bclib_fn)
+    with open(alignments_fn, "rb") as alns, open(out_fn, "wb") as out:
+        while True:
+            fields = [line.rstrip(b"\n").split(b"\t") for line in islice(alns, batch_size)]
+            if not fields:
+                break
+            barcodes = library.lookup([f[3] for f in fields])
+            out.write(b"".join([b" ".join([f[3], bc, f[0], f[1], f[2]] + f[4:]) + b"\n"
+                                for f, bc in zip(fields, barcodes) if bc is not None]))
+    library.close()
+
+
+def join_packed_library(alignments_fn, library, out_fn, batch_size=100000):
+    """Join alignments with a BarcodeKeys library using packed barcodes.
+
+    Writes the fields of join_binary_library with the barcode replaced by its
+    packed key in fixed-width hexadecimal notation, so keys sort like the
+    barcodes. Alignments without library entry and barcodes that can not be
+    packed are dropped.
+    """
+    codec = library.codec
+    key_width = -(-(codec.max_length * codec.bits + 1) // 4)
+    with open(alignments_fn, "rb") as alns, open(out_fn, "wb") as out:
+        while True:
+            fields = [line.rstrip(b"\n").split(b"\t") for line in islice(alns, batch_size)]
+            if not fields:
+                break
+            keys = library.lookup([f[3] for f in fields])
+            out.write(b"".join([b" ".join([f[3], b"%0*x" % (key_width, key), f[0], f[1], f[2]] + f[4:]) + b"\n"
+                                for f, key in zip(fields, keys) if key is not None]))
+
+
+def main():
+    # parse command line arguments
+    parser = argparse.ArgumentParser(description=tool_description,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    # positional arguments
+    parser.add_argument(
+        "alignments",
+        help="Path to bed6 file containing alignments, or to paired-end alignments in SAM or BAM format with --barcode-tag or --barcode-separator.")
+    parser.add_argument(
+        "bclib",
+        nargs="?",
+        help="Path to fastq or binary barcode library. Not used with --barcode-tag or --barcode-separator.")
+    # optional arguments
+    parser.add_argument(
+        "-o", "--outfile",
+        required=True,
+        help="Write results to this file.")
+    parser.add_argument(
+        "--barcode-space",
+        dest="barcode_space",
+        choices=BARCODE_SPACES,
+        default=NT_SPACE,
+        help="Merge by nucleotide barcodes or by barcodes translated to binary RY-space.")
+    parser.add_argument(
+        "--umi-mismatches",
+        dest="umi_mismatches",
+        type=int,
+        default=0,
+        help="Merge barcodes of the same position that differ in up to this many positions, using the directional method of UMI-tools. By default only identical barcodes are merged.")
+    parser.add_argument(
+        "--engine",
+        choices=ENGINES,
+        default="native",
+        help="Merge duplicates in-process (native) or using external programs (pipeline).")
+    parser.add_argument(
+        "--max-memory",
+        dest="max_memory",
+        help="Use about this much memory for the table of merged events, e.g. 500M or 2G. Sorted runs of merged events exceeding this limit are written to temporary files. The barcode library is not included in this limit.")
+    parser.add_argument(
+        "--presorted",
+        action="store_true",
+        help="Alignments are sorted by chrom and start. Merge them one position at a time.")
+    parser.add_argument(
+        "--barcode-tag",
+        dest="barcode_tag",
+        help="Read paired-end alignments in SAM or BAM format and take barcodes from this SAM tag, e.g. RX.")
+    parser.add_argument(
+        "--barcode-separator",
+        dest="barcode_separator",
+        help="Read paired-end alignments in SAM or BAM format and take barcodes from the read names, following the last occurrence of this separator.")
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="Merge duplicates using this many worker processes. Alignments are partitioned by chrom and strand, the output is identical to that of a single process.")
+    parser.add_argument(
+        "--metrics",
+        help="Write duplication and library complexity metrics to this file, in JSON format if the file name ends with .json and as TSV otherwise.")
+    parser.add_argument(
+        "--spurious-threshold",
+        dest="spurious_threshold",
+        type=float,
+        help="Remove spurious events supported by less than this fraction of the maximum number of PCR duplicates of events with the same coordinates, as by rm_spurious_events.py. By default no events are removed.")
+    parser.add_argument(
+        "--tmpdir",
+        help="Write temporary files to this directory. By default the system temporary directory is used.")
+    # misc arguments
+    parser.add_argument(
+        "-v", "--verbose",
+        help="Be verbose.",
+        action="store_true")
+    parser.add_argument(
+        "-d", "--debug",
+        help="Print lots of debugging information",
+        action="store_true")
+
+    args = parser.parse_args()
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG, format="%(asctime)s - %(filename)s - %(levelname)s - %(message)s")
+    elif args.verbose:
+        logging.basicConfig(level=logging.INFO, format="%(filename)s - %(levelname)s - %(message)s")
+    else:
+        logging.basicConfig(format="%(filename)s - %(levelname)s - %(message)s")
+    logging.info("Parsed arguments:")
+    logging.info("  alignments: '{}'".format(args.alignments))
+    logging.info("  bclib: '{}'".format(args.bclib))
+    logging.info("  barcode-space: {}".format(args.barcode_space))
+    logging.info("  umi-mismatches: {}".format(args.umi_mismatches))
+    logging.info("  engine: {}".format(args.engine))
+    logging.info("  max-memory: {}".format(args.max_memory))
+    logging.info("  tmpdir: '{}'".format(args.tmpdir))
+    logging.info("  presorted: {}".format(args.presorted))
+    logging.info("  threads: {}".format(args.threads))
+    logging.info("  metrics: '{}'".format(args.metrics))
+    logging.info("  spurious-threshold: {}".format(args.spurious_threshold))
+    logging.info("  barcode-tag: {}".format(args.barcode_tag))
+    logging.info("  barcode-separator: {}".format(args.barcode_separator))
+    if args.outfile:
+        logging.info("  outfile: enabled writing to file")
+        logging.info("  outfile: '{}'".format(args.outfile))
+    logging.info("")
+
+    max_memory = parse_memory(args.max_memory) if args.max_memory is not None else None
+    if args.presorted and (args.engine != "native" or max_memory is not None):
+        raise ValueError("Option --presorted requires the native engine and can not be combined with --max-memory.")
+    if args.threads < 1:
+        raise ValueError("Threads must be a positive integer, is '{}'.".format(args.threads))
+    if args.threads > 1 and (args.engine != "native" or args.presorted or args.barcode_tag is not None or args.barcode_separator is not None):
+        raise ValueError("Option --threads requires the native engine and bed6 input and can not be combined with --presorted.")
+    if args.metrics is not None and (args.engine != "native" or max_memory is not None):
+        raise ValueError("Option --metrics requires the native engine and can not be combined with --max-memory.")
+    if args.umi_mismatches < 0:
+        raise ValueError("Number of mismatches must not be negative, is '{}'.".format(args.umi_mismatches))
+    if args.umi_mismatches and (args.engine != "native" or max_memory is not None):
+        raise ValueError("Option --umi-mismatches requires the native engine and can not be combined with --max-memory.")
+    if args.spurious_threshold is not None:
+        if args.spurious_threshold < 0 or args.spurious_threshold > 1:
+            raise ValueError("Threshold must be in [0,1].")
+        if args.engine != "native" or max_memory is not None:
+            raise ValueError("Option --spurious-threshold requires the native engine and can not be combined with --max-memory.")
+    bam_input = args.barcode_tag is not None or args.barcode_separator is not None
+    if bam_input:
+        if args.barcode_tag is not None and args.barcode_separator is not None:
+            raise ValueError("Options --barcode-tag and --barcode-separator can not be combined.")
+        if args.bclib is not None:
+            raise ValueError("Barcodes are taken from the alignments, a barcode library can not be used with --barcode-tag or --barcode-separator.")
+        if args.engine != "native" or args.presorted:
+            raise ValueError("SAM and BAM input requires the native engine and can not be combined with --presorted.")
+    elif args.bclib is None:
+        raise ValueError("A barcode library is required for merging bed6 alignments.")
+
+    # see if alignments are empty and the tool can quit
+    n_alns = sum(1 for line in open(args.alignments, "rb")) if not bam_input else None
+    if n_alns == 0:
+        logging.warning("WARNING: Working on empty set of alignments, writing empty output.")
+        eventalnout = (open(args.outfile, "w") if args.outfile is not None else stdout)
+        eventalnout.close()
+        if args.metrics is not None:
+            MergeMetrics().write(args.metrics)
+        return
+
+    # check input filenames
+    if args.bclib is not None and not isfile(args.bclib):
+        raise Exception("ERROR: barcode library '{}' not found.")
+    if not isfile(args.alignments):
+        raise Exception("ERROR: alignments '{}' not found.")
+
+    codec = BarcodeCodec(args.barcode_space)
+    metrics = MergeMetrics() if args.metrics is not None else None
+    if bam_input:
+        batches = read_bam_batches(args.alignments, codec, args.barcode_tag, args.barcode_separator, metrics)
+        with open(args.outfile, "wb") as out:
+            merge_duplicates(batches, codec, out, max_memory, args.tmpdir, args.umi_mismatches, metrics, args.spurious_threshold)
+    elif args.engine == "native" and args.threads > 1:
+        # worker processes open the barcode library themselves
+        with open(args.outfile, "wb") as out:
+            merge_duplicates_parallel(args.alignments, args.bclib, codec, out, args.threads, max_memory, args.tmpdir, args.umi_mismatches,
+                                      metrics, args.spurious_threshold)
+    elif args.engine == "native":
+        library = BarcodeKeys(args.bclib, codec)
+        logging.info("loaded barcode library")
+        batches = library_batches(args.alignments, library, metrics)
+        with open(args.outfile, "wb") as out:
+            if args.presorted:
+                merge_presorted(batches, codec, out, args.umi_mismatches, metrics, args.spurious_threshold)
+            else:
+                merge_duplicates(batches, codec, out, max_memory, args.tmpdir, args.umi_mismatches, metrics, args.spurious_threshold)
+        library.close()
+    else:
+        try:
+            tmpdir = mkdtemp(dir=args.tmpdir)
+            logging.debug("tmpdir: " + tmpdir)
+            sort_cmd = "sort --compress-program=gzip -T " + tmpdir
+            if max_memory is not None:
+                sort_cmd += " -S {}b".format(max_memory)
+
+            # prepare alinments
+            syscall2 = "cat " + args.alignments + " | awk -F \"\\t\" 'BEGIN{OFS=\"\\t\"}{split($4, a, \" \"); $4 = a[1]; print}'| " + sort_cmd + " -k4,4 > " + tmpdir + "/alns.csv"
+            check_call(syscall2, shell=True)
+
+            # join barcode library and alignments
+            # after join: id, bc, chr, start, stop, mapscore, strand
+            # after datamash: bc, chr, start, stop, strand, ndupes, idrepresentative
+            if args.barcode_space != NT_SPACE:
+                logging.info("packing barcodes in {} space".format(args.barcode_space))
+                library = BarcodeKeys(args.bclib, codec)
+                join_packed_library(tmpdir + "/alns.csv", library, tmpdir + "/joined.csv")
+                library.close()
+                joined = "cat " + tmpdir + "/joined.csv"
+            elif is_binary_library(args.bclib):
+                logging.info("looking up barcodes in binary barcode library")
+                join_binary_library(tmpdir + "/alns.csv", args.bclib, tmpdir + "/joined.csv")
+                joined = "cat " + tmpdir + "/joined.csv"
+            else:
+                joined = "cat " + \
+                    args.bclib + \
+                    " | awk 'BEGIN{OFS=\"\\t\"}NR%4==1{gsub(/^@/,\"\"); id=$1}NR%4==2{bc=$1}NR%4==3{print id,bc}' " + \
+                    " | " + sort_cmd + " -k1,1 | join -1 1 -2 4 - " + tmpdir + "/alns.csv "
+            syscall3 = joined + \
+                " | awk 'BEGIN{OFS=\"\\t\"}$2!~/N/{print $1,$2,$3,$4,$5,$6,$7}' " + \
+                " | datamash --sort -g 2,3,4,5,7 count 2 first 1 " + \
+                " | awk 'BEGIN{OFS=\"\\t\"}{print $2,$3,$4,$7,$6,$5}' > " + args.outfile
+            check_call(syscall3, shell=True)
+        finally:
+            logging.debug("removed tmpdir: " + tmpdir)
+            rmtree(tmpdir)
+
+    if metrics is not None:
+        metrics.write(args.metrics)
+        logging.info("wrote metrics to '{}'".format(args.metrics))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+
+import argparse
+import logging
+from bctools_extract import BarcodePattern, TOO_SHORT, NO_ANCHOR, process_blocks, process_paired_chunks
+from bctools_fastq import read_fastq_file_blocks, read_paired_fastq_chunks
+from bctools_io import open_output, COMPRESSION_FORMATS
+# avoid ugly python IOError when stdout output is piped into another program
+# and then truncated (such as piping to head)
+from signal import signal, SIGPIPE, SIG_DFL
+signal(SIGPIPE, SIG_DFL)
+
+tool_description = """
+Preprocess barcoded reads in a single pass.
+
+Combines the steps of extract_bcs.py, convert_bc_to_binary_RY.py and
+remove_tail.py. Barcodes are extracted according to a user-specified pattern
+(see extract_bcs.py), the barcode library is optionally translated to binary
+RY-space and in paired-end mode a fixed number of nucleotides is removed from
+the 3'-end of the mate without barcode. Each read is parsed and written only
+once and no intermediate files are created.
+
+The output files are identical to the results of running extract_bcs.py on
+the barcode mate, remove_tail.py on the other mate and convert_bc_to_binary_RY.py
+on the barcode library, with one difference: if a read is skipped during
+barcode extraction, its mate is dropped as well (as by extract_bcs.py
+--paired), so both output files hold the same pairs. Input files may be gzip,
+bgzf or zstd compressed. By default reads are written to stdout.
+
+Example usage:
+- extract barcodes from the first mate, write the RY-space barcode library to
+  bcs_RY.fastq and remove the readthrough of 7 nts into the barcode from the
+  second mate:
+preprocess_reads.py R1.fastq XXXNNXX --paired R2.fastq --remove-tail 7 --outfile R1_out.fastq --paired-outfile R2_out.fastq --ry-bcs bcs_RY.fastq
+"""
+
+
+class DefaultsRawDescriptionHelpFormatter(argparse.ArgumentDefaultsHelpFormatter,
+                                          argparse.RawDescriptionHelpFormatter):
+    # To join the behaviour of RawDescriptionHelpFormatter with that of ArgumentDefaultsHelpFormatter
+    pass
+
+
+def main():
+    # parse command line arguments
+    parser = argparse.ArgumentParser(description=tool_description,
+                                     formatter_class=DefaultsRawDescriptionHelpFormatter)
+    # positional arguments
+    parser.add_argument(
+        "infile",
+        help="Path to fastq file (first mate in paired-end mode).")
+    parser.add_argument(
+        "pattern",
+        help="Pattern of barcode nucleotides starting at 5'-end. X positions will be moved to the header, N positions will be kept. A, C, G and T positions form anchor sequences that have to match the read and will be removed.")
+    # optional arguments
+    parser.add_argument(
+        "--max-offset",
+        dest="max_offset",
+        type=int,
+        default=0,
+        help="Search the pattern up to this many nts downstream of the 5'-end. Requires an anchor sequence in the pattern, nts in front of the pattern are removed.")
+    parser.add_argument(
+        "--anchor-mismatches",
+        dest="anchor_mismatches",
+        type=int,
+        default=0,
+        help="Allow this many mismatches in the anchor sequences of the pattern.")
+    parser.add_argument(
+        "-o", "--outfile",
+        help="Write reads to this file.")
+    parser.add_argument(
+        "--paired",
+        dest="mate2",
+        help="Path to fastq file of the second mate. Enables paired-end mode.")
+    parser.add_argument(
+        "--paired-outfile",
+        dest="mate2_outfile",
+        help="Write reads of the second mate to this file (paired-end mode).")
+    parser.add_argument(
+        "--barcode-mate",
+        dest="barcode_mate",
+        type=int,
+        choices=[1, 2],
+        default=1,
+        help="Extract barcodes from this mate (paired-end mode).")
+    parser.add_argument(
+        "--remove-tail",
+        dest="tail_length",
+        type=int,
+        help="Remove this many nts from the 3'-end of the mate without barcode (paired-end mode).")
+    parser.add_argument(
+        "-b", "--bcs",
+        dest="out_bc_fasta",
+        help="Write barcodes to this file in FASTQ format.")
+    parser.add_argument(
+        "--ry-bcs",
+        dest="out_ry_bcs",
+        help="Write barcodes translated to binary RY-space to this file in FASTQ format.")
+    parser.add_argument(
+        "--fasta-barcodes",
+        dest="save_bcs_as_fa",
+        action="store_true",
+        help="Save barcode libraries in FASTA format.")
+    parser.add_argument(
+        "-a", "--add-bc-to-fastq",
+        dest="add_to_head",
+        help="Append extracted barcodes to the FASTQ headers.",
+        action="store_true")
+    parser.add_argument(
+        "--compress",
+        choices=COMPRESSION_FORMATS,
+        help="Compress output files using this format.")
+    parser.add_argument(
+        "--compress-threads",
+        dest="compress_threads",
+        type=int,
+        default=1,
+        help="Number of threads used for compressing output.")
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="Process reads using this many worker processes. Output order is preserved.")
+    # misc arguments
+    parser.add_argument(
+        "-v", "--verbose",
+        help="Be verbose.",
+        action="store_true")
+    parser.add_argument(
+        "-d", "--debug",
+        help="Print lots of debugging information",
+        action="store_true")
+
+    args = parser.parse_args()
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG, format="%(asctime)s - %(filename)s - %(levelname)s - %(message)s")
+    elif args.verbose:
+        logging.basicConfig(level=logging.INFO, format="%(filename)s - %(levelname)s - %(message)s")
+    else:
+        logging.basicConfig(format="%(filename)s - %(levelname)s - %(message)s")
+    logging.info("Parsed arguments:")
+    logging.info("  infile: '{}'".format(args.infile))
+    logging.info("  pattern: '{}'".format(args.pattern))
+    logging.info("  max-offset: {}".format(args.max_offset))
+    logging.info("  anchor-mismatches: {}".format(args.anchor_mismatches))
+    logging.info("  outfile: '{}'".format(args.outfile))
+    if args.mate2:
+        logging.info("  paired: '{}'".format(args.mate2))
+        logging.info("  paired-outfile: '{}'".format(args.mate2_outfile))
+        logging.info("  barcode-mate: {}".format(args.barcode_mate))
+        logging.info("  remove-tail: {}".format(args.tail_length))
+    logging.info("  bcs: '{}'".format(args.out_bc_fasta))
+    logging.info("  ry-bcs: '{}'".format(args.out_ry_bcs))
+    if args.compress:
+        logging.info("  compress: writing {} compressed output using {} threads".format(args.compress, args.compress_threads))
+    logging.info("  threads: {}".format(args.threads))
+    logging.info("")
+
+    # check parameters
+    if args.threads < 1:
+        raise ValueError("Threads must be a positive integer, is '{}'.".format(args.threads))
+    if args.mate2 is None and (args.mate2_outfile is not None or args.tail_length is not None):
+        raise ValueError("Options --paired-outfile and --remove-tail require paired-end mode (--paired).")
+    if args.mate2 is not None and args.mate2_outfile is None:
+        raise ValueError("Paired-end mode requires an output file for the second mate (--paired-outfile).")
+    if args.tail_length is not None and args.tail_length < 0:
+        raise ValueError("Length must be a positive integer, is '{}'.".format(args.tail_length))
+    pattern = BarcodePattern(args.pattern, args.max_offset, args.anchor_mismatches)
+
+    # open output files
+    def output(filename):
+        return open_output(filename, args.compress, args.compress_threads)
+    samout = output(args.outfile)
+    mate2out = output(args.mate2_outfile) if args.mate2 is not None else None
+    bcout = output(args.out_bc_fasta) if args.out_bc_fasta is not None else None
+    rybcout = output(args.out_ry_bcs) if args.out_ry_bcs is not None else None
+
+    # stream reads through all stages
+    options = dict(add_to_head=args.add_to_head,
+                   fasta_barcodes=args.save_bcs_as_fa,
+                   nt_library=bcout is not None,
+                   ry_library=rybcout is not None)
+    if args.mate2 is not None:
+        chunks = read_paired_fastq_chunks(args.infile, args.mate2)
+        results = process_paired_chunks(chunks, pattern, args.threads, barcode_mate=args.barcode_mate,
+                                        tail_length=args.tail_length, **options)
+    else:
+        blocks = read_fastq_file_blocks(args.infile)
+        results = process_blocks(blocks, pattern, args.threads, **options)
+    n_no_anchor = 0
+    for result in results:
+        for header, seq, reason in result.skipped:
+            if reason == NO_ANCHOR:
+                n_no_anchor += 1
+            elif reason == TOO_SHORT:
+                logging.warning("skipping read '{}', is too short to extract the full requested barcode".format(header.decode()))
+            else:
+                logging.warning("skipping read '{}', no sequence remains after barcode extraction".format(header.decode()))
+        samout.write(result.reads)
+        if mate2out is not None:
+            mate2out.write(result.mate_reads)
+        if bcout is not None:
+            bcout.write(result.barcodes)
+        if rybcout is not None:
+            rybcout.write(result.ry_barcodes)
+
+    if n_no_anchor:
+        logging.warning("skipped {} reads, no anchor sequence found".format(n_no_anchor))
+
+    # close files
+    for out in (samout, mate2out, bcout, rybcout):
+        if out is not None:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
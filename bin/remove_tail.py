@@ -2,8 +2,9 @@
 
 import argparse
 import logging
-from sys import stdout
-from Bio.SeqIO.QualityIO import FastqGeneralIterator
+from bctools_fastq import FastqWriter, read_fastq_file_blocks, read_paired_fastq_chunks, parse_fastq_block, remove_tail, find_readthroughs, DEFAULT_SEED_LENGTH
+from bctools_index import shard_offsets
+from bctools_io import open_output, COMPRESSION_FORMATS
 # avoid ugly python IOError when stdout output is piped into another program
 # and then truncated (such as piping to head)
 from signal import signal, SIGPIPE, SIG_DFL
@@ -11,12 +12,30 @@ signal(SIGPIPE, SIG_DFL)
 
 tool_description = """
 Remove a certain number of nucleotides from the 3'-tails of sequences in FASTQ
-format.
+format. Input files may be gzip, bgzf or zstd compressed.
+
+With --adaptive only actual readthroughs into the barcode of the mate are
+removed. The barcode is expected at the first length nts of the mate reads.
+The --seed-length nts of the mate following the barcode are searched as
+reverse complement in each read; nts behind a match are removed. Inserts
+shorter than the seed are detected if the read starts with the reverse
+complement of the insert and the barcode of the mate, at least --seed-length
+nts in total. Seeds have to match exactly, so a sequencing error in the seed
+hides a readthrough. Reads without readthrough are kept unchanged. The number
+of reads with readthrough is always reported.
 
 Example usage:
 - remove the last 7 nucleotides from file input.fastq, write result to file
   output.fastq:
 remove_tail.py input.fastq 7 --out output.fastq
+- same as above, read and write gzip compressed files:
+remove_tail.py input.fastq.gz 7 --out output.fastq.gz --compress gzip
+- process the first of 4 shards of an uncompressed FASTQ file (see
+  index_fastq.py):
+remove_tail.py input.fastq 7 --shard 1/4 --out output_1.fastq
+- remove readthroughs into the 7 nt barcode at the start of the first mate
+  R1.fastq from the second mate R2.fastq:
+remove_tail.py R2.fastq 7 --adaptive R1.fastq --out R2_out.fastq
 """
 
 # parse command line arguments
@@ -34,6 +53,29 @@ parser.add_argument(
 parser.add_argument(
     "-o", "--outfile",
     help="Write results to this file.")
+parser.add_argument(
+    "--compress",
+    choices=COMPRESSION_FORMATS,
+    help="Compress output using this format.")
+parser.add_argument(
+    "--compress-threads",
+    dest="compress_threads",
+    type=int,
+    default=1,
+    help="Number of threads used for compressing output.")
+parser.add_argument(
+    "--adaptive",
+    dest="mate",
+    help="Path to fastq file of the mate with barcode. Only remove detected readthroughs into the barcode of the mate. Readthroughs are detected by exact matches of at least --seed-length nts.")
+parser.add_argument(
+    "--seed-length",
+    dest="seed_length",
+    type=int,
+    default=DEFAULT_SEED_LENGTH,
+    help="Number of mate nts used to detect readthroughs (--adaptive).")
+parser.add_argument(
+    "--shard",
+    help="Only process shard i/N of the uncompressed input file, counting from 1. Uses the index built by index_fastq.py if present.")
 parser.add_argument(
     "-v", "--verbose",
     help="Be verbose.",
@@ -56,26 +98,51 @@ logging.info("  length: '{}'".format(args.length))
 if args.outfile:
     logging.info("  outfile: enabled writing to file")
     logging.info("  outfile: '{}'".format(args.outfile))
+if args.compress:
+    logging.info("  compress: writing {} compressed output using {} threads".format(args.compress, args.compress_threads))
+if args.mate:
+    logging.info("  adaptive: removing readthroughs into barcodes of '{}'".format(args.mate))
+    logging.info("  seed-length: {}".format(args.seed_length))
+if args.shard:
+    logging.info("  shard: {}".format(args.shard))
 logging.info("")
 
 # check length parameter
 if args.length < 0:
     raise ValueError("Length must be a positive integer, is '{}'.".format(args.length))
+if args.seed_length < 1:
+    raise ValueError("Seed length must be a positive integer, is '{}'.".format(args.seed_length))
 
-# remove tail
-with (open(args.outfile, "w") if args.outfile is not None else stdout) as samout:
-    for header, seq, qual in FastqGeneralIterator(open(args.infile)):
+# remove readthroughs detected using the mate
+if args.mate is not None:
+    ranges = shard_offsets([args.infile, args.mate], args.shard) if args.shard is not None else None
+    n_reads = 0
+    n_trimmed = 0
+    with FastqWriter(open_output(args.outfile, args.compress, args.compress_threads)) as samout:
+        for records, mate_records in read_paired_fastq_chunks(args.infile, args.mate, ranges=ranges):
+            readthroughs = find_readthroughs([seq for _, seq, _ in records], [seq for _, seq, _ in mate_records],
+                                             args.length, args.seed_length)
+            for i, n_keep in readthroughs:
+                header, seq, qual = records[i]
+                records[i] = (header, seq[:n_keep], qual[:n_keep])
+            samout.write_fastq_records(records)
+            n_trimmed += len(readthroughs)
+            n_reads += len(records)
+    logging.warning("removed readthroughs from {} of {} reads".format(n_trimmed, n_reads))
+
+else:
+    # remove fixed-length tail
+    start, stop = shard_offsets([args.infile], args.shard)[0] if args.shard is not None else (0, None)
+    with FastqWriter(open_output(args.outfile, args.compress, args.compress_threads)) as samout:
+        for block in read_fastq_file_blocks(args.infile, start=start, stop=stop):
+            for header, seq, qual in parse_fastq_block(block):
 
-        # if removing tail would lead to an empty sequence,
-        # set sequence to a single N to keep fastq synchronized
-        if len(seq) <= args.length:
-            seq = "N"
-            qual = "B"
-            logging.debug("read '{}' was too short to remove full tail".format(header))
-            logging.debug("seq: {}".format(seq))
-            logging.debug("len(seq): {}".format(len(seq)))
-        else:
-            seq = seq[0:-args.length]
-            qual = qual[0:-args.length]
+                # if removing tail would lead to an empty sequence,
+                # set sequence to a single N to keep fastq synchronized
+                if len(seq) <= args.length:
+                    logging.debug("read '{}' was too short to remove full tail".format(header.decode()))
+                    logging.debug("seq: {}".format(seq.decode()))
+                    logging.debug("len(seq): {}".format(len(seq)))
+                seq, qual = remove_tail(seq, qual, args.length)
 
-        samout.write("@%s\n%s\n+\n%s\n" % (header, seq, qual))
+                samout.write_fastq(header, seq, qual)
@@ -5,6 +5,10 @@ import argparse
 import logging
 from subprocess import check_call
 import os
+from sys import stdout
+from bctools_spurious import remove_spurious, remove_spurious_presorted, parse_thresholds, sweep_thresholds, write_sweep_summary
+
+ENGINES = ("native", "pipeline")
 
 tool_description = """
 Remove spurious events originating from errors in random sequence tags.
@@ -13,6 +17,32 @@ This script compares all events sharing the same coordinates. Among each group
 of events the maximum number of PCR duplicates is determined. All events that
 are supported by less than 10 percent of this maximum count are removed.
 
+By default events are filtered in-process: all events are sorted once into the
+output order and filtered group by group. With --engine pipeline the previous
+sort/perl/sort pipeline is used, which requires GNU coreutils and perl. The
+order of the pipeline output depends on the locale, the native engine orders
+strands as in the en_US.UTF-8 locale ("-" before "+") and compares names as
+byte strings.
+
+With --presorted, events sorted by chrom and start (e.g. by sort -k1,1
+-k2,2n or as written by merge_pcr_duplicates.py --presorted) are filtered as
+they are read, keeping only the events of one position in memory. Positions
+are written in input order.
+
+With --thresholds, several thresholds are evaluated in a single pass. All
+events are written to the outfile with the ratio of their count to the
+maximum count of their group appended as seventh column. An event is removed
+at threshold t if its count is less than t times the maximum count. The
+number of events and of PCR duplicates kept and removed at each threshold
+are written as table to --summary or to stdout.
+
+With --window W, events are compared to the maximum count of all events of
+the same chrom and strand whose start and stop are both within W nt of their
+own, so low-count events shifted by a few nt from a dominant event, e.g. by
+soft-clipping, are removed as well. The maxima are determined by a sweep line
+over sorted events in O(n log n) time. --window 0 compares events of
+identical coordinates only.
+
 Input:
 * bed6 file containing crosslinking events with score field set to number of PCR
   duplicates
@@ -23,7 +53,10 @@ Output:
 
 Example usage:
 - remove spurious events from spurious.bed and write results to file cleaned.bed
-rm_spurious_events.py spurious.bed --oufile cleaned.bed
+rm_spurious_events.py spurious.bed --outfile cleaned.bed
+- compare thresholds 0.05, 0.1 and 0.2 and write events annotated with ratios
+  to file ratios.bed
+rm_spurious_events.py spurious.bed --thresholds 0.05,0.1,0.2 --outfile ratios.bed
 """
 
 
@@ -52,6 +85,26 @@ def main():
         default=0.1,
         help="Threshold for spurious event removal."
     )
+    parser.add_argument(
+        "--window",
+        type=int,
+        default=0,
+        help="Compare events to the maximum count of events of the same chrom and strand with start and stop within this many nt.")
+    parser.add_argument(
+        "--thresholds",
+        help="Evaluate these comma-separated thresholds in a single pass, e.g. 0.05,0.1,0.2. Writes all events annotated with the ratio of their count to the maximum count to the outfile and the number of events kept per threshold to --summary. Replaces --threshold.")
+    parser.add_argument(
+        "--summary",
+        help="Write the summary of --thresholds to this file instead of stdout.")
+    parser.add_argument(
+        "--engine",
+        choices=ENGINES,
+        default="native",
+        help="Filter events in-process (native) or using external programs (pipeline).")
+    parser.add_argument(
+        "--presorted",
+        action="store_true",
+        help="Events are sorted by chrom and start. Filter them one position at a time.")
     # misc arguments
     parser.add_argument(
         "-v", "--verbose",
@@ -73,6 +126,11 @@ def main():
     logging.info("Parsed arguments:")
     logging.info("  alignments: '{}'".format(args.events))
     logging.info("  threshold: '{}'".format(args.threshold))
+    logging.info("  window: {}".format(args.window))
+    logging.info("  thresholds: {}".format(args.thresholds))
+    logging.info("  summary: '{}'".format(args.summary))
+    logging.info("  engine: {}".format(args.engine))
+    logging.info("  presorted: {}".format(args.presorted))
     if args.outfile:
         logging.info("  outfile: enabled writing to file")
         logging.info("  outfile: '{}'".format(args.outfile))
@@ -81,10 +139,39 @@ def main():
     # check threshold parameter value
     if args.threshold < 0 or args.threshold > 1:
         raise ValueError("Threshold must be in [0,1].")
+    if args.presorted and args.engine != "native":
+        raise ValueError("Option --presorted requires the native engine.")
+    if args.window < 0:
+        raise ValueError("Window must not be negative, is '{}'.".format(args.window))
+    if args.window and (args.engine != "native" or args.presorted):
+        raise ValueError("Option --window requires the native engine and can not be combined with --presorted.")
+    thresholds = parse_thresholds(args.thresholds) if args.thresholds is not None else None
+    if thresholds is not None and args.engine != "native":
+        raise ValueError("Option --thresholds requires the native engine.")
+    if args.summary is not None and thresholds is None:
+        raise ValueError("Option --summary requires --thresholds.")
 
     if not os.path.isfile(args.events):
         raise Exception("ERROR: file '{}' not found.")
 
+    if thresholds is not None:
+        with open(args.outfile, "wb") as out:
+            summary = sweep_thresholds(args.events, out, thresholds, args.presorted, args.window)
+        if args.summary is not None:
+            with open(args.summary, "w") as summary_out:
+                write_sweep_summary(summary, summary_out)
+        else:
+            write_sweep_summary(summary, stdout)
+        return
+
+    if args.engine == "native":
+        with open(args.outfile, "wb") as out:
+            if args.presorted:
+                remove_spurious_presorted(args.events, out, args.threshold)
+            else:
+                remove_spurious(args.events, out, args.threshold, args.window)
+        return
+
     # prepare barcode library
     syscall = "cat " + args.events + " | sort -k1,1V -k6,6 -k2,2n -k3,3 -k5,5nr | perl " + os.path.dirname(os.path.realpath(__file__)) + "/rm_spurious_events.pl --frac_max " + str(args.threshold) + "| sort -k1,1V -k2,2n -k3,3n -k6,6 -k4,4 -k5,5nr > " + args.outfile
     check_call(syscall, shell=True)
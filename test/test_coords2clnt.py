@@ -65,3 +65,34 @@ def test_call_stdout():
         testdir + outfile,
         datadir + "merged_pcr_dupes_clnts.bed"
     ))
+
+
+def test_call_gzip_input():
+    "Call coords2clnt.py with gzip compressed infile and outfile."
+    infile = "merged_pcr_dupes.bed.gz"
+    outfile = "merged_pcr_dupes_clnts_gzip_input.bed"
+    env.run(
+        bindir_rel + "coords2clnt.py",
+        datadir_rel + infile,
+        "--outfile", outfile
+    )
+    assert(cmp(
+        testdir + outfile,
+        datadir + "merged_pcr_dupes_clnts.bed"
+    ))
+
+
+def test_call_pybedtools_engine():
+    "Call coords2clnt.py with infile and outfile using pybedtools."
+    infile = "merged_pcr_dupes.bed"
+    outfile = "merged_pcr_dupes_clnts_pybedtools.bed"
+    env.run(
+        bindir_rel + "coords2clnt.py",
+        datadir_rel + infile,
+        "--outfile", outfile,
+        "--engine", "pybedtools"
+    )
+    assert(cmp(
+        testdir + outfile,
+        datadir + "merged_pcr_dupes_clnts.bed"
+    ))
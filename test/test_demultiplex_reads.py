@@ -0,0 +1,78 @@
+from filecmp import cmp
+import re
+from scripttest import TestFileEnvironment
+
+bindir = "bin/"
+datadir = "test/data/"
+testdir = "test/testenv_demultiplex_reads/"
+env = TestFileEnvironment(testdir)
+# relative to test file environment
+bindir_rel = "../../" + bindir
+datadir_rel = "../../" + datadir
+
+
+def test_call_without_parameters():
+    "Call demultiplex_reads.py withouth any additional parameters."
+    run = env.run(
+        bindir_rel + "demultiplex_reads.py",
+        expect_error=True
+    )
+    assert(re.search("usage", run.stderr))
+
+
+def test_call_ry_space_with_mismatch():
+    "Demultiplex reads by RR/YY barcodes in RY-space allowing one mismatch."
+    env.run(
+        bindir_rel + "demultiplex_reads.py",
+        datadir_rel + "reads.fastq",
+        "XX",
+        bindir_rel + "RR_bcs.fa",
+        "--ry-space",
+        "--mismatches", 1,
+        "--prefix", "RR_",
+        "--stats", "RR_stats.tsv",
+    )
+    assert(cmp(
+        testdir + "RR_repA.fastq",
+        datadir + "demux_RR_repA.fastq"
+    ))
+    assert(cmp(
+        testdir + "RR_ambiguous.fastq",
+        datadir + "demux_RR_ambiguous.fastq"
+    ))
+    assert(cmp(
+        testdir + "RR_stats.tsv",
+        datadir + "demux_RR_stats.tsv"
+    ))
+
+
+def test_call_unassigned_reads_threads():
+    "Demultiplex reads by RYYR/YRRY barcodes using two worker processes."
+    env.run(
+        bindir_rel + "demultiplex_reads.py",
+        datadir_rel + "reads.fastq",
+        "XXXX",
+        bindir_rel + "RYYR_bcs.fa",
+        "--ry-space",
+        "--mismatches", 1,
+        "--prefix", "RYYR_",
+        "--stats", "RYYR_stats.tsv",
+        "--threads", 2,
+    )
+    assert(cmp(
+        testdir + "RYYR_stats.tsv",
+        datadir + "demux_RYYR_stats.tsv"
+    ))
+
+
+def test_call_barcode_length_mismatch():
+    "Fail if the sample barcodes do not fit the pattern."
+    run = env.run(
+        bindir_rel + "demultiplex_reads.py",
+        datadir_rel + "reads.fastq",
+        "XXX",
+        bindir_rel + "RR_bcs.fa",
+        "--ry-space",
+        expect_error=True
+    )
+    assert(re.search("do not match", run.stderr))
@@ -1,5 +1,8 @@
 from filecmp import cmp
+import gzip
 import re
+import shutil
+import sys
 from scripttest import TestFileEnvironment
 
 bindir = "bin/"
@@ -9,6 +12,13 @@ env = TestFileEnvironment(testdir)
 # relative to test file environment
 bindir_rel = "../../" + bindir
 datadir_rel = "../../" + datadir
+# runs the script given as first argument with the spawn start method of
+# multiprocessing, the default on macOS and Windows
+spawn_script = ("import multiprocessing, os, runpy, sys; "
+                "multiprocessing.set_start_method('spawn'); "
+                "sys.argv = sys.argv[1:]; "
+                "sys.path.insert(0, os.path.dirname(sys.argv[0])); "
+                "runpy.run_path(sys.argv[0], run_name='__main__')")
 
 
 def test_call_without_parameters():
@@ -174,3 +184,224 @@ def test_writing_bcs_to_file_no_move_to_head_fasta_out():
         testdir + "outfile_original_head.fastq",
         datadir + "result_original_head.fastq"
     ))
+
+
+def test_skip_short_reads():
+    "Extract and remove barcodes, skip reads that are too short for the pattern."
+    run = env.run(
+        bindir_rel + "extract_bcs.py",
+        datadir_rel + "shortreads.fastq",
+        "XXXXNNXX",
+        "--add-bc-to-fastq",
+        "--outfile", "shortreads_extracted.fastq",
+        expect_stderr=True,
+    )
+    assert(re.search("tooshort", run.stderr))
+    assert(cmp(
+        testdir + "shortreads_extracted.fastq",
+        datadir + "shortreads_extracted.fastq"
+    ))
+
+
+def test_threads():
+    "Extract and remove barcodes using multiple worker processes on many small blocks, write results to files."
+    env.run(
+        bindir_rel + "extract_bcs.py",
+        datadir_rel + "reads.fastq",
+        "XXXNNXXX",
+        "--add-bc-to-fastq",
+        "--out", "outfile_threads.fastq",
+        "--bcs", "extracted_bcs_threads.fastq",
+        "--threads", 2,
+        "--chunk-size", 1000,
+    )
+    assert(cmp(
+        testdir + "outfile_threads.fastq",
+        datadir + "result.fastq"
+    ))
+    assert(cmp(
+        testdir + "extracted_bcs_threads.fastq",
+        datadir + "extracted_bcs.fastq"
+    ))
+
+
+def test_threads_spawn():
+    "Extract and remove barcodes using multiple worker processes started by the spawn start method."
+    env.run(
+        sys.executable, "-c", spawn_script,
+        bindir_rel + "extract_bcs.py",
+        datadir_rel + "reads.fastq",
+        "XXXNNXXX",
+        "--add-bc-to-fastq",
+        "--out", "outfile_threads_spawn.fastq",
+        "--bcs", "extracted_bcs_threads_spawn.fastq",
+        "--threads", 2,
+        "--chunk-size", 1000,
+    )
+    assert(cmp(
+        testdir + "outfile_threads_spawn.fastq",
+        datadir + "result.fastq"
+    ))
+    assert(cmp(
+        testdir + "extracted_bcs_threads_spawn.fastq",
+        datadir + "extracted_bcs.fastq"
+    ))
+
+
+def test_bgzf_compressed_output():
+    "Extract and remove barcodes, write bgzf compressed results to files."
+    env.run(
+        bindir_rel + "extract_bcs.py",
+        datadir_rel + "reads.fastq",
+        "XXXNNXXX",
+        "--add-bc-to-fastq",
+        "--out", "outfile.fastq.gz",
+        "--bcs", "extracted_bcs.fastq.gz",
+        "--compress", "bgzf",
+    )
+    for compressed, expected in [("outfile.fastq.gz", "result.fastq"),
+                                 ("extracted_bcs.fastq.gz", "extracted_bcs.fastq")]:
+        with gzip.open(testdir + compressed, "rb") as f, open(testdir + expected, "wb") as out:
+            out.write(f.read())
+        assert(cmp(
+            testdir + expected,
+            datadir + expected
+        ))
+
+
+def test_paired_end():
+    "Extract barcodes from first mate and remove tail from second mate in paired-end mode."
+    env.run(
+        bindir_rel + "extract_bcs.py",
+        datadir_rel + "reads.fastq",
+        "XXXNNXXX",
+        "--paired", datadir_rel + "reads_mate2.fastq",
+        "--remove-tail", 7,
+        "--out", "outfile_mate1.fastq",
+        "--paired-outfile", "outfile_mate2.fastq",
+        "--bcs", "extracted_bcs_paired.fastq",
+    )
+    assert(cmp(
+        testdir + "outfile_mate1.fastq",
+        datadir + "result_original_head.fastq"
+    ))
+    assert(cmp(
+        testdir + "outfile_mate2.fastq",
+        datadir + "reads_mate2_tailremoved.fastq"
+    ))
+    assert(cmp(
+        testdir + "extracted_bcs_paired.fastq",
+        datadir + "extracted_bcs.fastq"
+    ))
+
+
+def test_shards():
+    "Extract barcodes from three shards of an indexed file, concatenated shards equal single run."
+    shutil.copy(datadir + "reads.fastq", testdir + "reads_sharded.fastq")
+    env.run(
+        bindir_rel + "index_fastq.py",
+        "reads_sharded.fastq",
+        "--interval", 10,
+    )
+    for i in range(1, 4):
+        env.run(
+            bindir_rel + "extract_bcs.py",
+            "reads_sharded.fastq",
+            "XXXNNXXX",
+            "--shard", "{}/3".format(i),
+            "--out", "outfile_shard{}.fastq".format(i),
+            "--bcs", "extracted_bcs_shard{}.fastq".format(i),
+        )
+    for prefix, expected in (("outfile_shard", "result_original_head.fastq"),
+                             ("extracted_bcs_shard", "extracted_bcs.fastq")):
+        with open(testdir + prefix + "s.fastq", "wb") as out:
+            for i in range(1, 4):
+                with open(testdir + "{}{}.fastq".format(prefix, i), "rb") as shard:
+                    out.write(shard.read())
+        assert(cmp(
+            testdir + prefix + "s.fastq",
+            datadir + expected
+        ))
+
+
+def test_shards_without_index():
+    "Extract barcodes from a shard of a file without index, warning that the index is built by every shard."
+    shutil.copy(datadir + "reads.fastq", testdir + "reads_unindexed.fastq")
+    run = env.run(
+        bindir_rel + "extract_bcs.py",
+        "reads_unindexed.fastq",
+        "XXXNNXXX",
+        "--shard", "1/2",
+        "--out", "outfile_unindexed_shard1.fastq",
+        expect_stderr=True,
+    )
+    assert(re.search("index_fastq.py", run.stderr))
+
+
+def test_paired_end_mismatching_ids():
+    "Check if extract_bcs.py reports mates with differing read ids."
+    run = env.run(
+        bindir_rel + "extract_bcs.py",
+        datadir_rel + "reads.fastq",
+        "XXXNNXXX",
+        "--paired", datadir_rel + "readswithtail.fastq",
+        "--paired-outfile", "outfile_mismatch.fastq",
+        expect_error=True,
+    )
+    assert(run.returncode != 0)
+
+
+def test_writing_bcs_to_binary_library():
+    "Extract and remove barcodes, write extracted barcodes to a binary barcode library."
+    env.run(
+        bindir_rel + "extract_bcs.py",
+        datadir_rel + "reads.fastq",
+        "XXXNNXXX",
+        "--out", "outfile_binary_library.fastq",
+        "--bcs", "extracted_bcs.bclib",
+        "--binary-barcodes",
+    )
+    assert(cmp(
+        testdir + "extracted_bcs.bclib",
+        datadir + "extracted_bcs.bclib"
+    ))
+    assert(cmp(
+        testdir + "outfile_binary_library.fastq",
+        datadir + "result_original_head.fastq"
+    ))
+
+
+def test_anchor_with_offset_and_mismatches():
+    "Extract barcodes next to a linker sequence found at variable offsets, allowing one mismatch."
+    run = env.run(
+        bindir_rel + "extract_bcs.py",
+        datadir_rel + "reads_anchor.fastq",
+        "XXXXXXTGAC",
+        "--max-offset", 3,
+        "--anchor-mismatches", 1,
+        "--add-bc-to-fastq",
+        "--out", "reads_anchor_extracted.fastq",
+        "--bcs", "reads_anchor_bcs.fastq",
+        expect_stderr=True,
+    )
+    assert(re.search("skipped 1 reads, no anchor sequence found", run.stderr))
+    assert(cmp(
+        testdir + "reads_anchor_extracted.fastq",
+        datadir + "reads_anchor_extracted.fastq"
+    ))
+    assert(cmp(
+        testdir + "reads_anchor_bcs.fastq",
+        datadir + "reads_anchor_bcs.fastq"
+    ))
+
+
+def test_offset_without_anchor():
+    "Check if extract_bcs.py complains about offsets for patterns without anchor sequence."
+    run = env.run(
+        bindir_rel + "extract_bcs.py",
+        datadir_rel + "reads.fastq",
+        "XXXNNXXX",
+        "--max-offset", 3,
+        expect_error=True
+    )
+    assert(run.returncode != 0)
@@ -1,5 +1,7 @@
 from filecmp import cmp
+import os
 import re
+import sys
 from scripttest import TestFileEnvironment
 
 bindir = "bin/"
@@ -9,6 +11,13 @@ env = TestFileEnvironment(testdir)
 # relative to test file environment
 bindir_rel = "../../" + bindir
 datadir_rel = "../../" + datadir
+# runs the script given as first argument with the spawn start method of
+# multiprocessing, the default on macOS and Windows
+spawn_script = ("import multiprocessing, os, runpy, sys; "
+                "multiprocessing.set_start_method('spawn'); "
+                "sys.argv = sys.argv[1:]; "
+                "sys.path.insert(0, os.path.dirname(sys.argv[0])); "
+                "runpy.run_path(sys.argv[0], run_name='__main__')")
 
 
 def test_call_without_parameters():
@@ -72,6 +81,23 @@ def test_call_fileout_fastalib():
     ))
 
 
+def test_call_fileout_binarylib():
+    "Call merge_pcr_duplicates.py with infile and outfile, use binary random barcode library"
+    infile = "pcr_dupes_sorted_2.bed"
+    inlib = "pcr_dupes_randomdict.bclib"
+    outfile = "merged_pcr_dupes_binarylib.bed"
+    env.run(
+        bindir_rel + "merge_pcr_duplicates.py",
+        datadir_rel + infile,
+        datadir_rel + inlib,
+        "--outfile", outfile,
+    )
+    assert(cmp(
+        testdir + outfile,
+        datadir + "merged_pcr_dupes.bed"
+    ))
+
+
 def test_call_no_readids_in_common():
     "Call merge_pcr_duplicates.py with a library that includes none of the required ids."
     infile = "pcr_dupes_sorted_2.bed"
@@ -140,3 +166,341 @@ def test_call_empty_barcode_library():
         testdir + outfile,
         datadir + "empty_file"
     ))
+
+
+def test_call_ry_barcode_space():
+    "Call merge_pcr_duplicates.py merging nucleotide barcodes in binary RY-space."
+    infile = "pcr_dupes_sorted_2.bed"
+    inlib = "pcr_dupes_randomdict_RYmixed.fastq"
+    outfile = "merged_pcr_dupes_ry.bed"
+    env.run(
+        bindir_rel + "merge_pcr_duplicates.py",
+        datadir_rel + infile,
+        datadir_rel + inlib,
+        "--barcode-space", "ry",
+        "--outfile", outfile,
+    )
+    assert(cmp(
+        testdir + outfile,
+        datadir + "merged_pcr_dupes.bed"
+    ))
+
+
+def test_call_pipeline_engine():
+    "Call merge_pcr_duplicates.py using the awk/sort/join/datamash pipeline."
+    infile = "pcr_dupes_sorted_2.bed"
+    inlib = "pcr_dupes_randomdict.fastq"
+    outfile = "merged_pcr_dupes_pipeline.bed"
+    env.run(
+        bindir_rel + "merge_pcr_duplicates.py",
+        datadir_rel + infile,
+        datadir_rel + inlib,
+        "--engine", "pipeline",
+        "--outfile", outfile,
+    )
+    assert(cmp(
+        testdir + outfile,
+        datadir + "merged_pcr_dupes.bed"
+    ))
+
+
+def test_call_max_memory():
+    "Call merge_pcr_duplicates.py with a memory limit requiring temporary files."
+    infile = "pcr_dupes_sorted_2.bed"
+    inlib = "pcr_dupes_randomdict.fastq"
+    outfile = "merged_pcr_dupes_max_memory.bed"
+    env.run(
+        bindir_rel + "merge_pcr_duplicates.py",
+        datadir_rel + infile,
+        datadir_rel + inlib,
+        "--max-memory", "1K",
+        "--tmpdir", ".",
+        "--outfile", outfile,
+    )
+    assert(cmp(
+        testdir + outfile,
+        datadir + "merged_pcr_dupes.bed"
+    ))
+
+
+def test_call_presorted():
+    "Call merge_pcr_duplicates.py on alignments sorted by coordinates."
+    infile = "pcr_dupes_sorted_2.bed"
+    inlib = "pcr_dupes_randomdict.fastq"
+    outfile = "merged_pcr_dupes_presorted.bed"
+    env.run(
+        bindir_rel + "merge_pcr_duplicates.py",
+        datadir_rel + infile,
+        datadir_rel + inlib,
+        "--presorted",
+        "--outfile", outfile,
+    )
+    assert(cmp(
+        testdir + outfile,
+        datadir + "merged_pcr_dupes.bed"
+    ))
+
+
+def test_call_presorted_not_sorted():
+    "Call merge_pcr_duplicates.py --presorted on unsorted alignments."
+    infile = "pcr_dupes_unsorted_2.bed"
+    inlib = "pcr_dupes_randomdict.fastq"
+    outfile = "merged_pcr_dupes_presorted_unsorted.bed"
+    run = env.run(
+        bindir_rel + "merge_pcr_duplicates.py",
+        datadir_rel + infile,
+        datadir_rel + inlib,
+        "--presorted",
+        "--outfile", outfile,
+        expect_error=True,
+    )
+    assert re.search("not sorted", run.stderr), "stderr should report unsorted alignments, was '{}'".format(run.stderr)
+
+
+def test_call_sam_barcode_tag():
+    "Call merge_pcr_duplicates.py on paired-end alignments with barcodes in SAM tag RX."
+    infile = "pcr_dupes_tagged.sam"
+    outfile = "merged_pcr_dupes_tagged.bed"
+    run = env.run(
+        bindir_rel + "merge_pcr_duplicates.py",
+        datadir_rel + infile,
+        "--barcode-tag", "RX",
+        "--outfile", outfile,
+        expect_stderr=True,
+    )
+    assert(cmp(
+        testdir + outfile,
+        datadir + "merged_pcr_dupes.bed"
+    ))
+    assert re.search("skipped 1 read pairs", run.stderr), "stderr should report skipped pairs, was '{}'".format(run.stderr)
+
+
+def test_call_sam_barcode_separator():
+    "Call merge_pcr_duplicates.py on paired-end alignments with barcodes appended to the read names."
+    infile = "pcr_dupes_named.sam"
+    outfile = "merged_pcr_dupes_named.bed"
+    env.run(
+        bindir_rel + "merge_pcr_duplicates.py",
+        datadir_rel + infile,
+        "--barcode-separator", "_",
+        "--outfile", outfile,
+        expect_stderr=True,
+    )
+    assert(cmp(
+        testdir + outfile,
+        datadir + "merged_pcr_dupes.bed"
+    ))
+
+
+def test_call_umi_mismatches():
+    "Call merge_pcr_duplicates.py merging barcodes with sequencing errors."
+    infile = "pcr_dupes_sorted_2.bed"
+    inlib = "pcr_dupes_randomdict_umi_errors.fastq"
+    outfile = "merged_pcr_dupes_umi_mismatches.bed"
+    env.run(
+        bindir_rel + "merge_pcr_duplicates.py",
+        datadir_rel + infile,
+        datadir_rel + inlib,
+        "--umi-mismatches", "1",
+        "--outfile", outfile,
+    )
+    assert(cmp(
+        testdir + outfile,
+        datadir + "merged_pcr_dupes.bed"
+    ))
+
+
+def test_call_threads():
+    "Call merge_pcr_duplicates.py using several worker processes."
+    infile = "pcr_dupes_unsorted_2.bed"
+    inlib = "pcr_dupes_randomdict.fastq"
+    outfile = "merged_pcr_dupes_threads.bed"
+    env.run(
+        bindir_rel + "merge_pcr_duplicates.py",
+        datadir_rel + infile,
+        datadir_rel + inlib,
+        "--threads", "2",
+        "--outfile", outfile,
+    )
+    assert(cmp(
+        testdir + outfile,
+        datadir + "merged_pcr_dupes.bed"
+    ))
+
+
+def test_call_threads_tmpdir_cleanup():
+    "Call merge_pcr_duplicates.py using several worker processes and check that partition files are removed from the tmpdir."
+    infile = "pcr_dupes_unsorted_2.bed"
+    inlib = "pcr_dupes_randomdict.fastq"
+    outfile = "merged_pcr_dupes_threads_tmpdir.bed"
+    run = env.run(
+        bindir_rel + "merge_pcr_duplicates.py",
+        datadir_rel + infile,
+        datadir_rel + inlib,
+        "--threads", "2",
+        "--tmpdir", ".",
+        "--outfile", outfile,
+    )
+    assert(cmp(
+        testdir + outfile,
+        datadir + "merged_pcr_dupes.bed"
+    ))
+    assert(list(run.files_created) == [outfile])
+    assert(not [fn for fn in os.listdir(testdir) if fn.startswith("merge_partitions_")])
+
+
+def test_call_threads_spawn():
+    "Call merge_pcr_duplicates.py using several worker processes started by the spawn start method."
+    infile = "pcr_dupes_unsorted_2.bed"
+    inlib = "pcr_dupes_randomdict.fastq"
+    outfile = "merged_pcr_dupes_threads_spawn.bed"
+    env.run(
+        sys.executable, "-c", spawn_script,
+        bindir_rel + "merge_pcr_duplicates.py",
+        datadir_rel + infile,
+        datadir_rel + inlib,
+        "--threads", "2",
+        "--outfile", outfile,
+    )
+    assert(cmp(
+        testdir + outfile,
+        datadir + "merged_pcr_dupes.bed"
+    ))
+
+
+def test_call_metrics():
+    "Call merge_pcr_duplicates.py and write duplication metrics."
+    infile = "pcr_dupes_sorted_2.bed"
+    inlib = "pcr_dupes_randomdict_withN.fastq"
+    outfile = "merged_pcr_dupes_metrics.bed"
+    metrics = "merged_pcr_dupes_withN_metrics.json"
+    env.run(
+        bindir_rel + "merge_pcr_duplicates.py",
+        datadir_rel + infile,
+        datadir_rel + inlib,
+        "--metrics", metrics,
+        "--outfile", outfile,
+    )
+    assert(cmp(
+        testdir + outfile,
+        datadir + "merged_pcr_dupes_withN.bed"
+    ))
+    assert(cmp(
+        testdir + metrics,
+        datadir + metrics
+    ))
+
+
+def test_call_spurious_threshold():
+    "Call merge_pcr_duplicates.py removing spurious events."
+    infile = "pcr_dupes_sorted_2.bed"
+    inlib = "pcr_dupes_randomdict_umi_errors.fastq"
+    outfile = "merged_pcr_dupes_spurious_threshold.bed"
+    env.run(
+        bindir_rel + "merge_pcr_duplicates.py",
+        datadir_rel + infile,
+        datadir_rel + inlib,
+        "--spurious-threshold", "0.5",
+        "--outfile", outfile,
+    )
+    assert(cmp(
+        testdir + outfile,
+        datadir + "merged_pcr_dupes_umi_errors_spurious_filtered.bed"
+    ))
+
+
+def test_call_metrics_presorted():
+    "Call merge_pcr_duplicates.py on alignments sorted by coordinates and write duplication metrics."
+    infile = "pcr_dupes_sorted_2.bed"
+    inlib = "pcr_dupes_randomdict_withN.fastq"
+    outfile = "merged_pcr_dupes_metrics_presorted.bed"
+    metrics = "merged_pcr_dupes_withN_metrics_presorted.json"
+    env.run(
+        bindir_rel + "merge_pcr_duplicates.py",
+        datadir_rel + infile,
+        datadir_rel + inlib,
+        "--presorted",
+        "--metrics", metrics,
+        "--outfile", outfile,
+    )
+    assert(cmp(
+        testdir + outfile,
+        datadir + "merged_pcr_dupes_withN.bed"
+    ))
+    assert(cmp(
+        testdir + metrics,
+        datadir + "merged_pcr_dupes_withN_metrics.json"
+    ))
+
+
+def test_call_metrics_max_memory():
+    "Call merge_pcr_duplicates.py with --metrics and --max-memory."
+    infile = "pcr_dupes_sorted_2.bed"
+    inlib = "pcr_dupes_randomdict.fastq"
+    outfile = "merged_pcr_dupes_metrics_max_memory.bed"
+    run = env.run(
+        bindir_rel + "merge_pcr_duplicates.py",
+        datadir_rel + infile,
+        datadir_rel + inlib,
+        "--metrics", "metrics_max_memory.json",
+        "--max-memory", "1M",
+        "--outfile", outfile,
+        expect_error=True,
+    )
+    assert(re.search("--max-memory", run.stderr))
+
+
+def test_call_max_memory_spill_near_limit():
+    "Call merge_pcr_duplicates.py with a memory limit and check that runs are spilled close to the limit."
+    infile = "many_alignments.bed"
+    inlib = "many_alignments_randomdict.fastq"
+    max_memory = 256 * 1024
+    with open(testdir + infile, "w") as bed, open(testdir + inlib, "w") as lib:
+        for i in range(20000):
+            barcode = "".join("ACGT"[(i >> (2 * j)) & 3] for j in range(8))
+            bed.write("chr1\t{}\t{}\tread{}\t0\t+\n".format(i, i + 30, i))
+            lib.write("@read{}\n{}\n+\nIIIIIIII\n".format(i, barcode))
+    run = env.run(
+        bindir_rel + "merge_pcr_duplicates.py",
+        infile,
+        inlib,
+        "--max-memory", "256K",
+        "--tmpdir", ".",
+        "--outfile", "many_alignments_merged_max_memory.bed",
+        "--debug",
+        expect_stderr=True,
+    )
+    env.run(
+        bindir_rel + "merge_pcr_duplicates.py",
+        infile,
+        inlib,
+        "--outfile", "many_alignments_merged.bed",
+    )
+    assert(cmp(
+        testdir + "many_alignments_merged_max_memory.bed",
+        testdir + "many_alignments_merged.bed"
+    ))
+    # the last run holds the remaining events
+    spilled = [int(memory) for memory in re.findall(r"spilled \d+ events using about (\d+) bytes", run.stderr)][:-1]
+    assert(len(spilled) > 1)
+    assert(all(0.8 * max_memory <= memory <= 1.2 * max_memory for memory in spilled))
+    assert(not [fn for fn in os.listdir(testdir) if fn.startswith("merge_runs_")])
+
+
+def test_call_umi_mismatches_all_positions():
+    "Call merge_pcr_duplicates.py allowing at least as many mismatches as the barcode length."
+    infile = "pcr_dupes_umi_all_mismatches.bed"
+    inlib = "pcr_dupes_randomdict_umi_all_mismatches.fastq"
+    for mismatches in ("3", "4"):
+        outfile = "merged_pcr_dupes_umi_all_mismatches_{}.bed".format(mismatches)
+        env.run(
+            bindir_rel + "merge_pcr_duplicates.py",
+            datadir_rel + infile,
+            datadir_rel + inlib,
+            "--umi-mismatches", mismatches,
+            "--outfile", outfile,
+        )
+        assert(cmp(
+            testdir + outfile,
+            datadir + "merged_pcr_dupes_umi_all_mismatches.bed"
+        ))
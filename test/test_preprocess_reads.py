@@ -0,0 +1,140 @@
+from filecmp import cmp
+import re
+from scripttest import TestFileEnvironment
+
+bindir = "bin/"
+datadir = "test/data/"
+testdir = "test/testenv_preprocess_reads/"
+env = TestFileEnvironment(testdir)
+# relative to test file environment
+bindir_rel = "../../" + bindir
+datadir_rel = "../../" + datadir
+
+
+def test_call_without_parameters():
+    "Call preprocess_reads.py withouth any additional parameters."
+    run = env.run(
+        bindir_rel + "preprocess_reads.py",
+        expect_error=True
+    )
+    assert(re.search("usage", run.stderr))
+
+
+def test_paired_end_all_stages():
+    "Extract barcodes, convert barcodes to RY-space and remove tail from second mate in a single pass."
+    env.run(
+        bindir_rel + "preprocess_reads.py",
+        datadir_rel + "reads.fastq",
+        "XXXNNXXX",
+        "--paired", datadir_rel + "reads_mate2.fastq",
+        "--remove-tail", 7,
+        "--outfile", "outfile_mate1.fastq",
+        "--paired-outfile", "outfile_mate2.fastq",
+        "--bcs", "extracted_bcs.fastq",
+        "--ry-bcs", "converted_bcs.fastq",
+    )
+    assert(cmp(
+        testdir + "outfile_mate1.fastq",
+        datadir + "result_original_head.fastq"
+    ))
+    assert(cmp(
+        testdir + "outfile_mate2.fastq",
+        datadir + "reads_mate2_tailremoved.fastq"
+    ))
+    assert(cmp(
+        testdir + "extracted_bcs.fastq",
+        datadir + "extracted_bcs.fastq"
+    ))
+    assert(cmp(
+        testdir + "converted_bcs.fastq",
+        datadir + "converted_bcs.fastq"
+    ))
+
+
+def test_single_end_fasta_barcodes():
+    "Extract barcodes and write RY-space barcodes in fasta format, print reads to stdout."
+    run = env.run(
+        bindir_rel + "preprocess_reads.py",
+        datadir_rel + "reads.fastq",
+        "XXXNNXXX",
+        "--add-bc-to-fastq",
+        "--ry-bcs", "converted_bcs.fa",
+        "--fasta-barcodes",
+    )
+    with open(testdir + "stdout_only_positional_args.fastq", "w") as b:
+        b.write(run.stdout)
+    assert(cmp(
+        testdir + "stdout_only_positional_args.fastq",
+        datadir + "result.fastq"
+    ))
+    assert(cmp(
+        testdir + "converted_bcs.fa",
+        datadir + "converted_bcs.fa"
+    ))
+
+
+def test_paired_end_chained_tools():
+    "Compare single-pass preprocessing with running extract_bcs.py, remove_tail.py and convert_bc_to_binary_RY.py one after another."
+    env.run(
+        bindir_rel + "extract_bcs.py",
+        datadir_rel + "reads.fastq",
+        "XXXNNXXX",
+        "--out", "chained_mate1.fastq",
+        "--bcs", "chained_bcs.fastq",
+    )
+    env.run(
+        bindir_rel + "remove_tail.py",
+        datadir_rel + "reads_mate2.fastq",
+        7,
+        "--outfile", "chained_mate2.fastq",
+    )
+    env.run(
+        bindir_rel + "convert_bc_to_binary_RY.py",
+        "chained_bcs.fastq",
+        "--outfile", "chained_bcs_RY.fastq",
+    )
+    env.run(
+        bindir_rel + "preprocess_reads.py",
+        datadir_rel + "reads.fastq",
+        "XXXNNXXX",
+        "--paired", datadir_rel + "reads_mate2.fastq",
+        "--remove-tail", 7,
+        "--outfile", "fused_mate1.fastq",
+        "--paired-outfile", "fused_mate2.fastq",
+        "--bcs", "fused_bcs.fastq",
+        "--ry-bcs", "fused_bcs_RY.fastq",
+    )
+    for chained, fused in [("chained_mate1.fastq", "fused_mate1.fastq"),
+                           ("chained_mate2.fastq", "fused_mate2.fastq"),
+                           ("chained_bcs.fastq", "fused_bcs.fastq"),
+                           ("chained_bcs_RY.fastq", "fused_bcs_RY.fastq")]:
+        assert(cmp(testdir + chained, testdir + fused))
+
+
+def test_long_fasta_barcodes_chained_tools():
+    "Compare RY-space fasta barcodes longer than a fasta line with those written by convert_bc_to_binary_RY.py."
+    pattern = "X" * 62 + "NNNNNNN"
+    env.run(
+        bindir_rel + "extract_bcs.py",
+        datadir_rel + "reads.fastq",
+        pattern,
+        "--out", "chained_long.fastq",
+        "--bcs", "chained_long_bcs.fa",
+        "--fasta-barcodes",
+    )
+    env.run(
+        bindir_rel + "convert_bc_to_binary_RY.py",
+        "chained_long_bcs.fa",
+        "--fasta-format",
+        "--outfile", "chained_long_bcs_RY.fa",
+    )
+    env.run(
+        bindir_rel + "preprocess_reads.py",
+        datadir_rel + "reads.fastq",
+        pattern,
+        "--outfile", "fused_long.fastq",
+        "--ry-bcs", "fused_long_bcs_RY.fa",
+        "--fasta-barcodes",
+    )
+    assert(cmp(testdir + "chained_long.fastq", testdir + "fused_long.fastq"))
+    assert(cmp(testdir + "chained_long_bcs_RY.fa", testdir + "fused_long_bcs_RY.fa"))
@@ -1,4 +1,5 @@
 from filecmp import cmp
+import gzip
 import re
 from scripttest import TestFileEnvironment
 
@@ -56,3 +57,52 @@ def test_writing_fastq_to_file():
     assert(cmp(
         testdir + "outfile.fastq",
         datadir + "readswithtailremoved.fastq"))
+
+
+def test_compressed_input_and_output():
+    "Remove nts from 3' tail, read gzip compressed input and write gzip compressed output."
+    env.run(
+        bindir_rel + "remove_tail.py",
+        datadir_rel + "readswithtail.fastq.gz",
+        7,
+        "--outfile", "outfile.fastq.gz",
+        "--compress", "gzip",
+        "--compress-threads", 2,
+    )
+    with gzip.open(testdir + "outfile.fastq.gz", "rb") as f, open(testdir + "outfile_decompressed.fastq", "wb") as out:
+        out.write(f.read())
+    assert(cmp(
+        testdir + "outfile_decompressed.fastq",
+        datadir + "readswithtailremoved.fastq"))
+
+
+def test_adaptive_readthrough_removal():
+    "Only remove readthroughs into the barcode of the first mate."
+    run = env.run(
+        bindir_rel + "remove_tail.py",
+        datadir_rel + "readthrough_mate2.fastq",
+        7,
+        "--adaptive", datadir_rel + "readthrough_mate1.fastq",
+        "--outfile", "outfile_adaptive.fastq",
+        expect_stderr=True,
+    )
+    assert(re.search("removed readthroughs from 19 of 40 reads", run.stderr))
+    assert(cmp(
+        testdir + "outfile_adaptive.fastq",
+        datadir + "readthrough_mate2_trimmed.fastq"))
+
+
+def test_adaptive_short_inserts():
+    "Remove readthroughs of inserts shorter than the seed into the barcode of the first mate."
+    run = env.run(
+        bindir_rel + "remove_tail.py",
+        datadir_rel + "readthrough_short_mate2.fastq",
+        7,
+        "--adaptive", datadir_rel + "readthrough_short_mate1.fastq",
+        "--outfile", "outfile_adaptive_short.fastq",
+        expect_stderr=True,
+    )
+    assert(re.search("removed readthroughs from 4 of 7 reads", run.stderr))
+    assert(cmp(
+        testdir + "outfile_adaptive_short.fastq",
+        datadir + "readthrough_short_mate2_trimmed.fastq"))
@@ -64,3 +64,71 @@ def test_call_not_sorted():
         testdir + outfile,
         datadir + "merged_pcr_dupes_spurious_filtered2.bed"
     ))
+
+
+def test_call_presorted():
+    "Call rm_spurious_events.py --presorted on events sorted by chrom and start."
+    infile = "merged_pcr_dupes_spurious.bed"
+    outfile = "merged_pcr_dupes_spurious_filtered_presorted.bed"
+    env.run(
+        bindir_rel + "rm_spurious_events.py",
+        datadir_rel + infile,
+        "--outfile", outfile,
+        "--presorted",
+    )
+    assert(cmp(
+        testdir + outfile,
+        datadir + "merged_pcr_dupes_spurious_filtered.bed"
+    ))
+
+
+def test_call_presorted_not_sorted():
+    "Call rm_spurious_events.py --presorted on events that are not sorted."
+    infile = "merged_pcr_dupes_spurious_notsorted.bed"
+    outfile = "merged_pcr_dupes_spurious_filtered_presorted_unsorted.bed"
+    run = env.run(
+        bindir_rel + "rm_spurious_events.py",
+        datadir_rel + infile,
+        "--outfile", outfile,
+        "--presorted",
+        expect_error=True,
+    )
+    assert(re.search("not sorted", run.stderr))
+
+
+def test_call_thresholds():
+    "Call rm_spurious_events.py evaluating several thresholds in one pass."
+    infile = "merged_pcr_dupes_spurious_notsorted.bed"
+    outfile = "merged_pcr_dupes_spurious_ratios.bed"
+    summary = "merged_pcr_dupes_spurious_thresholds.tsv"
+    env.run(
+        bindir_rel + "rm_spurious_events.py",
+        datadir_rel + infile,
+        "--outfile", outfile,
+        "--thresholds", "0.05,0.1,0.5",
+        "--summary", summary,
+    )
+    assert(cmp(
+        testdir + outfile,
+        datadir + "merged_pcr_dupes_spurious_ratios.bed"
+    ))
+    assert(cmp(
+        testdir + summary,
+        datadir + "merged_pcr_dupes_spurious_thresholds.tsv"
+    ))
+
+
+def test_call_window():
+    "Call rm_spurious_events.py comparing events to events with coordinates within 1 nt."
+    infile = "merged_pcr_dupes_spurious_shifted.bed"
+    outfile = "merged_pcr_dupes_spurious_shifted_window1.bed"
+    env.run(
+        bindir_rel + "rm_spurious_events.py",
+        datadir_rel + infile,
+        "--outfile", outfile,
+        "--window", "1",
+    )
+    assert(cmp(
+        testdir + outfile,
+        datadir + "merged_pcr_dupes_spurious_shifted_window1.bed"
+    ))